@@ -20,7 +20,25 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 
+import importlib
 import sys
-from .obminion import main
+
+# python -m obminion <command> [arguments] runs the main() of its module
+COMMANDS = {
+    "simulate": ".simulator",
+    "matrix":   ".matrix",
+    "replay":   ".replay",
+    "memory":   ".memory",
+    "atlas":    ".view.atlas"
+}
+
+if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+    command = importlib.import_module(COMMANDS[sys.argv[1]], __package__)
+    sys.exit(command.main(sys.argv[2:]))
+
+from .timeline import STARTUP
+
+with STARTUP.span("imports"):
+    from .obminion import main
 
 sys.exit(main())
@@ -0,0 +1,338 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Game content: types, abilities, species and teams.
+# Content is read from JSON packs in obminion/data, validated against SCHEMA
+# and merged in order, later packs replacing entries of earlier ones by key.
+# The validated data is cached with marshal under CACHE_DIR, keyed by a hash
+# of the pack bytes, so an unchanged set of packs is neither parsed nor
+# validated again; workers and the game only rebuild the objects.
+# Importing this module only reads the cache; the game writes it at startup.
+# Set OBMINION_PACKS (os.pathsep separated files) to load other packs, and
+# OBMINION_CACHE to move the cache ("" disables it).
+
+import json
+import marshal
+import os
+from collections import namedtuple
+from hashlib import sha1
+
+from .engine.models import UnitTemplate, UnitInstance, UnitType, Ability, AbilityEffect, \
+                          TypeChart
+from .engine.mechanics import compile_effect, parse_trigger
+
+
+SCHEMA_VERSION = 1
+
+PACK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+CACHE_DIR = os.environ.get("OBMINION_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".cache", "obminion"))
+
+
+class ContentError(ValueError):
+    pass
+
+
+###############################################################################
+#   Schema
+###############################################################################
+
+# A spec is a type (or tuple of types), [spec] for a list of spec, or a dict
+# of key: spec for an object. Keys ending in "?" are optional, and the key
+# "*" matches any key, for tables of entries by id.
+
+TEXT    = basestring
+INTEGER = (int, long)
+NUMBER  = (int, long, float)
+
+EFFECT = {
+    "mechanic":     TEXT,
+    "target":       TEXT,
+    "events":       [TEXT],
+    "parameters?":  {"*": NUMBER + (TEXT, list)}
+}
+
+SCHEMA = {
+    "version": INTEGER,
+    "types?": {"*": {
+        "name":         TEXT,
+        "resistances?": [TEXT],
+        "weaknesses?":  [TEXT]
+    }},
+    "abilities?": {"*": {
+        "name":         TEXT,
+        "description?": TEXT,
+        "effects?":     [EFFECT]
+    }},
+    "species?": {"*": {
+        "id":           TEXT,
+        "name":         TEXT,
+        "type":         TEXT,
+        "health":       INTEGER,
+        "power":        INTEGER,
+        "speed":        INTEGER,
+        "abilities?":   [TEXT]
+    }},
+    "teams?": {"*": [TEXT]}
+}
+
+SECTIONS = ("types", "abilities", "species", "teams")
+
+
+def check(value, spec, path = "$"):
+    """Raise ContentError unless `value` matches `spec`."""
+    if isinstance(spec, dict):
+        if not isinstance(value, dict):
+            raise ContentError(path + ": expected an object")
+        if "*" in spec:
+            for key, item in value.iteritems():
+                check(item, spec["*"], path + "." + key)
+            return
+        for key, item_spec in spec.iteritems():
+            name = key.rstrip("?")
+            if name in value:
+                check(value[name], item_spec, path + "." + name)
+            elif name == key:
+                raise ContentError(path + ": missing " + name)
+        for key in value:
+            if not key in spec and not key + "?" in spec:
+                raise ContentError(path + ": unknown key " + key)
+    elif isinstance(spec, list):
+        if not isinstance(value, list):
+            raise ContentError(path + ": expected a list")
+        for i, item in enumerate(value):
+            check(item, spec[0], "{}[{}]".format(path, i))
+    elif isinstance(value, bool) or not isinstance(value, spec):
+        raise ContentError("{}: unexpected value {!r}".format(path, value))
+
+
+def _plain(value):
+    # json yields unicode; the engine compares against str
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_plain(k), _plain(v)) for k, v in value.iteritems())
+    return value
+
+
+###############################################################################
+#   Content Packs
+###############################################################################
+
+def pack_paths():
+    paths = os.environ.get("OBMINION_PACKS")
+    if paths:
+        return [path for path in paths.split(os.pathsep) if path]
+    return [os.path.join(PACK_DIR, name)
+            for name in sorted(os.listdir(PACK_DIR)) if name.endswith(".json")]
+
+
+def parse_packs(sources):
+    """Validate and merge (path, bytes) packs into one plain data dict."""
+    data = dict((section, {}) for section in SECTIONS)
+    for path, text in sources:
+        try:
+            pack = json.loads(text)
+        except ValueError as e:
+            raise ContentError("{}: {}".format(path, e))
+        try:
+            check(pack, SCHEMA)
+            if pack["version"] != SCHEMA_VERSION:
+                raise ContentError("$.version: expected " + str(SCHEMA_VERSION))
+            check_triggers(pack)
+        except ContentError as e:
+            raise ContentError("{}: {}".format(path, e))
+        pack = _plain(pack)
+        for section in SECTIONS:
+            data[section].update(pack.get(section, {}))
+    # references and effects are only checked on the merged data
+    build(data)
+    return data
+
+
+def check_triggers(pack):
+    """Raise ContentError unless every trigger of the pack's abilities names
+    a known event that provides the effect's reference, if any."""
+    for key, entry in pack.get("abilities", {}).iteritems():
+        for i, effect in enumerate(entry.get("effects", ())):
+            reference = effect.get("parameters", {}).get("reference")
+            for trigger in effect["events"]:
+                try:
+                    parse_trigger(trigger, reference)
+                except ValueError as e:
+                    raise ContentError("abilities.{}.effects[{}]: {}".format(
+                                       key, i, e))
+
+
+def build(data):
+    """Create the content objects from plain data."""
+    types = {}
+    for key, entry in data["types"].iteritems():
+        for ref in entry.get("resistances", []) + entry.get("weaknesses", []):
+            _ref(data["types"], ref, "types." + key)
+        types[key] = UnitType(key, entry["name"],
+                              resistances = tuple(entry.get("resistances", ())),
+                              weaknesses = tuple(entry.get("weaknesses", ())))
+    chart = TypeChart([types[key] for key in sorted(types)])
+    abilities = {}
+    for key, entry in data["abilities"].iteritems():
+        path = "abilities." + key
+        effects = tuple(_effect(effect, types, "{}.effects[{}]".format(path, i))
+                        for i, effect in enumerate(entry.get("effects", ())))
+        abilities[key] = Ability(key, entry["name"], effects = effects,
+                                 description = entry.get("description",
+                                                         "No description."))
+        # plans keep the ability, so compile once it is set on the effects
+        for i, effect in enumerate(effects):
+            try:
+                compile_effect(effect)
+            except (ValueError, AssertionError) as e:
+                raise ContentError("{}.effects[{}]: {}".format(
+                                   path, i, e or "invalid parameters"))
+    species = {}
+    for key, entry in data["species"].iteritems():
+        path = "species." + key
+        species[key] = UnitTemplate(entry["id"], entry["name"],
+                                    _ref(types, entry["type"], path),
+                                    entry["health"], entry["power"],
+                                    entry["speed"],
+                                    tuple(_ref(abilities, ability, path)
+                                          for ability in entry.get("abilities", ())))
+    teams = {}
+    for key, entry in data["teams"].iteritems():
+        teams[key] = tuple(UnitInstance(_ref(species, sid, "teams." + key))
+                           for sid in entry)
+    return Content(types, chart, abilities, species, teams)
+
+
+def _ref(table, key, path):
+    try:
+        return table[key]
+    except KeyError:
+        raise ContentError(path + ": unknown reference " + key)
+
+
+def _effect(entry, types, path):
+    parameters = dict(entry.get("parameters", {}))
+    if "type" in parameters:
+        parameters["type"] = _ref(types, parameters["type"], path)
+    if "clamp" in parameters:
+        parameters["clamp"] = tuple(parameters["clamp"])
+    return AbilityEffect(entry["mechanic"], entry["target"],
+                         tuple(entry["events"]), parameters = parameters)
+
+
+Content = namedtuple("Content", ("types", "chart", "abilities", "species", "teams"))
+
+
+###############################################################################
+#   Compiled Cache
+###############################################################################
+
+def content_key(sources):
+    h = sha1("obminion content {} {}".format(SCHEMA_VERSION, marshal.version))
+    for path, text in sources:
+        h.update(os.path.basename(path) + "\0")
+        h.update(sha1(text).digest())
+    return h.hexdigest()
+
+
+def read_cache(path):
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+
+def write_cache(path, data):
+    # written aside and renamed, so concurrent workers never read half a file
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp, "wb") as f:
+            marshal.dump(data, f)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_packs(paths = None):
+    sources = []
+    for path in (paths or pack_paths()):
+        with open(path, "rb") as f:
+            sources.append((path, f.read()))
+    return sources
+
+
+def cache_path(sources, cache_dir = None):
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, "content-{}.bin".format(content_key(sources)))
+
+
+def load_data(paths = None, cache_dir = None, store = True):
+    """Return the plain data of the content packs, from the cache when it
+    holds the same pack contents. A missing cache is written if `store`."""
+    sources = read_packs(paths)
+    cache = cache_path(sources, cache_dir)
+    if cache:
+        data = read_cache(cache)
+        if data is not None:
+            return data
+    data = parse_packs(sources)
+    if cache and store:
+        write_cache(cache, data)
+    return data
+
+
+def load(paths = None, cache_dir = None):
+    return build(load_data(paths = paths, cache_dir = cache_dir))
+
+
+###############################################################################
+#   Loaded Content
+###############################################################################
+
+_data = load_data(store = False)
+_content = build(_data)
+
+
+def store_cache(cache_dir = None):
+    """Write the cache of the loaded content, if it is missing."""
+    cache = cache_path(read_packs(), cache_dir)
+    if cache and not os.path.exists(cache):
+        write_cache(cache, _data)
+
+
+TYPES       = _content.types
+CHART       = _content.chart
+ABILITIES   = _content.abilities
+SPECIES     = _content.species
+TEAMS       = _content.teams
+
+PLAYER = TEAMS["player"]
+DUMMY = TEAMS["dummy"]
@@ -18,6 +18,8 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 
+from collections import deque, namedtuple
+
 # Credits to:
 # http://stackoverflow.com/a/2022629
 
@@ -46,6 +48,8 @@ class Event(list):
     >>> del e[0]
     >>> e(2)
     g(2)
+    >>> e(x = 3)
+    g(3)
     """
     def sub(self, callable):
         self.append(callable)
@@ -59,3 +63,99 @@ class Event(list):
 
     def __repr__(self):
         return "Event({})".format(list.__repr__(self))
+
+
+class QueuedEvent(Event):
+    """Deferred event subscription.
+
+    Calling an instance of this records the call on an EventQueue instead
+    of calling the subscribers. They are called when the queue is drained.
+    Calls are positional: the emitter, then one value for each of `args`.
+    """
+    def __init__(self, queue, name, args = ()):
+        Event.__init__(self)
+        self.queue = queue
+        self.name = name
+        self.record = record_type(name, args)
+
+    def __call__(self, *args):
+        self.queue.push(self, args)
+
+    def dispatch(self, args):
+        for f in self:
+            f(*args)
+
+    def __repr__(self):
+        return "QueuedEvent({})".format(list.__repr__(self))
+
+
+class EventRecord(tuple):
+    """Base of the typed records: a tuple of the event, the cascade depth,
+    the emitter and the event's arguments, in its declared order."""
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.event.name
+
+    @property
+    def args(self):
+        return self[2:]
+
+
+_record_types = {}
+
+def record_type(name, args):
+    """The record class of an event with the given argument names, shared
+    by every topic with the same signature."""
+    key = (name, tuple(args))
+    cls = _record_types.get(key)
+    if cls is None:
+        fields = namedtuple(name.title().replace("_", "") + "Record",
+                            ("event", "depth", "emitter") + key[1])
+        cls = type(fields.__name__, (fields, EventRecord), {"__slots__": ()})
+        _record_types[key] = cls
+    return cls
+
+
+class EventQueue(object):
+    """FIFO of deferred event calls, drained iteratively.
+
+    Calls made while a record is being dispatched are one level deeper in
+    the cascade than that record; calls deeper than max_depth are dropped.
+    """
+    def __init__(self, max_depth = 16):
+        self.records    = deque()
+        self.max_depth  = max_depth
+        self.depth      = 0
+        self.dropped    = 0
+        self.draining   = False
+
+    @property
+    def pending(self):
+        return len(self.records) > 0
+
+    def push(self, event, args):
+        depth = self.depth + 1 if self.draining else 0
+        if depth > self.max_depth:
+            self.dropped += 1
+        else:
+            self.records.append(event.record._make((event, depth) + args))
+
+    def drain(self):
+        """Dispatch queued records, and those they cause, until the queue
+        is empty. Returns the list of dispatched records."""
+        if self.draining:
+            return []
+        batch = []
+        self.draining = True
+        try:
+            while self.records:
+                record = self.records.popleft()
+                self.depth = record.depth
+                record.event.dispatch(record[2:])
+                batch.append(record)
+        finally:
+            self.draining = False
+            self.depth = 0
+        return batch
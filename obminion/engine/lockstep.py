@@ -0,0 +1,441 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Struct-of-arrays battle kernel.
+# Keeps the combat state of N two-team battles in NumPy arrays and advances
+# all of them one round at a time, following the same rules (and the same
+# callback order) as BattleEngine/BattleMechanics.
+# Supported abilities: "damage" and "heal" effects triggered by unit
+# attack, defend, post_attack and death events.
+
+import numpy as np
+
+from .models import NORMAL, PLUS, MINUS
+
+
+CAPACITY = 4
+
+ATTACK          = 0
+ROTATE_CLOCK    = 1
+ROTATE_COUNTER  = 2
+
+ACTIONS = ("attack", "rotate_clock", "rotate_counter")
+
+###############################################################################
+#   Target Specifications
+###############################################################################
+
+FRIEND, OPPONENT, BOTH = 0, 1, 2
+
+# name: (side, relative, offsets or indices, inclusive)
+# Mirrors the _target_* factories of BattleMechanics.
+TARGET_SPECS = {
+    "all":              (BOTH, False, range(CAPACITY), True),
+    "self":             (FRIEND, True, (0,), True),
+    "self_left":        (FRIEND, True, (-1,), False),
+    "self_right":       (FRIEND, True, (1,), False),
+    "self_adjacent":    (FRIEND, True, (1, -1), False),
+    "friend_active":    (FRIEND, False, (0,), True),
+    "friend_all":       (FRIEND, False, range(CAPACITY), True),
+    "friend_left":      (FRIEND, False, (-1,), True),
+    "friend_right":     (FRIEND, False, (1,), True),
+    "friend_adjacent":  (FRIEND, False, (1, -1), True),
+    "friend_front":     (FRIEND, False, (0, 1, -1), True),
+    "friend_others":    (FRIEND, False, range(CAPACITY), False),
+    "friend_standby":   (FRIEND, False, range(1, CAPACITY), True),
+    "opponent":         (OPPONENT, False, (0,), False),
+    "opponent_all":     (OPPONENT, False, range(CAPACITY), False),
+    "opponent_left":    (OPPONENT, False, (-1,), False),
+    "opponent_right":   (OPPONENT, False, (1,), False),
+    "opponent_adjacent": (OPPONENT, False, (1, -1), False),
+    "opponent_front":   (OPPONENT, False, (0, 1, -1), False),
+    "opponent_standby": (OPPONENT, False, range(1, CAPACITY), False)
+}
+
+TARGET_NAMES = sorted(TARGET_SPECS.keys())
+
+# event: numeric arguments passed to callbacks
+EVENTS = {
+    "attack":       (),
+    "defend":       (),
+    "post_attack":  ("damage",),
+    "death":        ()
+}
+
+EVENT_NAMES = sorted(EVENTS.keys())
+
+MECHANICS = ("damage", "heal")
+
+MULTIPLIER_NORMAL, MULTIPLIER_PLUS, MULTIPLIER_MINUS = NORMAL, PLUS, MINUS
+
+
+###############################################################################
+#   Lockstep Battles
+###############################################################################
+
+class LockstepBattles(object):
+    def __init__(self, battles, max_rounds = 100, tie_break = None, rng = None):
+        """`battles` is a sequence of (unit_listing, unit_listing) pairs.
+        Speed ties are resolved by a coin flip from `rng`, or always in
+        favour of team `tie_break` if given."""
+        n = len(battles)
+        self.n          = n
+        self.max_rounds = max_rounds
+        self.tie_break  = tie_break
+        self.rng        = rng or np.random.RandomState()
+        self.round      = np.ones(n, dtype = np.int64)
+        self.over       = np.zeros(n, dtype = bool)
+        self.turn       = np.zeros(n, dtype = np.int64)
+        shape = (n, 2, CAPACITY)
+        self.health     = np.zeros(shape, dtype = np.int64)
+        self.max_health = np.zeros(shape, dtype = np.int64)
+        self.power      = np.zeros(shape, dtype = np.int64)
+        self.speed      = np.zeros(shape, dtype = np.int64)
+        self.type       = np.zeros(shape, dtype = np.int64)
+        self.dead       = np.zeros(shape, dtype = bool)
+        self.removed    = np.zeros(shape, dtype = bool)   # abilities unbound
+        self.index      = np.full(shape, -1, dtype = np.int64)
+        self.slots      = np.full(shape, -1, dtype = np.int64)
+        self.size       = np.zeros((n, 2), dtype = np.int64)
+        self._rows      = np.arange(n)
+        self._chart     = None  # the TypeChart shared by every unit type
+        self._effects   = []
+        self._effect_ids = {}
+        self._callbacks = []
+        self._compiled  = {}
+        unit_callbacks = {}
+        for b in xrange(n):
+            for t in xrange(2):
+                for u, instance in enumerate(battles[b][t][:CAPACITY]):
+                    self._add_unit(b, t, u, instance)
+                    unit_callbacks[(b, t, u)] = self._compile(instance.ability)
+        width = max([len(cbs) for cbs in unit_callbacks.itervalues()] or [0])
+        self.callbacks = np.full(shape + (max(width, 1),), -1, dtype = np.int64)
+        for (b, t, u), cbs in unit_callbacks.iteritems():
+            self.callbacks[b, t, u, :len(cbs)] = cbs
+        self._build_tables()
+
+    @property
+    def running(self):
+        return ~self.over & (self.round <= self.max_rounds)
+
+    @property
+    def winners(self):
+        """Winning team per battle, -1 for draws and unfinished battles."""
+        alive = self.size > 0
+        winner = np.where(alive[:, 0], 0, 1)
+        return np.where(self.over & (alive.sum(axis = 1) == 1), winner, -1)
+
+    def step(self, actions = None):
+        """Play one round (actions, both attacks and the between-rounds
+        cleanup) of every running battle. `actions` is an (N, 2) array of
+        ATTACK, ROTATE_CLOCK or ROTATE_COUNTER."""
+        sel = self.running
+        if actions is not None:
+            self._apply_actions(np.asarray(actions), sel)
+        self._calculate_turn(sel)
+        self._attack(sel)
+        self._cleanup(sel)
+        sel = self._check_over(sel)
+        self.turn = 1 - self.turn
+        self._attack(sel)
+        self._cleanup(sel)
+        sel = self._check_over(sel)
+        self._cleanup(sel)
+        sel = self._check_over(sel)
+        self.round[sel] += 1
+
+    def run(self, policy = None):
+        """Play every battle to the end. `policy(battles)` returns the
+        actions array for the next round; everyone attacks by default."""
+        while self.running.any():
+            self.step(None if policy is None else policy(self))
+        return self.winners
+
+    # -- setup ----------------------------------------------------------------
+
+    def _add_unit(self, b, t, u, instance):
+        template = instance.template
+        self.max_health[b, t, u] = max(1, instance.get_health())
+        self.health[b, t, u] = self.max_health[b, t, u]
+        self.power[b, t, u] = instance.get_power()
+        self.speed[b, t, u] = instance.get_speed()
+        self.type[b, t, u] = self._type_id(template.type)
+        self.index[b, t, u] = u
+        self.slots[b, t, u] = u
+        self.size[b, t] = u + 1
+
+    def _type_id(self, type):
+        if type is None:
+            return -1
+        if type.chart is None:
+            raise ValueError("type is not in a TypeChart: " + type.id)
+        if self._chart is None:
+            self._chart = type.chart
+        elif not type.chart is self._chart:
+            raise ValueError("types from different charts: " + type.id)
+        return type.uid
+
+    def _compile(self, ability):
+        if id(ability) in self._compiled:
+            return self._compiled[id(ability)]
+        callbacks = []
+        self._compiled[id(ability)] = callbacks
+        if ability is None:
+            return callbacks
+        for effect in ability.effects:
+            k = self._effect_id(effect)
+            for trigger in effect.events:
+                source, event = trigger.split()
+                event = event.split(":")[-1]
+                if not source in TARGET_SPECS:
+                    raise ValueError("unsupported trigger source: " + source)
+                if not event in EVENTS:
+                    raise ValueError("unsupported trigger event: " + event)
+                param = effect.parameters or {}
+                if not "amount" in param \
+                        and not param.get("reference") in EVENTS[event]:
+                    raise ValueError("event {} does not provide {}".format(
+                                     event, param.get("reference")))
+                callbacks.append(len(self._callbacks))
+                self._callbacks.append((EVENT_NAMES.index(event),
+                                        TARGET_NAMES.index(source), k))
+        return callbacks
+
+    def _effect_id(self, effect):
+        key = id(effect)
+        if key in self._effect_ids:
+            return self._effect_ids[key]
+        if not effect.mechanic in MECHANICS:
+            raise ValueError("unsupported mechanic: " + effect.mechanic)
+        if not effect.target in TARGET_SPECS:
+            raise ValueError("unsupported target: " + effect.target)
+        param = effect.parameters or {}
+        if "amount" in param:
+            relative, amount = 0.0, param["amount"]
+        else:
+            relative, amount = param["relative"], -1
+        k = len(self._effects)
+        self._effects.append((MECHANICS.index(effect.mechanic),
+                              TARGET_NAMES.index(effect.target),
+                              amount, relative,
+                              self._type_id(param.get("type"))))
+        self._effect_ids[key] = k
+        return k
+
+    def _build_tables(self):
+        specs = [TARGET_SPECS[name] for name in TARGET_NAMES]
+        self._spec_side = np.array([s[0] for s in specs])
+        self._spec_rel  = np.array([s[1] for s in specs])
+        self._spec_incl = np.array([s[3] for s in specs])
+        self._spec_npos = np.array([len(s[2]) for s in specs])
+        self._spec_pos  = np.zeros((len(specs), CAPACITY), dtype = np.int64)
+        for i, s in enumerate(specs):
+            self._spec_pos[i, :len(s[2])] = s[2]
+        cbs = self._callbacks or [(-1, 0, 0)]
+        self._cb_event  = np.array([c[0] for c in cbs])
+        self._cb_source = np.array([c[1] for c in cbs])
+        self._cb_effect = np.array([c[2] for c in cbs])
+        effects = self._effects or [(0, 0, 0, 0.0, -1)]
+        self._fx_mech   = np.array([e[0] for e in effects])
+        self._fx_target = np.array([e[1] for e in effects])
+        self._fx_amount = np.array([e[2] for e in effects], dtype = np.int64)
+        self._fx_rel    = np.array([e[3] for e in effects], dtype = np.float64)
+        self._fx_type   = np.array([e[4] for e in effects])
+        # chart[defender, attacker]; the last column is the untyped attack
+        if self._chart is None:
+            self.chart = np.zeros((1, 1), dtype = np.int64)
+        else:
+            self.chart = np.array(self._chart.kinds, dtype = np.int64)
+
+    # -- mechanics ------------------------------------------------------------
+
+    def _apply_actions(self, actions, sel):
+        for t in xrange(2):
+            size = self.size[:, t]
+            shift = np.zeros(self.n, dtype = np.int64)
+            shift[actions[:, t] == ROTATE_COUNTER] = 1
+            shift[actions[:, t] == ROTATE_CLOCK] = -1
+            rows = self._rows[sel & (size > 1) & (shift != 0)]
+            if not len(rows):
+                continue
+            j = np.arange(CAPACITY)
+            idx = (j[None, :] + shift[rows, None]) % size[rows, None]
+            live = j[None, :] < size[rows, None]
+            rotated = self.slots[rows[:, None], t, idx]
+            self.slots[rows, t] = np.where(live, rotated, -1)
+            for k in xrange(CAPACITY):
+                m = k < size[rows]
+                self.index[rows[m], t, self.slots[rows[m], t, k]] = k
+
+    def _calculate_turn(self, sel):
+        s0 = self._stat(self.speed, 0, self.slots[:, 0, 0])
+        s1 = self._stat(self.speed, 1, self.slots[:, 1, 0])
+        if self.tie_break is None:
+            coin = self.rng.randint(0, 2, self.n).astype(bool)
+        else:
+            coin = np.full(self.n, self.tie_break == 1, dtype = bool)
+        turn = np.where((s1 > s0) | ((s1 == s0) & coin), 1, 0)
+        self.turn = np.where(sel, turn, self.turn)
+
+    def _attack(self, sel):
+        rows = self._rows
+        turn = self.turn
+        zero = np.zeros(self.n, dtype = np.int64)
+        attacker = np.maximum(self.slots[rows, turn, 0], 0)
+        defender = np.maximum(self.slots[rows, 1 - turn, 0], 0)
+        damage = self._stat(self.power, turn, attacker)
+        attack_type = self.type[rows, turn, attacker]
+        self._fire("attack", sel, turn, zero)
+        self._fire("defend", sel, 1 - turn, zero)
+        damage = self._damage(sel, 1 - turn, defender, damage, attack_type)
+        self._fire("post_attack", sel & (damage > 0), turn, zero,
+                   damage = damage)
+
+    def _cleanup(self, sel):
+        # Mirrors BattleTeam.cleanup: dead units keep their slots (but lose
+        # their abilities) until the pass ends, then each team is compacted.
+        rows = self._rows
+        for t in xrange(2):
+            team = np.full(self.n, t, dtype = np.int64)
+            for pos in xrange(CAPACITY):
+                uid = np.maximum(self.slots[:, t, pos], 0)
+                dying = (sel & (pos < self.size[:, t])
+                         & ~self.dead[rows, t, uid]
+                         & (self.health[rows, t, uid] <= 0))
+                if not dying.any():
+                    continue
+                self.dead[rows[dying], t, uid[dying]] = True
+                self.health[rows[dying], t, uid[dying]] = 0
+                self._fire("death", dying, team,
+                           np.full(self.n, pos, dtype = np.int64))
+                self.removed[rows[dying], t, uid[dying]] = True
+            slots = self.slots[:, t, :]
+            keep = (slots >= 0) & ~self.dead[rows[:, None], t,
+                                             np.maximum(slots, 0)]
+            changed = sel & (keep.sum(axis = 1) != self.size[:, t])
+            if not changed.any():
+                continue
+            order = np.argsort(~keep, axis = 1, kind = "mergesort")
+            packed = slots[rows[:, None], order]
+            count = keep.sum(axis = 1)
+            packed[np.arange(CAPACITY)[None, :] >= count[:, None]] = -1
+            self.slots[changed, t, :] = packed[changed]
+            self.size[changed, t] = count[changed]
+            for k in xrange(CAPACITY):
+                m = changed & (k < count)
+                self.index[rows[m], t, packed[m, k]] = k
+
+    def _check_over(self, sel):
+        over = sel & ((self.size > 0).sum(axis = 1) < 2)
+        self.over |= over
+        return sel & ~over
+
+    # -- events ---------------------------------------------------------------
+
+    def _fire(self, event, sel, team, pos, **args):
+        """Run, in subscription order, the callbacks for `event` emitted by
+        the unit at slot `pos` of `team` in each selected battle."""
+        if not sel.any():
+            return
+        event = EVENT_NAMES.index(event)
+        rows = self._rows
+        for lt in xrange(2):
+            for lu in xrange(CAPACITY):
+                listening = (sel & ~self.removed[:, lt, lu]
+                             & (self.slots[:, lt, :] == lu).any(axis = 1))
+                for c in xrange(self.callbacks.shape[3]):
+                    cb = self.callbacks[:, lt, lu, c]
+                    safe = np.maximum(cb, 0)
+                    fire = listening & (cb >= 0) & (self._cb_event[safe] == event)
+                    if not fire.any():
+                        continue
+                    sources = self._resolve(self._cb_source[safe], lt, lu, fire)
+                    fire &= sources[rows, team, pos]
+                    if fire.any():
+                        self._apply(self._cb_effect[safe], lt, lu, fire, args)
+
+    def _apply(self, k, lt, lu, sel, args):
+        amount = self._fx_amount[k]
+        relative = self._fx_rel[k]
+        if "damage" in args:
+            scaled = (relative * args["damage"]).astype(np.int64)
+            amount = np.where(amount < 0, scaled, amount)
+        targets = self._resolve(self._fx_target[k], lt, lu, sel)
+        heal = self._fx_mech[k] == MECHANICS.index("heal")
+        for t in xrange(2):
+            team = np.full(self.n, t, dtype = np.int64)
+            for j in xrange(CAPACITY):
+                m = targets[:, t, j]
+                if not m.any():
+                    continue
+                uid = np.maximum(self.slots[:, t, j], 0)
+                self._damage(m & ~heal, team, uid, amount, self._fx_type[k])
+                self._heal(m & heal, team, uid, amount)
+
+    def _damage(self, sel, team, uid, amount, attack_type):
+        rows = self._rows
+        live = sel & ~self.dead[rows, team, uid]
+        kind = self.chart[np.maximum(self.type[rows, team, uid], 0),
+                          np.where(attack_type < 0, self.chart.shape[1] - 1,
+                                   attack_type)]
+        amount = np.where(kind == MULTIPLIER_PLUS, amount + amount // 2,
+                 np.where(kind == MULTIPLIER_MINUS, amount - amount // 3,
+                          amount))
+        health = self.health[rows, team, uid]
+        self.health[rows[live], team[live], uid[live]] = \
+            np.maximum(0, health - amount)[live]
+        return np.where(live, amount, 0)
+
+    def _heal(self, sel, team, uid, amount):
+        rows = self._rows
+        live = sel & ~self.dead[rows, team, uid]
+        health = np.minimum(self.max_health[rows, team, uid],
+                            self.health[rows, team, uid] + amount)
+        self.health[rows[live], team[live], uid[live]] = health[live]
+
+    def _resolve(self, spec, lt, lu, sel):
+        """Slot mask (N, 2, CAPACITY) of the units that the target `spec`
+        of unit `lu` in team `lt` resolves to, for each selected battle."""
+        rows = self._rows
+        mask = np.zeros((self.n, 2, CAPACITY), dtype = bool)
+        side = self._spec_side[spec]
+        relative = self._spec_rel[spec]
+        base = np.where(relative, self.index[:, lt, lu], 0)
+        for t in xrange(2):
+            if t == lt:
+                applies = sel & (side != OPPONENT)
+            else:
+                applies = sel & (side != FRIEND)
+            size = self.size[:, t]
+            safe = np.maximum(size, 1)
+            for k in xrange(CAPACITY):
+                pos = self._spec_pos[spec, k]
+                valid = applies & (k < self._spec_npos[spec]) & (size > 0)
+                valid &= relative | ((pos < size) & (pos > -size))
+                slot = (base + pos) % safe
+                mask[rows[valid], t, slot[valid]] = True
+            if t == lt:
+                me = (self.slots[:, t, :] == lu) & ~self._spec_incl[spec][:, None]
+                mask[:, t, :] &= ~me
+        return mask
+
+    def _stat(self, stat, team, uid):
+        return np.maximum(1, stat[self._rows, team, np.maximum(uid, 0)])
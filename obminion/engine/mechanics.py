@@ -18,24 +18,40 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 
-from random import randint
+from collections import namedtuple, OrderedDict
+from hashlib import sha1
+from operator import attrgetter
+import random
+from random import Random
+from weakref import WeakKeyDictionary
 
-from .events import Event
-from .models import BattleUnit, BattleTeam
+from .events import Event, QueuedEvent, EventQueue
+from .models import _new, BattleUnit, BattleTeam, StatModifier, STATS, ADD, \
+                    MULTIPLY, CLAMP
 
 ###############################################################################
 #   Battle Mechanics
 ###############################################################################
 
+_rng = Random(0x7e)
+TURN_KEYS = tuple(_rng.getrandbits(62) for _ in xrange(8))
+del _rng
+
 class BattleMechanics(object):
-    def __init__(self):
+    def __init__(self, deferred = False, max_cascade = 16, rng = None):
         self.teams = []
         self.turn = 0
         self.round = 1
-        self.abilities = []
-        self.events = MechanicsEventChannel()
-        self.unit_events = UnitEventChannel()
-        self.team_events = TeamEventChannel()
+        self.abilities = OrderedDict()  # unit -> [EffectHandler], bind order
+        self.routers = {}       # (channel, event) -> EventRouter
+        self.tie_break = None   # fixes the speed tie coin flip when set
+        # random.Random for coin flips; the module stream if not given
+        self.rng = rng if not rng is None else random
+        # In deferred mode, events are queued and dispatched by flush().
+        self.queue = EventQueue(max_cascade) if deferred else None
+        self.events = MechanicsEventChannel(self.queue)
+        self.unit_events = UnitEventChannel(self.queue)
+        self.team_events = TeamEventChannel(self.queue)
         self.team_events.remove.sub(self._on_unit_remove)
 
     @property
@@ -70,6 +86,19 @@ class BattleMechanics(object):
         team.index = len(self.teams)
         self.teams.append(team)
 
+    def enable_hashing(self):
+        """Maintain Zobrist hashes of the formations from now on."""
+        for team in self.teams:
+            team.enable_hashing()
+
+    def zobrist_hash(self):
+        """Hash of the slot order, health, stats and turn. Requires
+        enable_hashing()."""
+        h = TURN_KEYS[self.turn]
+        for team in self.teams:
+            h ^= team.hash
+        return h
+
     def flip_turn(self):
         self.turn = self.next
 
@@ -81,7 +110,8 @@ class BattleMechanics(object):
             if s > ms:
                 ms = s
                 self.turn = i
-            elif s == ms and randint(0, 1):
+            elif s == ms and (self.rng.getrandbits(1)
+                              if self.tie_break is None else self.tie_break):
                 self.turn = i
 
     def attack(self):
@@ -89,32 +119,162 @@ class BattleMechanics(object):
         damage  = unit.power.value
         type    = unit.type
         target  = self.defender
-        self.unit_events.attack(unit, target = target)
-        self.unit_events.defend(target, target = unit)
+        # deferred abilities resolve before the damage, as they do when
+        # they are dispatched synchronously
+        self.unit_events.attack(unit, target)
+        self.flush()
+        self.unit_events.defend(target, unit)
+        self.flush()
         damage = target.damage(damage, type)
         if damage > 0:
-            self.unit_events.post_attack(unit, target = target, damage = damage)
+            self.unit_events.post_attack(unit, target, damage)
         # self.events.attack(self, unit = unit, target = target, damage = damage)
+        self.flush()
 
     def cleanup(self):
         for team in self.teams:
             team.cleanup()
+        if not self.queue is None:
+            # death abilities may kill more units
+            while self.queue.pending:
+                self.flush()
+                for team in self.teams:
+                    team.cleanup()
+        for router in self.routers.itervalues():
+            router.compact()
 
     def tick(self):
-        pass
+        for team in self.teams:
+            for unit in team.units:
+                if unit.max_health.timed or unit.power.timed \
+                        or unit.speed.timed:
+                    unit.tick()
 
     def next_round(self):
         self.round += 1
         self.events.round(self)
+        self.flush()
+
+    def flush(self):
+        if not self.queue is None and self.queue.pending:
+            records = self.queue.drain()
+            self.events.batch(self, records)
+
+    def clone(self):
+        """Copy of the combat state. Nothing that subscribed to this
+        battle's events is carried over. The ability handlers and the
+        routers' indexes are copied rather than bound anew."""
+        # the copy continues this battle's random stream on its own
+        rng = _new_random(Random)
+        rng.setstate(self.rng.getstate())
+        other = _new(BattleMechanics)
+        other.turn = self.turn
+        other.round = self.round
+        other.tie_break = None
+        other.rng = rng
+        other.queue = queue = None if self.queue is None \
+                              else EventQueue(self.queue.max_depth)
+        other.events = MechanicsEventChannel(queue)
+        other.unit_events = UnitEventChannel(queue)
+        other.team_events = TeamEventChannel(queue)
+        other.team_events.remove.sub(other._on_unit_remove)
+        # the original of every emitter, target and callback -> its copy
+        memo = {self: other}
+        other.teams = teams = []
+        for team in self.teams:
+            memo[team] = copy = team.copy(other.team_events,
+                                          other.unit_events, memo)
+            teams.append(copy)
+        # routers subscribe in creation order, before their callbacks
+        other.routers = {}
+        for key, router in self.routers.iteritems():
+            memo[router] = other.router(*key)
+        other.abilities = abilities = OrderedDict()
+        for unit, handlers in self.abilities.iteritems():
+            abilities[memo[unit]] = [handler.copy(other, memo)
+                                     for handler in handlers]
+        for router in self.routers.itervalues():
+            memo[router].copy_index(router, memo)
+        return other
+
+    def snapshot(self):
+        """Compact record of the mutable combat state, for restore()."""
+        teams = []
+        units = []
+        for team in self.teams:
+            teams.append((tuple(team.units), len(team.grave), team.hash))
+            for unit in team.units:
+                max_health, power, speed = \
+                    unit.max_health, unit.power, unit.speed
+                units.append((unit, unit.health, unit.dead,
+                              max_health.bonus, max_health.modifiers,
+                              power.bonus, power.modifiers,
+                              speed.bonus, speed.modifiers))
+        return (self.turn, self.round, tuple(teams), tuple(units),
+                tuple(self.abilities.items()))
+
+    def restore(self, snapshot):
+        """Roll the battle back to a snapshot() taken earlier in it.
+        Abilities of units revived by the rollback are bound again."""
+        turn, round, teams, units, abilities = snapshot
+        self.turn = turn
+        self.round = round
+        for team, (formation, graves, hash) in zip(self.teams, teams):
+            team.units[:] = formation
+            del team.grave[graves:]
+            team._reindex()
+            team.version += 1
+            team.hash = hash
+        for unit, health, dead, mb, mm, pb, pm, sb, sm in units:
+            unit.health = health
+            unit.dead = dead
+            # the modifier stacks are immutable, so identity means unchanged
+            a = unit.max_health
+            if a.bonus != mb or not a.modifiers is mm:
+                a.set(mb, mm)
+            a = unit.power
+            if a.bonus != pb or not a.modifiers is pm:
+                a.set(pb, pm)
+            a = unit.speed
+            if a.bonus != sb or not a.modifiers is sm:
+                a.set(sb, sm)
+        current = self.abilities
+        if len(current) != len(abilities) \
+                or not all([unit in current for unit, _ in abilities]):
+            bound = OrderedDict(abilities)
+            for unit, handlers in current.iteritems():
+                if not unit in bound:
+                    for handler in handlers:
+                        handler.remove()
+            for unit, handlers in abilities:
+                if not unit in current:
+                    for handler in handlers:
+                        handler.restore()
+            self.abilities = bound
+        if not self.queue is None:
+            self.queue.records.clear()
 
     def create_handlers(self):
         for team in self.teams:
             for unit in team.units:
-                if unit.ability:
-                    for effect in unit.ability.effects:
-                        h = EffectHandler(self, unit, effect)
-                        h.bind()
-                        self.abilities.append(h)
+                if unit.ability and unit.ability.effects:
+                    self._bind(unit)
+
+    def _bind(self, unit):
+        handlers = []
+        for plan in compile_ability(unit.ability):
+            h = EffectHandler(self, unit, plan)
+            h.bind()
+            handlers.append(h)
+        self.abilities[unit] = handlers
+
+    def router(self, channel, event):
+        """The router of an event topic, e.g. ("unit_events", "damage")."""
+        router = self.routers.get((channel, event))
+        if router is None:
+            router = EventRouter(getattr(getattr(self, channel), event))
+            self.routers[(channel, event)] = router
+        return router
 
     def target(self, unit, target):
         return getattr(self, "_target_" + target)(unit)
@@ -136,8 +296,8 @@ class BattleMechanics(object):
     def _target_self_adjacent(self, unit):
         return RelativeTarget(unit.team, unit, (1, -1))
 
-    # def _target_friend_team(self, unit):
-        # return unit.team
+    def _target_friend_team(self, unit):
+        return SingleTarget(unit.team)
 
     def _target_friend_active(self, unit):
         return FixTarget(unit.team, unit, (0,), inclusive = True)
@@ -168,8 +328,8 @@ class BattleMechanics(object):
     def _target_opponent(self, unit):
         return FixTarget(self._opposing(unit), unit, (0,))
 
-    # def _target_opponent_team(self, unit):
-        # return self._opposing(unit)
+    def _target_opponent_team(self, unit):
+        return SingleTarget(self._opposing(unit))
 
     def _target_opponent_all(self, unit):
         team = self._opposing(unit)
@@ -194,18 +354,137 @@ class BattleMechanics(object):
     def _opposing(self, unit):
         return self.teams[(unit.team.index + 1) % len(self.teams)]
 
-    def _on_unit_remove(self, team, **args):
-        i = 0
-        unit = args["unit"]
-        while i < len(self.abilities):
-            effect = self.abilities[i]
-            if effect.unit is unit:
-                del self.abilities[i]
-                effect.remove()
-                print "removed ability effect"
-            else:
-                i += 1
+    def _on_unit_remove(self, team, unit):
+        for effect in self.abilities.pop(unit, ()):
+            effect.remove()
+            print "removed ability effect"
+
+
+
+###############################################################################
+#   Compiled Abilities
+###############################################################################
 
+# An EffectPlan is the battle-independent part of an AbilityEffect: parsed
+# triggers, the mechanic function and the target factory. Plans are built
+# once per effect and shared by every unit and battle that uses it.
+
+EffectPlan = namedtuple("EffectPlan", ("effect", "ability", "mechanic",
+                        "target", "triggers", "amount", "relative",
+                        "reference", "type", "stat", "modifier"))
+
+_plans = WeakKeyDictionary()
+
+def compile_effect(effect):
+    plan = _plans.get(effect)
+    if plan is None:
+        mechanic = MECHANICS.get(effect.mechanic)
+        if mechanic is None:
+            raise ValueError("unknown mechanic: " + effect.mechanic)
+        param = effect.parameters or {}
+        triggers = tuple(parse_trigger(trigger, param.get("reference"))
+                         for trigger in effect.events)
+        modifier = None
+        if effect.mechanic == "modify":
+            modifier = _stat_modifier(effect, param)
+        elif not "amount" in param and effect.mechanic != "log":
+            assert "relative" in param and "reference" in param
+        plan = EffectPlan(effect, effect.ability, mechanic,
+                          _target_factory(effect.target), triggers,
+                          param.get("amount"), param.get("relative"),
+                          param.get("reference"), param.get("type"),
+                          param.get("stat"), modifier)
+        _plans[effect] = plan
+    return plan
+
+def parse_trigger(trigger, reference = None):
+    """Split a trigger such as "self damage" into (channel, source factory,
+    event, position of `reference` among the event's arguments). Raises
+    ValueError for unknown sources and events, and for references that
+    the event does not provide."""
+    words = trigger.split()
+    if len(words) != 2:
+        raise ValueError("malformed trigger: " + trigger)
+    source, event = words
+    event = event.split(":")[-1]
+    if source == "mechanics":
+        channel, factory = "events", None
+    elif "team" in source:
+        channel, factory = "team_events", _target_factory(source)
+    else:
+        channel, factory = "unit_events", _target_factory(source)
+    args = CHANNELS[channel].ARGS.get(event)
+    if args is None:
+        raise ValueError("unknown {} event: {}".format(source, event))
+    if reference is None:
+        return channel, factory, event, None
+    if not reference in args:
+        raise ValueError("event {} does not provide {}".format(event, reference))
+    return channel, factory, event, args.index(reference)
+
+_ability_plans = WeakKeyDictionary()
+
+def compile_ability(ability):
+    plans = _ability_plans.get(ability)
+    if plans is None:
+        plans = tuple(compile_effect(effect) for effect in ability.effects)
+        _ability_plans[ability] = plans
+    return plans
+
+def _stat_modifier(effect, param):
+    # parameters: "stat", one of "add", "multiply" or "clamp", "duration"
+    if not param.get("stat") in STATS:
+        raise ValueError("unknown stat: " + str(param.get("stat")))
+    for key, kind in (("add", ADD), ("multiply", MULTIPLY), ("clamp", CLAMP)):
+        if key in param:
+            return StatModifier(kind, param[key], effect.ability,
+                                param.get("duration"))
+    raise ValueError("modify needs an add, multiply or clamp parameter")
+
+def _target_factory(name):
+    factory = getattr(BattleMechanics, "_target_" + name, None)
+    if factory is None:
+        raise ValueError("unknown target: " + name)
+    return factory
+
+
+# A mechanic is called with the handler, the emitter, the other event
+# arguments and the position of the plan's reference among them.
+
+def _plan_amount(plan, args, reference):
+    if plan.amount is None:
+        return int(plan.relative * args[reference])
+    return plan.amount
+
+def mechanic_log(handler, emitter, args, reference):
+    print handler.plan.ability.name, "triggered with", args
+    return True
+
+def mechanic_damage(handler, emitter, args, reference):
+    plan = handler.plan
+    amount = _plan_amount(plan, args, reference)
+    for target in handler.targets.get():
+        target.damage(amount, type = plan.type, source = handler)
+    return True
+
+def mechanic_heal(handler, emitter, args, reference):
+    amount = _plan_amount(handler.plan, args, reference)
+    for target in handler.targets.get():
+        target.heal(amount)
+    return True
+
+def mechanic_modify(handler, emitter, args, reference):
+    plan = handler.plan
+    for target in handler.targets.get():
+        target.add_modifier(plan.stat, plan.modifier)
+    return True
+
+MECHANICS = {
+    "log":      mechanic_log,
+    "damage":   mechanic_damage,
+    "heal":     mechanic_heal,
+    "modify":   mechanic_modify
+}
 
 
 ###############################################################################
@@ -213,85 +492,197 @@ class BattleMechanics(object):
 ###############################################################################
 
 class EffectHandler(object):
-    def __init__(self, mechanics, unit, template):
+    """Binds an EffectPlan to a unit in one battle."""
+    def __init__(self, mechanics, unit, plan):
         self.mechanics  = mechanics
         self.unit       = unit
-        self.template   = template
-        self.targets    = mechanics.target(unit, template.target)
-        self.mechanic   = getattr(self, "_mechanic_" + template.mechanic)
+        self.plan       = plan
+        self.template   = plan.effect
+        self.targets    = plan.target(mechanics, unit)
         self.callbacks  = []
 
     def bind(self):
-        for event in self.template.events:
-            event = event.split()
-            source = event[0]
-            event = event[1]
-            if source == "mechanics":
-                cb = EffectCallback(self.template.ability, self.unit,
-                                    self.mechanics.events, event,
-                                    (self.mechanics,), self.mechanic)
-            elif "team" in source:
-                cb = EffectCallback(self.template.ability, self.unit,
-                                    self.mechanics.team_events, event,
-                                    self.mechanics.target(self.unit, source),
-                                    self.mechanic)
+        mechanics = self.mechanics
+        for channel, factory, event, reference in self.plan.triggers:
+            if factory is None:
+                sources = SingleTarget(mechanics)
             else:
-                cb = EffectCallback(self.template.ability, self.unit,
-                                    self.mechanics.unit_events, event,
-                                    self.mechanics.target(self.unit, source),
-                                    self.mechanic)
+                sources = factory(mechanics, self.unit)
+            cb = EffectCallback(self, mechanics.router(channel, event),
+                                sources, reference)
             self.callbacks.append(cb)
 
+    def copy(self, mechanics, memo):
+        """Copy bound to a clone of the battle. The routers of `mechanics`
+        must already be in `memo`; the callbacks are added to it."""
+        handler = _new(EffectHandler)
+        handler.mechanics   = mechanics
+        handler.unit        = memo[self.unit]
+        handler.plan        = self.plan
+        handler.template    = self.template
+        handler.targets     = self.targets.copy(memo)
+        handler.callbacks   = [callback.copy(handler, memo)
+                               for callback in self.callbacks]
+        return handler
+
     def remove(self):
-        while self.callbacks:
-            callback = self.callbacks.pop()
+        for callback in self.callbacks:
             callback.remove()
 
-    def _mechanic_log(self, emitter, **args):
-        print self.template.ability.name, "triggered with", args
-        return True
-
-    def _mechanic_damage(self, emitter, **args):
-        param = self.template.parameters
-        type = param.get("type")
-        if "amount" in param:
-            amount = param["amount"]
-        else:
-            assert "relative" in param and "reference" in param
-            amount = int(param["relative"] * args[param["reference"]])
-        for target in self.targets.get():
-            target.damage(amount, type = type, source = self)
-        return True
-
-    def _mechanic_heal(self, emitter, **args):
-        param = self.template.parameters
-        if "amount" in param:
-            amount = param["amount"]
-        else:
-            assert "relative" in param and "reference" in param
-            amount = int(param["relative"] * args[param["reference"]])
-        for target in self.targets.get():
-            target.heal(amount)
-        return True
+    def restore(self):
+        # undo remove(), keeping each callback's place in dispatch order
+        for callback in self.callbacks:
+            callback.router.sub(callback, callback.order)
 
 
 class EffectCallback(object):
-    def __init__(self, ability, unit, channel, event, sources, function):
-        self.ability = ability
-        self.unit = unit
-        self.channel = channel
-        self.topic = getattr(channel, event.split(":")[-1])
+    def __init__(self, handler, router, sources, reference = None):
+        self.handler = handler
+        self.ability = handler.plan.ability
+        self.unit = handler.unit
+        self.router = router
         self.sources = sources
-        self.function = function
-        self.topic.sub(self.callback)
-
-    def callback(self, emitter, **args):
-        if emitter in self.sources:
-            if self.function(emitter, **args):
-                self.channel.ability(self.ability, unit = self.unit)
+        self.reference = reference
+        self.function = handler.plan.mechanic
+        self.router.sub(self)
+
+    def callback(self, emitter, *args):
+        if self.function(self.handler, emitter, args, self.reference):
+            self.unit.on.ability(self.ability, self.unit)
+
+    def copy(self, handler, memo):
+        callback = _new(EffectCallback)
+        callback.handler    = handler
+        callback.ability    = self.ability
+        callback.unit       = handler.unit
+        callback.router     = memo[self.router]
+        callback.sources    = self.sources.copy(memo)
+        callback.reference  = self.reference
+        callback.function   = self.function
+        callback.order      = self.order
+        if self.sources.static:
+            callback.emitters = [memo[emitter] for emitter in self.emitters]
+        memo[self] = callback
+        return callback
 
     def remove(self):
-        self.topic.unsub(self.callback)
+        self.router.unsub(self)
+
+
+class EventRouter(object):
+    """Dispatches one event topic to the effect callbacks whose sources
+    contain the emitter, in subscription order. Callbacks on static sources
+    (the unit itself, a team, the mechanics) are indexed by emitter once;
+    the others are indexed per team and re-indexed when that team's
+    formation changes (see BattleTeam.version), or when a callback on
+    its units is added or removed."""
+
+    def __init__(self, topic):
+        self.static = {}    # emitter -> [callbacks]
+        self.dynamic = []   # including the removed ones, until compact()
+        self.removed = set()
+        self.routes = {}    # team -> (version, {emitter: [callbacks]})
+        self.order = 0
+        topic.sub(self)
+
+    def sub(self, callback, order = None):
+        """Subscribe a callback; an `order` from an earlier subscription
+        puts it back in its original place."""
+        if order is None:
+            order = self.order
+            self.order += 1
+        callback.order = order
+        if callback.sources.static:
+            callback.emitters = callback.sources.get()
+            for emitter in callback.emitters:
+                _insort(self.static.setdefault(emitter, []), callback)
+        elif callback in self.removed:
+            # not compacted yet, so still in its place
+            self.removed.discard(callback)
+            self._invalidate(callback)
+        else:
+            _insort(self.dynamic, callback)
+            self._invalidate(callback)
+
+    def unsub(self, callback):
+        if callback.sources.static:
+            for emitter in callback.emitters:
+                self.static[emitter].remove(callback)
+        else:
+            self.removed.add(callback)
+            self._invalidate(callback)
+
+    def compact(self):
+        """Drop the callbacks removed since the last call from `dynamic`."""
+        if self.removed:
+            removed = self.removed
+            self.dynamic = [cb for cb in self.dynamic if not cb in removed]
+            removed.clear()
+
+    def _invalidate(self, callback):
+        # only the routes of the teams that the callback listens to change
+        sources = callback.sources
+        for target in getattr(sources, "targets", (sources,)):
+            self.routes.pop(target.team, None)
+
+    def __call__(self, emitter, *args):
+        team = getattr(emitter, "team", None)
+        version = 0 if team is None else team.version
+        callbacks = self.static.get(emitter)
+        if self.dynamic and not team is None:
+            entry = self.routes.get(team)
+            if entry is None or entry[0] != version:
+                entry = self._rebuild(team, version)
+            routed = entry[1].get(emitter)
+            if routed:
+                if callbacks:
+                    callbacks = sorted(callbacks + routed, key = _by_order)
+                else:
+                    callbacks = routed
+        if callbacks:
+            for callback in callbacks:
+                # a callback may have moved units around; double check
+                if not team is None and team.version != version:
+                    if not emitter in callback.sources:
+                        continue
+                callback.callback(emitter, *args)
+
+    def copy_index(self, router, memo):
+        """Take over the indexes of `router`, of the battle this one is a
+        clone of. `memo` maps its emitters and callbacks to their copies."""
+        self.order = router.order
+        static = self.static
+        for emitter, callbacks in router.static.iteritems():
+            if callbacks:
+                static[memo[emitter]] = [memo[cb] for cb in callbacks]
+        removed = router.removed
+        self.dynamic = [memo[cb] for cb in router.dynamic
+                        if not cb in removed]
+
+    def _rebuild(self, team, version):
+        routes = {}
+        removed = self.removed
+        for callback in self.dynamic:
+            if callback in removed:
+                continue
+            sources = callback.sources
+            for target in getattr(sources, "targets", (sources,)):
+                if target.team is team:
+                    for emitter in target.get():
+                        callbacks = routes.setdefault(emitter, [])
+                        if not callbacks or not callbacks[-1] is callback:
+                            callbacks.append(callback)
+        entry = (version, routes)
+        self.routes[team] = entry
+        return entry
+
+_by_order = attrgetter("order")
+
+def _insort(callbacks, callback):
+    i = len(callbacks)
+    while i > 0 and callbacks[i - 1].order > callback.order:
+        i -= 1
+    callbacks.insert(i, callback)
 
 
 
@@ -299,32 +690,72 @@ class EffectCallback(object):
 #   Event Channels
 ###############################################################################
 
+# Events are emitted positionally: the emitter, then the arguments that
+# ARGS lists for the topic, always all of them and in that order.
+
+def _topic(queue, channel, name):
+    if queue is None:
+        return Event()
+    return QueuedEvent(queue, name, channel.ARGS[name])
+
 class UnitEventChannel(object):
-    def __init__(self):
-        self.spawn      = Event()
-        self.death      = Event()
-        self.damage     = Event()
-        self.heal       = Event()
-        self.attack     = Event()
-        self.defend     = Event()
-        self.rotate_in  = Event()
-        self.rotate_out = Event()
-        self.ability    = Event()
-        self.post_attack = Event()  # successful attack
+    ARGS = {
+        "spawn":        (),
+        "death":        (),
+        "damage":       ("amount", "type", "source"),
+        "heal":         ("amount", "source"),
+        "attack":       ("target",),
+        "defend":       ("target",),
+        "rotate_in":    (),
+        "rotate_out":   (),
+        "ability":      ("unit",),  # emitted by the ability
+        "post_attack":  ("target", "damage")
+    }
+
+    def __init__(self, queue = None):
+        self.spawn      = _topic(queue, self, "spawn")
+        self.death      = _topic(queue, self, "death")
+        self.damage     = _topic(queue, self, "damage")
+        self.heal       = _topic(queue, self, "heal")
+        self.attack     = _topic(queue, self, "attack")
+        self.defend     = _topic(queue, self, "defend")
+        self.rotate_in  = _topic(queue, self, "rotate_in")
+        self.rotate_out = _topic(queue, self, "rotate_out")
+        self.ability    = _topic(queue, self, "ability")
+        self.post_attack = _topic(queue, self, "post_attack")  # successful attack
 
 class TeamEventChannel(object):
-    def __init__(self):
-        self.add            = Event()
-        self.remove         = Event()
-        self.rotate         = Event()
-        self.rotate_left    = Event()
-        self.rotate_right   = Event()
+    ARGS = {
+        "add":          ("unit",),
+        "remove":       ("unit",),
+        "rotate":       ("active", "previous"),
+        "rotate_left":  ("active", "previous"),
+        "rotate_right": ("active", "previous")
+    }
+
+    def __init__(self, queue = None):
+        self.add            = _topic(queue, self, "add")
+        self.remove         = _topic(queue, self, "remove")
+        self.rotate         = _topic(queue, self, "rotate")
+        self.rotate_left    = _topic(queue, self, "rotate_left")
+        self.rotate_right   = _topic(queue, self, "rotate_right")
 
 class MechanicsEventChannel(object):
-    def __init__(self):
-        self.round  = Event()
+    ARGS = {
+        "round":        ()
+    }
+
+    def __init__(self, queue = None):
+        self.round  = _topic(queue, self, "round")
+        self.batch  = Event()   # deferred mode: (mechanics, records) drained by flush()
         # self.attack = Event()
 
+CHANNELS = {
+    "events":       MechanicsEventChannel,
+    "team_events":  TeamEventChannel,
+    "unit_events":  UnitEventChannel
+}
+
 class EngineEventChannel(object):
     def __init__(self):
         self.battle_start           = Event()
@@ -333,6 +764,7 @@ class EngineEventChannel(object):
         self.battle_between_rounds  = Event()
         self.battle_end             = Event()
         self.request_input          = Event()
+        self.action                 = Event()
         self.end_phase              = Event()
         self.attack                 = Event()
 
@@ -342,67 +774,161 @@ class EngineEventChannel(object):
 #   Target System
 ###############################################################################
 
-class RelativeTarget(object):
-    def __init__(self, team, unit, offsets, inclusive = False):
+def _slots(positions):
+    slots = []
+    mask = 0
+    for i in positions:
+        if not mask & (1 << i):
+            slots.append(i)
+            mask |= 1 << i
+    return tuple(slots), mask
+
+_ring_tables = {}
+_fix_tables = {}
+
+def ring_table(capacity, offsets):
+    """table[size][index] -> (slots, bitmask) of the units at `offsets` from
+    slot `index`, in a formation of `size` units. Shared by all targets."""
+    key = (capacity, tuple(offsets))
+    table = _ring_tables.get(key)
+    if table is None:
+        table = tuple(tuple(_slots([(i + o) % n for o in offsets])
+                            for i in xrange(n))
+                      for n in xrange(capacity + 1))
+        _ring_tables[key] = table
+    return table
+
+def fix_table(capacity, indices):
+    """table[size] -> (slots, bitmask) of the units at `indices`."""
+    key = (capacity, tuple(indices))
+    table = _fix_tables.get(key)
+    if table is None:
+        table = tuple(_slots([i % n for i in indices if -n < i < n])
+                      for n in xrange(capacity + 1))
+        _fix_tables[key] = table
+    return table
+
+
+class TeamTarget(object):
+    """A set of units resolved against a team's formation, as a list and
+    as a slot bitmask. Both are cached until the team's formation version
+    changes; membership is then a single AND with the unit's slot bit."""
+
+    def __init__(self, team, unit, inclusive = False):
         self.team = team
         self.unit = unit
-        self.offsets = offsets
         self.inclusive = inclusive
+        self.static = False
+        self._version = -1
+        self._units = []
+        self._mask = 0
 
     def get(self):
-        units = []
-        for offset in self.offsets:
-            u = self.team.units[(self.unit.index + offset) % self.team.size]
-            if self.inclusive or not u is self.unit:
-                if not u in units:
-                    units.append(u)
-        return units
+        if self._version != self.team.version:
+            self._refresh()
+        return self._units
 
     def __contains__(self, unit):
-        for offset in self.offsets:
-            u = self.team.units[(self.unit.index + offset) % self.team.size]
-            if self.inclusive or not u is self.unit:
-                if u is unit:
-                    return True
-        return False
+        if self._version != self.team.version:
+            self._refresh()
+        return getattr(unit, "team", None) is self.team \
+            and (unit.bit & self._mask) != 0
+
+    def _refresh(self):
+        units = self.team.units
+        slots, mask = self.lookup(len(units))
+        if not self.inclusive and self.unit.team is self.team:
+            mask &= ~self.unit.bit
+        # replaced, never mutated; callers may hold on to the old list
+        self._units = [units[i] for i in slots if mask & (1 << i)]
+        self._mask = mask
+        self._version = self.team.version
+
+    def lookup(self, size):
+        return (), 0
+
+    def copy(self, memo):
+        """Copy for a clone of the battle; `memo` maps the teams and units
+        to their copies."""
+        target = _new(type(self))
+        target.__dict__.update(self.__dict__)
+        target.team = memo[self.team]
+        target.unit = memo[self.unit]
+        target._version = -1
+        target._units = []
+        return target
+
+
+class RelativeTarget(TeamTarget):
+    def __init__(self, team, unit, offsets, inclusive = False):
+        TeamTarget.__init__(self, team, unit, inclusive = inclusive)
+        self.offsets = offsets
+        self.table = ring_table(team.capacity, offsets)
+        # offset 0 is always the unit itself, wherever it stands
+        self.static = tuple(offsets) == (0,)
+
+    def lookup(self, size):
+        index = self.unit.index
+        # deferred events may arrive after the unit has left the team
+        if not (index < size and self.team.units[index] is self.unit):
+            return (), 0
+        return self.table[size][index]
 
 
-class FixTarget(object):
+class FixTarget(TeamTarget):
     def __init__(self, team, unit, indices, inclusive = False):
-        self.team = team
-        self.unit = unit
+        TeamTarget.__init__(self, team, unit, inclusive = inclusive)
         self.indices = indices
-        self.inclusive = inclusive
+        self.table = fix_table(team.capacity, indices)
+
+    def lookup(self, size):
+        return self.table[size]
+
+
+class SingleTarget(object):
+    def __init__(self, emitter):
+        self.emitter = emitter
+        self.static = True
 
     def get(self):
-        units = []
-        for index in self.indices:
-            if index < self.team.size and index > -self.team.size:
-                u = self.team.units[index]
-                if self.inclusive or not u is self.unit:
-                    if not u in units:
-                        units.append(u)
-        return units
+        return [self.emitter]
 
-    def __contains__(self, unit):
-        for index in self.indices:
-            if index < self.team.size and index > -self.team.size:
-                u = self.team.units[index]
-                if self.inclusive or not u is self.unit:
-                    if u is unit:
-                        return True
-        return False
+    def __contains__(self, emitter):
+        return emitter is self.emitter
+
+    def copy(self, memo):
+        return SingleTarget(memo[self.emitter])
 
 
 class CompoundTarget(object):
     def __init__(self, targets):
         self.targets = targets
+        self.static = False
+        self._versions = [None] * len(targets)  # of each target's team
+        self._units = []
 
     def get(self):
-        units = set()
+        # checked in place; nothing is allocated while the cache is valid
+        versions = self._versions
+        i = 0
+        for target in self.targets:
+            if target.team.version != versions[i]:
+                return self._refresh()
+            i += 1
+        return self._units
+
+    def _refresh(self):
+        versions = self._versions
+        units = []
+        i = 0
         for target in self.targets:
-            units.update(target.get())
-        return list(units)
+            versions[i] = target.team.version
+            for u in target.get():
+                if not u in units:
+                    units.append(u)
+            i += 1
+        self._units = units
+        return units
 
     def __contains__(self, unit):
         for target in self.targets:
@@ -410,6 +936,24 @@ class CompoundTarget(object):
                 return True
         return False
 
+    def copy(self, memo):
+        return CompoundTarget([target.copy(memo) for target in self.targets])
+
+
+
+###############################################################################
+#   Random Streams
+###############################################################################
+
+_new_random = Random.__new__    # skips seeding from the OS, for copies
+
+def spawn_seed(seed, *path):
+    """Seed of an independent stream (a 60 bit int), derived from a root
+    `seed` and a path of ints or strings, e.g. spawn_seed(seed, worker,
+    battle). As with SeedSequence spawning, the result only depends on
+    the arguments, not on which streams were derived before."""
+    key = "/".join([str(n) for n in (seed,) + path])
+    return int(sha1(key).hexdigest()[:15], 16)
 
 
 ###############################################################################
@@ -417,14 +961,59 @@ class CompoundTarget(object):
 ###############################################################################
 
 class BattleEngine(object):
-    def __init__(self):
+    """Runs battles, one at a time.
+
+    Each battle draws its coin flips from `rng`, seeded with the battle's
+    `seed`. Unless set_battle() is given a seed, it is the next one in a
+    stream seeded with the `seed` given here, so that a seeded engine
+    plays the same sequence of battles.
+    """
+    def __init__(self, deferred = False, max_cascade = 16, seed = None):
         self.mechanics  = None
         self.on         = EngineEventChannel()
         self.state      = None
+        self.deferred   = deferred
+        self.max_cascade = max_cascade
+        self.seed       = None  # seed of the current battle
+        self.rng        = None
+        self._root      = seed
+        self._seeds     = None  # seeded on first use, as it may be slow
         self._handler   = None
 
-    def set_battle(self, unit_listings):
-        self.mechanics = BattleMechanics()
+    def clone(self):
+        """Copy of the battle that can be stepped independently, e.g. to
+        look ahead. The copy has no subscribers."""
+        other = BattleEngine(deferred = self.deferred,
+                             max_cascade = self.max_cascade)
+        other.mechanics = self.mechanics.clone()
+        other.rng = other.mechanics.rng
+        other.seed = self.seed
+        other.state = self.state
+        if self.state:
+            other._handler = getattr(other, "_state_" + self.state)
+        return other
+
+    def snapshot(self):
+        return (self.state, self.mechanics.snapshot())
+
+    def restore(self, snapshot):
+        self.state, mechanics = snapshot
+        self.mechanics.restore(mechanics)
+        self._handler = getattr(self, "_state_" + self.state)
+
+    def set_battle(self, unit_listings, seed = None):
+        if seed is None:
+            if self._seeds is None:
+                self._seeds = Random(self._root)
+            seed = self._seeds.getrandbits(63)
+        self.seed = seed
+        if self.rng is None:
+            self.rng = Random(seed)
+        else:
+            self.rng.seed(seed)
+        self.mechanics = BattleMechanics(deferred = self.deferred,
+                                         max_cascade = self.max_cascade,
+                                         rng = self.rng)
         for unit_listing in unit_listings:
             self.mechanics.make_team(unit_listing)
         self.state = "start"
@@ -433,6 +1022,7 @@ class BattleEngine(object):
     def set_action(self, action, i):
         team = self.mechanics.teams[i]
         if action == "surrender":
+            self.on.action(self, i, action)
             self.state = "end"
             self._handler = self._state_end
             return
@@ -449,6 +1039,8 @@ class BattleEngine(object):
         else:
             print "invalid action"
             return
+        self.on.action(self, i, action)
+        self.mechanics.flush()
         self.state = "attack"
         self._handler = self._state_attack
         self.on.end_phase(self)
@@ -474,8 +1066,7 @@ class BattleEngine(object):
         self.on.battle_attack(self)
         self.mechanics.calculate_turn()
         self.mechanics.attack()
-        self.on.attack(self, unit = self.mechanics.attacker,
-                       target = self.mechanics.defender)
+        self.on.attack(self, self.mechanics.attacker, self.mechanics.defender)
         self.mechanics.cleanup()
         if self.mechanics.battle_over:
             self.on.end_phase(self)
@@ -485,8 +1076,7 @@ class BattleEngine(object):
         # Revenge!
         self.mechanics.flip_turn()
         self.mechanics.attack()
-        self.on.attack(self, unit = self.mechanics.attacker,
-                       target = self.mechanics.defender)
+        self.on.attack(self, self.mechanics.attacker, self.mechanics.defender)
         self.mechanics.cleanup()
         self.on.end_phase(self)
         if self.mechanics.battle_over:
@@ -18,6 +18,14 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 
+from collections import namedtuple
+from random import Random
+
+_new = object.__new__   # instance without __init__, for copies
+
+# Source of Zobrist keys; drawn lazily, per unit, once hashing is enabled.
+_zobrist = Random(0x0b)
+
 ###############################################################################
 #   Species Template
 ###############################################################################
@@ -52,6 +60,9 @@ class UnitTemplate(object):
 ###############################################################################
 
 class UnitInstance(object):
+    __slots__ = ("template", "level", "xp", "health", "power", "speed",
+                 "ability")
+
     def __init__(self, template, level = 1, experience = 0, health = None,
                  power = None, speed = None, ability = None):
         self.template   = template
@@ -78,6 +89,10 @@ class UnitInstance(object):
 ###############################################################################
 
 class BattleUnit(object):
+    __slots__ = ("instance", "template", "type", "max_health", "health",
+                 "power", "speed", "ability", "team", "index", "bit", "on",
+                 "dead", "zkeys")
+
     def __init__(self, instance, events, template = None, type = None,
                  health = None, max_health = None, power = None, speed = None,
                  ability = None):
@@ -91,8 +106,10 @@ class BattleUnit(object):
         self.ability    = ability or instance.ability
         self.team       = None
         self.index      = -1
+        self.bit        = 0     # 1 << index while in a formation
         self.on         = events
         self.dead       = False
+        self.zkeys      = None  # feature -> Zobrist key, when hashing
 
     @property
     def alive(self):
@@ -100,51 +117,156 @@ class BattleUnit(object):
 
     def plus_health(self, amount):
         if not self.dead:
+            health, state = self.health, self.max_health.state
             self.max_health.plus(amount)
             if self.health > 0:
                 self.health = min(self.health + amount, self.max_health.value)
+            if not self.zkeys is None:
+                self._rehash("max_health", state, health)
 
     def minus_health(self, amount):
         if not self.dead:
+            health, state = self.health, self.max_health.state
             self.max_health.minus(amount)
             self.health = min(self.max_health.value, self.health)
+            if not self.zkeys is None:
+                self._rehash("max_health", state, health)
 
     def plus_power(self, amount):
         if not self.dead:
+            state = self.power.state
             self.power.plus(amount)
+            if not self.zkeys is None:
+                self._rehash("power", state)
 
     def minus_power(self, amount):
         if not self.dead:
+            state = self.power.state
             self.power.minus(amount)
+            if not self.zkeys is None:
+                self._rehash("power", state)
 
     def plus_speed(self, amount):
         if not self.dead:
+            state = self.speed.state
             self.speed.plus(amount)
+            if not self.zkeys is None:
+                self._rehash("speed", state)
 
     def minus_speed(self, amount):
         if not self.dead:
+            state = self.speed.state
             self.speed.minus(amount)
+            if not self.zkeys is None:
+                self._rehash("speed", state)
+
+    def add_modifier(self, name, modifier):
+        """Push a StatModifier onto the "max_health", "power" or "speed"
+        stack. Health is capped by a lowered maximum."""
+        if not self.dead:
+            attribute = getattr(self, name)
+            health, state = self.health, attribute.state
+            attribute.add(modifier)
+            self._modified(name, state, health)
+
+    def remove_modifiers(self, source):
+        """Drop the modifiers of every stat that come from `source`."""
+        for name in STATS:
+            attribute = getattr(self, name)
+            health, state = self.health, attribute.state
+            if attribute.remove(source):
+                self._modified(name, state, health)
+
+    def tick(self):
+        """Count down timed modifiers at the end of a round."""
+        for name in STATS:
+            attribute = getattr(self, name)
+            if attribute.timed:
+                health, state = self.health, attribute.state
+                attribute.tick()
+                self._modified(name, state, health)
 
     def damage(self, amount, type = None, source = None):
         if self.dead:
             return 0
-        amount = self.type(type.id if type else None)(amount)
-        self.health = max(0, self.health - amount)
-        self.on.damage(self, amount = amount, type = type, source = source)
+        row = self.type.row
+        # the row is indexed by the uids of the defender's chart only
+        if not row is None and (type is None or type.chart is self.type.chart):
+            amount = row[type.uid if type else -1](amount)
+        else:
+            amount = self.type(type.id if type else None)(amount)
+        health = self.health
+        self.health = max(0, health - amount)
+        if not self.zkeys is None and self.bit:
+            self.team.hash ^= self.zkey(health) ^ self.zkey(self.health)
+        self.on.damage(self, amount, type, source)
         # if self.health == 0:
             # self.on.death(self)
         return amount
 
     def heal(self, amount, source = None):
         if not self.dead:
-            self.health = min(self.max_health.value, self.health + amount)
-            self.on.heal(self, amount = amount, source = source)
+            health = self.health
+            self.health = min(self.max_health.value, health + amount)
+            if not self.zkeys is None and self.bit:
+                self.team.hash ^= self.zkey(health) ^ self.zkey(self.health)
+            self.on.heal(self, amount, source)
 
     def kill(self):
         self.dead = True
+        if not self.zkeys is None and self.bit:
+            self.team.hash ^= self.zkey(self.health) ^ self.zkey(0)
         self.health = 0
         self.on.death(self)
 
+    def zkey(self, feature):
+        """Zobrist key of a feature of this unit. Health values are plain
+        ints, slots are negative ints, stats are (name,) + Attribute.state."""
+        key = self.zkeys.get(feature)
+        if key is None:
+            key = self.zkeys[feature] = _zobrist.getrandbits(62)
+        return key
+
+    def zobrist_hash(self):
+        """Hash of this unit's slot, health and stats."""
+        return (self.zkey(-1 - self.index) ^ self.zkey(self.health)
+                ^ self.zkey(("max_health",) + self.max_health.state)
+                ^ self.zkey(("power",) + self.power.state)
+                ^ self.zkey(("speed",) + self.speed.state))
+
+    def _modified(self, name, state, health):
+        if name == "max_health" and self.health > self.max_health.value:
+            self.health = self.max_health.value
+        if not self.zkeys is None:
+            self._rehash(name, state, health)
+
+    def _rehash(self, name, state, health = None):
+        if self.bit:
+            h = (self.zkey((name,) + state)
+                 ^ self.zkey((name,) + getattr(self, name).state))
+            if not health is None:
+                h ^= self.zkey(health) ^ self.zkey(self.health)
+            self.team.hash ^= h
+
+    def copy(self, events, team = None):
+        """Copy of the combat state, as a unit of `team` at the same slot."""
+        unit = _new(BattleUnit)
+        unit.instance   = self.instance
+        unit.template   = self.template
+        unit.type       = self.type
+        unit.max_health = self.max_health.copy()
+        unit.health     = self.health
+        unit.power      = self.power.copy()
+        unit.speed      = self.speed.copy()
+        unit.ability    = self.ability
+        unit.team       = team
+        unit.index      = self.index
+        unit.bit        = self.bit
+        unit.on         = events
+        unit.dead       = self.dead
+        unit.zkeys      = self.zkeys
+        return unit
+
 
 
 ###############################################################################
@@ -152,15 +274,21 @@ class BattleUnit(object):
 ###############################################################################
 
 class BattleTeam(object):
+    __slots__ = ("capacity", "units", "grave", "index", "on", "version",
+                 "zobrist", "hash")
+
     def __init__(self, capacity, events):
         self.capacity = capacity
         self.units  = []
         self.grave  = []
         self.index  = -1
         self.on     = events
+        self.version = 0    # bumped whenever the formation changes
+        self.zobrist = False
+        self.hash   = 0     # Zobrist hash of the formation, when enabled
         for i in xrange(len(self.units)):
             self.units[i].team = self
-            self.units[i].index = i
+        self._reindex()
 
     @property
     def size(self):
@@ -195,48 +323,112 @@ class BattleTeam(object):
     def rotate_left(self):
         u = self.units.pop(0)
         self.units.append(u)
-        for i in xrange(len(self.units)):
-            self.units[i].index = i
-        self.on.rotate(self, active = self.active, previous = u)
-        self.on.rotate_left(self, active = self.active, previous = u)
+        self._reindex()
+        self.version += 1
+        self.on.rotate(self, self.active, u)
+        self.on.rotate_left(self, self.active, u)
 
     def rotate_right(self):
         u = self.units.pop()
         self.units.insert(0, u)
-        for i in xrange(len(self.units)):
-            self.units[i].index = i
-        self.on.rotate(self, active = self.active, previous = u)
-        self.on.rotate_right(self, active = self.active, previous = u)
+        self._reindex()
+        self.version += 1
+        self.on.rotate(self, self.active, u)
+        self.on.rotate_right(self, self.active, u)
 
     def add_unit(self, unit):
         if len(self.units) < self.capacity:
             unit.index  = len(self.units)
+            unit.bit    = 1 << unit.index
             unit.team   = self
             self.units.append(unit)
+            self.version += 1
+            if self.zobrist:
+                if unit.zkeys is None:
+                    unit.zkeys = {}
+                self.hash ^= unit.zobrist_hash()
             return True
         return False
 
     def kill(self, i):
         unit = self.units[i]
         unit.kill()
+        if self.zobrist:
+            self.hash ^= unit.zobrist_hash()
         self.units.pop(i)
-        for j in xrange(i, len(self.units)):
-            self.units[j].index = j
-        self.on.remove(self, unit = unit)
+        unit.bit = 0
+        self._reindex(i)
+        self.version += 1
+        self.on.remove(self, unit)
         self.grave.append(unit)
 
     def cleanup(self):
-        i = 0
-        while i < len(self.units):
-            unit = self.units[i]
-            if not unit.alive:
+        # Dead units keep their slots until the end of the pass, so the
+        # formation is compacted once, however many units die.
+        removed = False
+        for unit in self.units:
+            if not unit.dead and not unit.alive:
                 unit.kill()
-                self.units.pop(i)
-                self.on.remove(self, unit = unit)
+                self.on.remove(self, unit)
                 self.grave.append(unit)
-            else:
-                unit.index = i
-                i += 1
+                removed = True
+        if removed:
+            for unit in self.units:
+                if unit.dead:
+                    if self.zobrist:
+                        self.hash ^= unit.zobrist_hash()
+                    unit.bit = 0
+            self.units[:] = [unit for unit in self.units if not unit.dead]
+            self._reindex()
+            self.version += 1
+
+    def copy(self, events, unit_events, memo):
+        """Copy of the formation and grave. Unit copies are stored in
+        `memo`, keyed by the original unit."""
+        team = _new(BattleTeam)
+        team.capacity = self.capacity
+        team.index = self.index
+        team.on = events
+        team.version = 0
+        team.zobrist = self.zobrist
+        team.hash = self.hash
+        team.units = units = []
+        for unit in self.units:
+            memo[unit] = copy = unit.copy(unit_events, team)
+            units.append(copy)
+        team.grave = grave = []
+        for unit in self.grave:
+            memo[unit] = copy = unit.copy(unit_events, team)
+            grave.append(copy)
+        return team
+
+    def enable_hashing(self):
+        """Start maintaining `hash` as units move, take damage or heal."""
+        self.zobrist = True
+        for unit in self.units:
+            if unit.zkeys is None:
+                unit.zkeys = {}
+        for unit in self.grave:
+            if unit.zkeys is None:
+                unit.zkeys = {}
+        self.rehash()
+
+    def rehash(self):
+        h = 0
+        for unit in self.units:
+            h ^= unit.zobrist_hash()
+        self.hash = h
+        return h
+
+    def _reindex(self, start = 0):
+        h = 0
+        for i in xrange(start, len(self.units)):
+            unit = self.units[i]
+            if self.zobrist and unit.index != i:
+                h ^= unit.zkey(-1 - unit.index) ^ unit.zkey(-1 - i)
+            unit.index = i
+            unit.bit = 1 << i
+        self.hash ^= h
 
 
 
@@ -255,20 +447,108 @@ class Battlefield(object):
 #   Attribute
 ###############################################################################
 
+STATS = ("max_health", "power", "speed")
+
+# Modifier kinds. Layers apply in this order: the sum of ADD amounts, the
+# product of MULTIPLY factors, then the tightest of the CLAMP (low, high)
+# bounds, either of which may be None.
+ADD         = 0
+MULTIPLY    = 1
+CLAMP       = 2
+
+# `source` is the ability that applied it; `duration` is in rounds, or None.
+StatModifier = namedtuple("StatModifier", ("kind", "amount", "source",
+                                           "duration"))
+
+
 class Attribute(object):
+    """Base stat with a flat `bonus` and a stack of StatModifiers. `value`
+    is recomputed whenever either changes, so reads are plain lookups."""
+    __slots__ = ("base", "bonus", "modifiers", "value", "timed")
+
     def __init__(self, value):
-        self.base = value
-        self.bonus = 0
+        self.base       = value
+        self.bonus      = 0
+        self.modifiers  = ()    # replaced, never mutated, so snapshots share it
+        self.value      = max(1, value)
+        self.timed      = False
 
     @property
-    def value(self):
-        return max(1, self.base + self.bonus)
+    def state(self):
+        return (self.bonus, self.modifiers)
 
     def plus(self, amount):
         self.bonus += amount
+        self.update()
 
     def minus(self, amount):
         self.bonus -= amount
+        self.update()
+
+    def add(self, modifier):
+        self.modifiers += (modifier,)
+        self.update()
+
+    def remove(self, source):
+        """Drop the modifiers from `source`. Returns how many there were."""
+        kept = tuple([m for m in self.modifiers if not m.source is source])
+        removed = len(self.modifiers) - len(kept)
+        if removed:
+            self.modifiers = kept
+            self.update()
+        return removed
+
+    def tick(self):
+        modifiers = []
+        for modifier in self.modifiers:
+            if modifier.duration is None:
+                modifiers.append(modifier)
+            elif modifier.duration > 1:
+                modifiers.append(modifier._replace(
+                                 duration = modifier.duration - 1))
+        self.modifiers = tuple(modifiers)
+        self.update()
+
+    def set(self, bonus, modifiers):
+        self.bonus = bonus
+        self.modifiers = modifiers
+        self.update()
+
+    def update(self):
+        value = self.base + self.bonus
+        if not self.modifiers:
+            self.value = max(1, value)
+            self.timed = False
+            return
+        factor = 1.0
+        low, high = 1, None
+        timed = False
+        for kind, amount, _, duration in self.modifiers:
+            if kind == ADD:
+                value += amount
+            elif kind == MULTIPLY:
+                factor *= amount
+            else:
+                if not amount[0] is None:
+                    low = max(low, amount[0])
+                if not amount[1] is None:
+                    high = amount[1] if high is None else min(high, amount[1])
+            if not duration is None:
+                timed = True
+        if factor != 1.0:
+            value = int(value * factor)
+        value = max(low, value)
+        self.value = value if high is None else max(1, min(high, value))
+        self.timed = timed
+
+    def copy(self):
+        attribute = _new(Attribute)
+        attribute.base      = self.base
+        attribute.bonus     = self.bonus
+        attribute.modifiers = self.modifiers
+        attribute.value     = self.value
+        attribute.timed     = self.timed
+        return attribute
 
 
 
@@ -276,12 +556,27 @@ class Attribute(object):
 #   Species Type
 ###############################################################################
 
+def multiplier_plus(amount):
+    return int(amount + amount / 2)
+
+def multiplier_minus(amount):
+    return int(amount - amount / 3)
+
+def multiplier_normal(amount):
+    return int(amount)
+
+
 class UnitType(object):
     def __init__(self, id, name, resistances = None, weaknesses = None):
         self.id = id
         self.name = name
         self.resistances = resistances or []
         self.weaknesses = weaknesses or []
+        # set by TypeChart: index in the chart, and the multiplier function
+        # per attacking type index, the last one for untyped attacks
+        self.chart = None
+        self.uid = -1
+        self.row = None
 
     def __call__(self, attacking_type):
         if attacking_type in self.resistances:
@@ -290,17 +585,53 @@ class UnitType(object):
             return UnitType.multiplier_plus
         return UnitType.multiplier_normal
 
-    @staticmethod
-    def multiplier_plus(amount):
-        return int(amount + amount / 2)
+    # module level functions, so that charted types can be pickled
+    multiplier_plus = staticmethod(multiplier_plus)
+    multiplier_minus = staticmethod(multiplier_minus)
+    multiplier_normal = staticmethod(multiplier_normal)
 
-    @staticmethod
-    def multiplier_minus(amount):
-        return int(amount - amount / 3)
 
-    @staticmethod
-    def multiplier_normal(amount):
-        return int(amount)
+# Effectiveness kinds stored in a TypeChart.
+NORMAL, PLUS, MINUS = 0, 1, 2
+
+MULTIPLIERS = (multiplier_normal, multiplier_plus, multiplier_minus)
+
+
+class TypeChart(object):
+    """Dense effectiveness table, built once from a set of types.
+
+    Each type gets a small integer `uid`. kinds[defender][attacker] holds
+    NORMAL, PLUS or MINUS; the last column is for untyped attacks. Types
+    in one battle should share a chart.
+    """
+    def __init__(self, types):
+        self.types = list(types)
+        uids = {}
+        for i, type in enumerate(self.types):
+            type.chart = self
+            type.uid = i
+            uids.setdefault(type.id, []).append(i)
+        n = len(self.types)
+        kinds = []
+        for type in self.types:
+            row = [NORMAL] * (n + 1)
+            # as in UnitType.__call__, resistances win over weaknesses
+            for kind, ids in ((PLUS, type.weaknesses),
+                              (MINUS, type.resistances)):
+                for id in ids:
+                    for i in uids.get(id, ()):
+                        row[i] = kind
+                if None in ids:
+                    row[n] = kind
+            kinds.append(tuple(row))
+            type.row = tuple([MULTIPLIERS[kind] for kind in row])
+        self.kinds = tuple(kinds)
+
+    def __len__(self):
+        return len(self.types)
+
+    def kind(self, defender, attacker):
+        return self.kinds[defender.uid][attacker.uid if attacker else -1]
 
 
 
@@ -320,6 +651,10 @@ class Ability(object):
 
 
 class AbilityEffect(object):
+    # weakly referenced by the compiled plan cache
+    __slots__ = ("ability", "mechanic", "target", "events", "parameters",
+                 "__weakref__")
+
     def __init__(self, mechanic, target, events, ability = None, parameters = None):
         self.ability    = ability
         self.mechanic   = mechanic
@@ -0,0 +1,447 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Lookahead action selection.
+# Depth-limited expectimax over whole rounds, deepened iteratively until the
+# time budget runs out. Both teams pick their actions at the same time, so
+# the opponent is a chance node (uniform over its actions), as is the coin
+# flip that breaks speed ties in BattleMechanics.calculate_turn.
+# Positions reached again, e.g. by rotating back and forth, are looked up in
+# a transposition table keyed by the battle's Zobrist hash.
+
+import multiprocessing
+import sys
+import time
+
+from .mechanics import BattleEngine
+
+
+ACTIONS = ("attack", "rotate_clock", "rotate_counter")
+
+WIN     = 1.0
+LOSS    = -1.0
+DRAW    = 0.0
+
+# Keys for the side to move, so both teams can share a table.
+PERSPECTIVE = (0x2545f4914f6cdd1d, 0x1d8e4e27c47d124f)
+
+###############################################################################
+#   Transposition Table
+###############################################################################
+
+class TranspositionTable(object):
+    """Fixed-size table of searched values, keyed by Zobrist hash.
+
+    Each of the `size` buckets holds two entries: one kept for the deepest
+    search stored there, and one that is always replaced. Memory does not
+    grow with the length of the battle.
+    """
+    def __init__(self, size = 1 << 14):
+        assert size & (size - 1) == 0, "size must be a power of two"
+        self.mask   = size - 1
+        self.keys   = [None] * (2 * size)
+        self.depths = [0] * (2 * size)
+        self.values = [0.0] * (2 * size)
+        self.hits   = 0
+        self.stores = 0
+
+    def probe(self, key, depth):
+        """Value stored for `key` by a search at least `depth` deep."""
+        i = (key & self.mask) << 1
+        keys = self.keys
+        if keys[i] == key and self.depths[i] >= depth:
+            self.hits += 1
+            return self.values[i]
+        i += 1
+        if keys[i] == key and self.depths[i] >= depth:
+            self.hits += 1
+            return self.values[i]
+        return None
+
+    def store(self, key, depth, value):
+        i = (key & self.mask) << 1
+        if not (self.keys[i] is None or self.keys[i] == key
+                or depth >= self.depths[i]):
+            i += 1
+        self.keys[i] = key
+        self.depths[i] = depth
+        self.values[i] = value
+        self.stores += 1
+
+    def clear(self):
+        n = len(self.keys)
+        self.keys   = [None] * n
+        self.depths = [0] * n
+        self.values = [0.0] * n
+        self.hits   = 0
+        self.stores = 0
+
+
+###############################################################################
+#   Search Policy
+###############################################################################
+
+class OutOfTime(Exception):
+    pass
+
+
+class NullWriter(object):
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+class SearchPolicy(object):
+    """Policy callable as policy(engine, team_index) -> action.
+
+    `budget` is the time allowed per decision, in milliseconds. Statistics
+    of the last decision are kept in nodes, depth, elapsed and value.
+    The transposition table is kept across decisions.
+    """
+    def __init__(self, budget = 50, max_depth = 8, table = None):
+        self.budget     = budget
+        self.max_depth  = max_depth
+        self.table      = table or TranspositionTable()
+        self.nodes      = 0
+        self.depth      = 0
+        self.elapsed    = 0.0
+        self.value      = 0.0
+        self._deadline  = 0.0
+        self._team      = 0
+
+    @property
+    def nodes_per_second(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.nodes / self.elapsed
+
+    def __call__(self, engine, i):
+        return self.choose(engine, i)
+
+    def choose(self, engine, i):
+        start = time.time()
+        self._deadline = start + self.budget / 1000.0
+        self._team = i
+        self.nodes = 0
+        self.depth = 0
+        action = "attack"
+        stdout = sys.stdout
+        sys.stdout = NullWriter()   # the engine prints debug traces
+        try:
+            # hashes are kept on the battle, so they carry over to clones
+            # and later decisions reuse the table
+            if not engine.mechanics.teams[0].zobrist:
+                engine.mechanics.enable_hashing()
+            engine = engine.clone()
+            for depth in xrange(1, self.max_depth + 1):
+                action, self.value = self._root(engine, depth)
+                self.depth = depth
+                if abs(self.value) >= WIN:
+                    break
+        except OutOfTime:
+            pass
+        finally:
+            sys.stdout = stdout
+        self.elapsed = time.time() - start
+        return action
+
+    def report(self):
+        return ("depth {}, {} nodes, {:.0f} nodes/sec, value {:.3f}, "
+                "{} table hits").format(self.depth, self.nodes,
+                self.nodes_per_second, self.value, self.table.hits)
+
+    def _root(self, engine, depth):
+        best = None
+        snapshot = engine.snapshot()
+        for action in self._actions(engine, self._team):
+            value = self._expect(engine, snapshot, action, depth)
+            if best is None or value > best[1]:
+                best = (action, value)
+        engine.restore(snapshot)
+        return best
+
+    def _max(self, engine, depth):
+        if engine.state == "end":
+            return self._outcome(engine)
+        if depth == 0:
+            return self._evaluate(engine)
+        key = engine.mechanics.zobrist_hash() ^ PERSPECTIVE[self._team]
+        best = self.table.probe(key, depth)
+        if not best is None:
+            return best
+        snapshot = engine.snapshot()
+        best = LOSS
+        for action in self._actions(engine, self._team):
+            best = max(best, self._expect(engine, snapshot, action, depth))
+            if best >= WIN:
+                break
+        self.table.store(key, depth, best)
+        return best
+
+    def deepen(self, engine, i, action, reply):
+        """Value of one root (action, reply) pair at increasing depths,
+        until the budget runs out. Used to split a search across workers."""
+        start = time.time()
+        self._deadline = start + self.budget / 1000.0
+        self._team = i
+        self.nodes = 0
+        values = []
+        stdout = sys.stdout
+        sys.stdout = NullWriter()
+        try:
+            if not engine.mechanics.teams[0].zobrist:
+                engine.mechanics.enable_hashing()
+            snapshot = engine.snapshot()
+            for depth in xrange(1, self.max_depth + 1):
+                values.append(self._pair(engine, snapshot, action, reply, depth))
+                if abs(values[-1]) >= WIN:
+                    break
+        except OutOfTime:
+            pass
+        finally:
+            sys.stdout = stdout
+        self.depth = len(values)
+        self.elapsed = time.time() - start
+        return values
+
+    def _expect(self, engine, snapshot, action, depth):
+        """Expected value of `action` over the opponent's actions and the
+        speed tie coin flip."""
+        replies = self._actions(engine, 1 - self._team)
+        total = 0.0
+        for reply in replies:
+            total += self._pair(engine, snapshot, action, reply, depth)
+        return total / len(replies)
+
+    def _pair(self, engine, snapshot, action, reply, depth):
+        engine.restore(snapshot)
+        actions = {self._team: action, 1 - self._team: reply}
+        coins = self._coins(engine, actions)
+        total = 0.0
+        for coin in coins:
+            if coin is not None:
+                engine.restore(snapshot)
+            total += self._play(engine, actions, coin, depth)
+        engine.restore(snapshot)
+        return total / len(coins)
+
+    def _coins(self, engine, actions):
+        # Rotations change the active units, so apply them before comparing.
+        for i in sorted(actions):
+            engine.set_action(actions[i], i)
+        teams = engine.mechanics.teams
+        if teams[0].active.speed.value == teams[1].active.speed.value:
+            return (0, 1)
+        return (None,)
+
+    def _play(self, engine, actions, coin, depth):
+        if time.time() > self._deadline:
+            raise OutOfTime()
+        self.nodes += 1
+        if coin is not None:
+            for i in sorted(actions):
+                engine.set_action(actions[i], i)
+        engine.mechanics.tie_break = coin
+        engine.step()
+        if engine.state == "between_rounds":
+            engine.step()
+        engine.mechanics.tie_break = None
+        return self._max(engine, depth - 1)
+
+    def _actions(self, engine, i):
+        if engine.mechanics.teams[i].can_rotate:
+            return ACTIONS
+        return ACTIONS[:1]
+
+    def _outcome(self, engine):
+        mine = engine.mechanics.teams[self._team].alive
+        theirs = engine.mechanics.teams[1 - self._team].alive
+        if mine and not theirs:
+            return WIN
+        if theirs and not mine:
+            return LOSS
+        return DRAW
+
+    def _evaluate(self, engine):
+        """Health share of each team, scaled to stay inside (LOSS, WIN)."""
+        teams = engine.mechanics.teams
+        mine = self._health(teams[self._team])
+        theirs = self._health(teams[1 - self._team])
+        return 0.9 * (mine - theirs) / max(mine + theirs, 1e-9)
+
+    def _health(self, team):
+        return sum([unit.health / float(unit.max_health.value)
+                    for unit in team.units])
+
+
+###############################################################################
+#   Root-Parallel Search
+###############################################################################
+
+def export_battle(engine):
+    """Picklable copy of a battle's state, for import_battle()."""
+    mechanics = engine.mechanics
+    rank = dict((unit, r) for r, unit in enumerate(mechanics.abilities))
+    teams = []
+    for team in mechanics.teams:
+        teams.append(tuple((unit.instance, unit.health, unit.max_health.state,
+                            unit.power.state, unit.speed.state,
+                            rank.get(unit)) for unit in team.units))
+    return (engine.state, mechanics.turn, mechanics.round, tuple(teams))
+
+def import_battle(state):
+    engine_state, turn, round, teams = state
+    engine = BattleEngine()
+    engine.set_battle([[entry[0] for entry in team] for team in teams])
+    mechanics = engine.mechanics
+    mechanics.turn = turn
+    mechanics.round = round
+    ranked = []
+    for team, entries in zip(mechanics.teams, teams):
+        for unit, entry in zip(team.units, entries):
+            _, unit.health, max_health, power, speed, rank = entry
+            unit.max_health.set(*max_health)
+            unit.power.set(*power)
+            unit.speed.set(*speed)
+            if not rank is None:
+                ranked.append((rank, unit))
+    # bind abilities in their original order, which is also dispatch order
+    for _, unit in sorted(ranked):
+        mechanics._bind(unit)
+    engine.state = engine_state
+    engine._handler = getattr(engine, "_state_" + engine_state)
+    return engine
+
+
+_table = None   # per worker, reused by every task it runs
+
+def search_pair(args):
+    """Worker entry point: deepen one root (action, reply) pair."""
+    global _table
+    state, i, action, reply, budget, max_depth = args
+    if _table is None:
+        _table = TranspositionTable()
+    policy = SearchPolicy(budget = budget, max_depth = max_depth,
+                          table = _table)
+    values = policy.deepen(import_battle(state), i, action, reply)
+    return action, reply, values, policy.nodes
+
+
+def init_worker():
+    sys.stdout = NullWriter()
+
+
+class ParallelSearch(object):
+    """Splits the root of a SearchPolicy search into (action, reply) pairs,
+    searched in a process pool that is created once and reused.
+
+    start() submits a decision and poll() returns the action once it is
+    ready, or None, so that a game loop never blocks on it.
+    """
+    def __init__(self, budget = 100, max_depth = 8, jobs = None):
+        self.budget     = budget
+        self.max_depth  = max_depth
+        self.jobs       = jobs or multiprocessing.cpu_count()
+        self.pool       = None
+        self.nodes      = 0
+        self.depth      = 0
+        self.elapsed    = 0.0
+        self.value      = 0.0
+        self._pending   = None
+        self._start     = 0.0
+        self._actions   = ()
+
+    @property
+    def nodes_per_second(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.nodes / self.elapsed
+
+    @property
+    def busy(self):
+        return not self._pending is None
+
+    def __call__(self, engine, i):
+        self.start(engine, i)
+        self._pending.wait()
+        return self.poll()
+
+    def start(self, engine, i):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.jobs,
+                                             initializer = init_worker)
+        teams = engine.mechanics.teams
+        self._actions = ACTIONS if teams[i].can_rotate else ACTIONS[:1]
+        replies = ACTIONS if teams[1 - i].can_rotate else ACTIONS[:1]
+        state = export_battle(engine)
+        pairs = [(action, reply) for action in self._actions
+                 for reply in replies]
+        # with more pairs than workers, they run in waves within the budget
+        waves = -(-len(pairs) // self.jobs)
+        tasks = [(state, i, action, reply, self.budget / float(waves),
+                  self.max_depth) for action, reply in pairs]
+        self._start = time.time()
+        self._pending = self.pool.map_async(search_pair, tasks, chunksize = 1)
+
+    def poll(self):
+        if self._pending is None or not self._pending.ready():
+            return None
+        results = self._pending.get()
+        self._pending = None
+        self.elapsed = time.time() - self._start
+        return self._merge(results)
+
+    def close(self):
+        if not self.pool is None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self._pending = None
+
+    def report(self):
+        return "depth {}, {} nodes, {:.0f} nodes/sec, value {:.3f}".format(
+               self.depth, self.nodes, self.nodes_per_second, self.value)
+
+    def _merge(self, results):
+        """Average each action over the replies, at the deepest depth that
+        every pair completed."""
+        self.nodes = sum([nodes for _, _, _, nodes in results])
+        open = [len(values) for _, _, values, _ in results
+                if not values or abs(values[-1]) < WIN]
+        depth = min(open) if open else max([len(values)
+                                            for _, _, values, _ in results])
+        self.depth = depth
+        if depth == 0:
+            self.value = 0.0
+            return "attack"
+        totals = {}
+        for action, reply, values, _ in results:
+            # a decided pair stops deepening; its last value stays valid
+            totals.setdefault(action, []).append(values[min(depth,
+                                                            len(values)) - 1])
+        best = None
+        for action in self._actions:
+            value = sum(totals[action]) / len(totals[action])
+            if best is None or value > best[1]:
+                best = (action, value)
+        self.value = best[1]
+        return best[0]
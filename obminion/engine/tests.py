@@ -1,4 +1,5 @@
-from .models import UnitTemplate, UnitInstance, UnitType, Ability, AbilityEffect
+from .models import UnitTemplate, UnitInstance, UnitType, Ability, AbilityEffect, \
+                    TypeChart
 from .mechanics import BattleEngine
 
 ###############################################################################
@@ -26,6 +27,8 @@ types = {
     "weak": UnitType("weak", "Weak", weaknesses = ("dummy",))
 }
 
+chart = TypeChart(types.values())
+
 abilities = {
     "none": Ability("none", "Do Nothing"),
     "log": Ability("log", "Log Ability",
@@ -133,6 +136,35 @@ assert engine.mechanics.teams[1].active.health == 10
 
 print "> OK"
 
+###############################################################################
+# Type chart test
+
+print "Testing type chart..."
+
+from .models import MULTIPLIERS
+
+assert len(chart) == len(types)
+for defender in types.itervalues():
+    for attacker in types.itervalues():
+        assert MULTIPLIERS[chart.kind(defender, attacker)] \
+               is defender(attacker.id)
+        assert defender.row[attacker.uid] is defender(attacker.id)
+    assert defender.row[-1] is defender(None)
+assert types["resistant"].row[types["dummy"].uid](9) == 6
+assert types["weak"].row[types["dummy"].uid](9) == 13
+
+# attacking types outside the defender's chart are matched by id
+engine.set_battle(((UnitInstance(species["weak"]),), dummy))
+weak = engine.mechanics.teams[0].active
+assert weak.damage(10, UnitType("dummy", "Unlisted")) == 15
+others = [UnitType("other" + str(i), "Other") for i in xrange(8)]
+others.append(UnitType("dummy", "Foreign Dummy"))
+TypeChart(others)
+assert weak.damage(2, others[-1]) == 3
+assert weak.damage(2, others[0]) == 2
+
+print "> OK"
+
 ###############################################################################
 # Logging ability test
 
@@ -227,3 +259,602 @@ assert engine.mechanics.teams[1].active.health == 10
 
 print "> OK"
 action = "attack"
+
+###############################################################################
+# Target cache test
+
+print "Testing cached target resolution..."
+
+units = tuple(UnitInstance(species[sid]) for sid in ("normal", "weak", "resistant"))
+engine.set_battle((units, dummy))
+team = engine.mechanics.teams[0]
+a, b, c = team.units
+left = engine.mechanics.target(a, "self_left")
+others = engine.mechanics.target(a, "friend_others")
+everyone = engine.mechanics.target(a, "all")
+assert left.get() == [c] and c in left and not b in left
+assert others.get() == [b, c]
+assert len(everyone.get()) == 4
+team.rotate_left()
+assert left.get() == [c]
+assert others.get() == [b, c] and not a in others
+c.health = 0
+team.cleanup()
+assert left.get() == [b] and b in left and not c in left
+assert others.get() == [b]
+assert len(everyone.get()) == 3
+assert a.bit == 1 << a.index and b.bit == 1 << b.index and c.bit == 0
+assert not c in everyone and not team in others
+
+print "> OK"
+
+###############################################################################
+# Event routing test
+
+print "Testing ability routing by emitter..."
+
+watch = Ability("watch", "Watch Ability",
+                effects = (AbilityEffect("log", "self", ("self_left defend",)),
+                           AbilityEffect("log", "self", ("friend_active defend",))))
+watcher = UnitTemplate("watcher", "Watcher", types["normal"], 20, 10, 12,
+                       (watch,))
+units = (UnitInstance(watcher), UnitInstance(species["normal"]),
+         UnitInstance(species["normal"]))
+engine.set_battle((units, dummy))
+engine.step()
+mechanics = engine.mechanics
+team = mechanics.teams[0]
+a, b, c = team.units
+fired = []
+mechanics.unit_events.ability.sub(lambda ability, unit: fired.append(unit))
+
+def defend(unit):
+    del fired[:]
+    unit.on.defend(unit, None)
+    return len(fired)
+
+assert (defend(a), defend(b), defend(c)) == (1, 0, 1)
+# the callbacks follow the watcher to its new slot
+team.rotate_left()
+assert team.active is b and a.index == 2
+assert (defend(a), defend(b), defend(c)) == (0, 1, 1)
+assert fired == [a]
+c.health = 0
+mechanics.cleanup()
+assert team.units == [b, a]
+assert (defend(a), defend(b), defend(c)) == (0, 2, 0)
+# removed callbacks keep their place until the next cleanup, so adding
+# them back restores the dispatch order
+router = mechanics.router("unit_events", "defend")
+dynamic = list(router.dynamic)
+for handler in mechanics.abilities[a]:
+    handler.remove()
+assert router.dynamic == dynamic and len(router.removed) == 2
+assert (defend(a), defend(b)) == (0, 0)
+for handler in mechanics.abilities[a]:
+    handler.restore()
+assert router.dynamic == dynamic and not router.removed
+assert (defend(a), defend(b), defend(c)) == (0, 2, 0)
+# and stop firing once it is gone
+a.health = 0
+mechanics.cleanup()
+assert not a in mechanics.abilities
+assert (defend(a), defend(b)) == (0, 0)
+router = mechanics.router("unit_events", "defend")
+assert not router.dynamic and not any(router.static.values())
+
+print "> OK"
+
+###############################################################################
+# Cleanup order test
+
+print "Testing unit cleanup order..."
+
+units = (UnitInstance(watcher), UnitInstance(species["normal"]),
+         UnitInstance(watcher))
+engine.set_battle((units, dummy))
+engine.step()
+mechanics = engine.mechanics
+team = mechanics.teams[0]
+a, b, c = team.units
+removed = []
+mechanics.team_events.remove.sub(lambda team, unit: removed.append(
+    (unit, unit.index, list(team.units), unit in mechanics.abilities)))
+fired = []
+mechanics.unit_events.ability.sub(lambda ability, unit: fired.append(unit))
+b.on.defend(b, None)
+assert fired == [c]
+del fired[:]
+version = team.version
+a.health = c.health = 0
+mechanics.cleanup()
+# each unit is torn down in slot order, while the dead keep their slots
+assert removed == [(a, 0, [a, b, c], False), (c, 2, [a, b, c], False)]
+# then the formation is compacted once
+assert team.units == [b] and b.index == 0 and team.version == version + 1
+assert a.bit == c.bit == 0 and team.grave == [a, c]
+assert mechanics.abilities.keys() == []
+b.on.defend(b, None)
+assert fired == []
+
+print "> OK"
+
+###############################################################################
+# Compiled ability plan test
+
+print "Testing compiled ability plans..."
+
+import random
+import zlib
+
+def tester(id, type, health, power, speed, effect = None):
+    ability = (Ability(id, id.title(), effects = (effect,)),) if effect else ()
+    return UnitTemplate(id, id.title(), types[type], health, power, speed,
+                        ability)
+
+thorns = AbilityEffect("damage", "opponent", ("self damage",),
+                       parameters = {"relative": 0.5, "reference": "amount"})
+mend = AbilityEffect("heal", "friend_adjacent", ("self attack",),
+                     parameters = {"amount": 3})
+spite = AbilityEffect("damage", "opponent_all", ("self death",),
+                      parameters = {"amount": 4})
+# no speed ties, so the outcome only depends on the chosen actions
+roster = (tester("thorny", "normal", 30, 6, 10, thorns),
+          tester("medic", "weak", 24, 5, 12, mend),
+          tester("martyr", "dummy", 18, 8, 11, spite),
+          tester("brute", "normal", 28, 9, 13))
+rival = (tester("ogre", "normal", 30, 6, 14),
+         tester("medic", "weak", 24, 5, 9, mend),
+         tester("martyr", "dummy", 18, 8, 15, spite),
+         tester("brute", "normal", 28, 9, 16))
+
+def play(seed):
+    actions = random.Random(seed + 1)
+    def choose(engine):
+        engine.set_action(actions.choice(("attack", "attack", "rotate_clock",
+                                          "rotate_counter")), 0)
+    battle = BattleEngine(seed = seed)
+    battle.on.request_input.sub(choose)
+    battle.set_battle(([UnitInstance(s) for s in roster],
+                       [UnitInstance(s) for s in rival]))
+    trace = []
+    while battle.state != "end":
+        battle.step()
+        trace.append(tuple(tuple((u.template.id, u.health) for u in team.units)
+                           for team in battle.mechanics.teams))
+    return trace
+
+# units with the same ability share its plans, in every battle
+engine.set_battle(((UnitInstance(roster[1]), UnitInstance(roster[1])), dummy))
+engine.step()
+a, b = engine.mechanics.teams[0].units
+plan = engine.mechanics.abilities[a][0].plan
+assert engine.mechanics.abilities[b][0].plan is plan
+assert engine.clone().mechanics.abilities.values()[1][0].plan is plan
+engine.set_battle(((UnitInstance(roster[1]),), dummy))
+engine.step()
+assert engine.mechanics.abilities.values()[0][0].plan is plan
+trace = play(3)
+# same battles as the interpreter before plans were compiled
+assert (len(trace), zlib.crc32(repr(trace))) == (42, -1679906243)
+assert trace[-1] == ((), ())
+trace = play(11)
+assert (len(trace), zlib.crc32(repr(trace))) == (33, -1381500869)
+assert trace[-1] == ((("thorny", 6), ("medic", 11), ("brute", 4)), ())
+
+print "> OK"
+
+###############################################################################
+# Clone and snapshot test
+
+print "Testing battle clones and snapshots..."
+
+def outcome(engine):
+    return [([(u.template.id, u.health) for u in team.units],
+             [u.template.id for u in team.grave])
+            for team in engine.mechanics.teams]
+
+def finish(engine):
+    while engine.state != "end":
+        engine.step()
+    return outcome(engine)
+
+units = tuple(UnitInstance(species[sid]) for sid in ("logger", "weak", "logger"))
+enemy = (UnitInstance(species["dummy"]), UnitInstance(species["dummy"]))
+engine.set_battle((units, enemy))
+engine.step()
+snapshot = engine.snapshot()
+clone = engine.clone()
+clone.on.request_input.sub(action_callback)
+assert outcome(clone) == outcome(engine)
+expected = finish(engine)
+assert expected[0][1][0] == "logger"
+assert len(engine.mechanics.abilities) < 2
+assert finish(clone) == expected
+assert not clone.mechanics.teams[0].active is engine.mechanics.teams[0].active
+engine.restore(snapshot)
+assert engine.state == "select_action"
+assert len(engine.mechanics.abilities) == 2
+assert finish(engine) == expected
+engine.restore(snapshot)
+clone = engine.clone()
+clone.on.request_input.sub(action_callback)
+assert finish(clone) == expected
+# clones copy the handlers and routes, in the original order
+engine.restore(snapshot)
+clone = engine.clone().mechanics.clone()
+order = [u.template.id for u in engine.mechanics.abilities]
+assert [u.template.id for u in clone.abilities] == order
+for key, router in engine.mechanics.routers.iteritems():
+    copy = clone.routers[key]
+    assert copy.order == router.order
+    assert [cb.order for cb in copy.dynamic] == \
+           [cb.order for cb in router.dynamic if not cb in router.removed]
+    assert sorted(len(cbs) for cbs in copy.static.itervalues() if cbs) == \
+           sorted(len(cbs) for cbs in router.static.itervalues() if cbs)
+    for cbs in copy.static.itervalues():
+        for cb in cbs:
+            assert cb.router is copy
+            assert cb.unit in clone.abilities
+            assert all(e is clone or e in clone.teams or e.team in clone.teams
+                       for e in cb.emitters)
+clone = engine.clone()
+clone.on.request_input.sub(action_callback)
+assert finish(clone) == expected
+
+print "> OK"
+
+###############################################################################
+# Search policy test
+
+print "Testing search policy..."
+
+from .search import SearchPolicy
+
+calls = []
+units = tuple(UnitInstance(species[sid]) for sid in ("weak", "resistant"))
+engine.set_battle((units, (UnitInstance(species["logger"]),)))
+engine.mechanics.unit_events.damage.sub(lambda unit, *args: calls.append(unit))
+engine.step()
+before = outcome(engine)
+policy = SearchPolicy(budget = 50, max_depth = 3)
+assert policy(engine, 0) in ("attack", "rotate_clock", "rotate_counter")
+assert policy.nodes > 0 and policy.depth >= 1
+assert outcome(engine) == before
+assert engine.state == "select_action"
+assert not calls
+
+from .search import ParallelSearch, export_battle, import_battle
+
+copy = import_battle(export_battle(engine))
+assert outcome(copy) == before
+assert len(copy.mechanics.abilities) == len(engine.mechanics.abilities)
+policy = ParallelSearch(budget = 20, max_depth = 3, jobs = 2)
+try:
+    policy.start(engine, 1)
+    assert policy.busy
+    while policy.busy:
+        action = policy.poll()
+    assert action == "attack"   # a lone unit cannot rotate
+    assert policy(engine, 0) in ("attack", "rotate_clock", "rotate_counter")
+    assert policy.nodes > 0
+finally:
+    policy.close()
+assert outcome(engine) == before
+
+print "> OK"
+
+###############################################################################
+# Zobrist hashing test
+
+print "Testing Zobrist hashing..."
+
+from .search import TranspositionTable
+
+units = tuple(UnitInstance(species[sid]) for sid in ("normal", "weak", "resistant"))
+engine.set_battle((units, dummy))
+engine.step()
+mechanics = engine.mechanics
+mechanics.enable_hashing()
+team = mechanics.teams[0]
+start = mechanics.zobrist_hash()
+team.rotate_left()
+rotated = mechanics.zobrist_hash()
+assert rotated != start
+team.rotate_right()
+assert mechanics.zobrist_hash() == start
+team.active.damage(5)
+assert mechanics.zobrist_hash() != start
+assert team.hash == team.rehash()
+team.active.heal(5)
+assert mechanics.zobrist_hash() == start
+team.active.plus_power(2)
+assert team.hash == team.rehash()
+team.active.minus_power(2)
+assert mechanics.zobrist_hash() == start
+snapshot = engine.snapshot()
+team.kill(1)
+assert team.hash == team.rehash()
+engine.restore(snapshot)
+assert mechanics.zobrist_hash() == start
+assert engine.clone().mechanics.zobrist_hash() == start
+
+table = TranspositionTable(size = 4)
+table.store(start, 3, 0.5)
+assert table.probe(start, 2) == 0.5
+assert table.probe(start, 4) is None
+table.store(start + 4, 1, 0.25)     # same bucket, shallower
+table.store(start + 8, 1, -0.25)    # replaces the shallower entry
+assert table.probe(start, 3) == 0.5
+assert table.probe(start + 4, 1) is None
+assert table.probe(start + 8, 1) == -0.25
+assert len(table.keys) == 8
+
+policy = SearchPolicy(budget = 200, max_depth = 3)
+policy(engine, 0)
+nodes = policy.nodes
+policy(engine, 0)     # the same position again, answered from the table
+assert policy.table.hits > 0 and policy.nodes < nodes
+
+print "> OK"
+
+###############################################################################
+# Seeded random stream test
+
+print "Testing seeded random streams..."
+
+from .mechanics import spawn_seed
+
+def turns(engine, listings, seed = None):
+    # a speed tie every round, with units that deal 1 damage
+    engine.set_battle(listings, seed = seed)
+    for team in engine.mechanics.teams:
+        team.active.power.minus(100)
+    flips = []
+    while engine.state != "end" and engine.mechanics.round <= 15:
+        engine.step()
+        flips.append(engine.mechanics.turn)
+    return flips
+
+listings = ((UnitInstance(species["normal"]),), (UnitInstance(species["weak"]),))
+engines = [BattleEngine(seed = 7), BattleEngine(seed = 7)]
+for other in engines:
+    other.on.request_input.sub(action_callback)
+first = turns(engines[0], listings)
+assert first == turns(engines[1], listings)
+assert 0 < sum(first) < len(first)
+second = turns(engines[0], listings)
+assert second != first
+assert turns(engines[1], listings, seed = engines[0].seed) == second
+seed = engines[0].seed
+engines[0].set_battle(listings, seed = seed)
+engines[0].step()
+clone = engines[0].clone()
+clone.on.request_input.sub(action_callback)
+for _ in xrange(10):
+    engines[0].step()
+    clone.step()
+    assert clone.mechanics.turn == engines[0].mechanics.turn
+assert spawn_seed(7, 0, 1) == spawn_seed(7, 0, 1)
+assert spawn_seed(7, 0, 1) != spawn_seed(7, 1, 0)
+
+print "> OK"
+
+###############################################################################
+# Stat modifier test
+
+print "Testing stat modifiers..."
+
+from .models import Attribute, StatModifier, ADD, MULTIPLY, CLAMP
+
+attribute = Attribute(10)
+attribute.plus(2)
+attribute.add(StatModifier(MULTIPLY, 1.5, None, None))
+attribute.add(StatModifier(ADD, 2, "aura", None))
+assert attribute.value == 21
+attribute.add(StatModifier(CLAMP, (None, 15), "aura", 2))
+assert attribute.value == 15 and attribute.timed
+attribute.tick()
+assert attribute.value == 15
+attribute.tick()
+assert attribute.value == 21 and not attribute.timed
+assert attribute.remove("aura") == 1
+assert attribute.value == 18 and attribute.remove("aura") == 0
+attribute.add(StatModifier(MULTIPLY, 0.0, None, None))
+assert attribute.value == 1
+
+abilities["war_cry"] = Ability("war_cry", "War Cry", effects = (
+    AbilityEffect("modify", "friend_others", ("self attack",),
+                  parameters = {"stat": "power", "multiply": 2,
+                                "duration": 1}),))
+species["crier"] = UnitTemplate("crier", "Crier", types["normal"], 20, 10, 12,
+                                (abilities["war_cry"],))
+units = tuple(UnitInstance(species[sid]) for sid in ("crier", "normal"))
+engine.set_battle((units, dummy))
+engine.step()
+engine.mechanics.enable_hashing()
+team = engine.mechanics.teams[0]
+snapshot = engine.snapshot()
+start = engine.mechanics.zobrist_hash()
+engine.step()   # select action
+engine.step()   # the crier attacks
+assert team.units[1].power.value == 20
+assert team.hash == team.rehash()
+engine.step()   # the dummy attacks
+engine.step()   # the war cry wears off between rounds
+assert team.units[1].power.value == 10
+assert team.hash == team.rehash()
+engine.restore(snapshot)
+assert engine.mechanics.zobrist_hash() == start
+engine.step()
+engine.step()
+assert team.units[1].power.value == 20
+engine.restore(snapshot)
+assert team.units[1].power.value == 10
+assert team.units[1].power.modifiers == ()
+
+print "> OK"
+
+###############################################################################
+# Deferred event queue test
+
+print "Testing deferred event dispatch..."
+
+def on_batch(mechanics, records = ()):
+    batches.append([record.event.name for record in records])
+    drained.extend(records)
+
+deferred = BattleEngine(deferred = True, max_cascade = 8)
+deferred.on.request_input.sub(action_callback)
+
+batches = []
+drained = []
+unit = (UnitInstance(species["logger"]),)
+deferred.set_battle((unit, dummy))
+deferred.mechanics.events.batch.sub(on_batch)
+while deferred.state != "end":
+    deferred.step()
+assert not deferred.mechanics.teams[0].alive
+assert deferred.mechanics.teams[1].active.health == 10
+assert len(deferred.mechanics.abilities) == 0
+# the logger's attack and defend abilities fire before the damage
+assert batches[:3] == [["attack", "ability"], ["defend", "ability"],
+                       ["damage", "post_attack"]]
+assert batches[3:6] == [["attack"], ["defend"], ["damage", "post_attack"]]
+assert batches[6] == ["death", "remove"]
+# records are typed tuples holding the arguments in their declared order
+damage = drained[4]
+assert damage.name == "damage"
+assert damage.amount == 10 and damage.type is types["normal"]
+assert damage.args == (damage.emitter, 10, types["normal"], None)
+assert type(damage) is type(drained[8]) and isinstance(damage, tuple)
+
+# attack and defend abilities resolve before the damage is dealt, in
+# either mode
+abilities["brace"] = Ability("brace", "Brace", effects = (
+    AbilityEffect("log", "self", ("self defend",)),))
+species["brace"] = UnitTemplate("brace", "Brace", types["normal"], 20, 10, 12,
+                                (abilities["brace"],))
+brace = (UnitInstance(species["brace"]),)
+for battle in (engine, deferred):
+    seen = []
+    battle.set_battle((brace, brace))
+    battle.mechanics.unit_events.ability.sub(
+        lambda ability, unit: seen.append(unit.health))
+    while battle.state != "between_rounds":
+        battle.step()
+    assert seen == [20, 20]
+    assert [team.active.health for team in battle.mechanics.teams] == [10, 10]
+
+# Two echoes bounce damage back and forth; only the cascade cap stops them.
+abilities["echo"] = Ability("echo", "Echo", effects = (
+    AbilityEffect("damage", "opponent", ("self damage",),
+                  parameters = {"amount": 0}),))
+species["echo"] = UnitTemplate("echo", "Echo", types["normal"], 20, 10, 12,
+                               (abilities["echo"],))
+echo = (UnitInstance(species["echo"]),)
+
+deferred.set_battle((echo, echo))
+deferred.step()
+deferred.step()
+deferred.step()
+assert deferred.state == "between_rounds"
+assert deferred.mechanics.queue.dropped > 0
+assert not deferred.mechanics.queue.pending
+assert deferred.mechanics.teams[0].active.health == 10
+assert deferred.mechanics.teams[1].active.health == 10
+
+print "> OK"
+
+###############################################################################
+# Lockstep kernel differential test
+
+print "Testing lockstep kernel against the engine..."
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is None:
+    print "> SKIPPED (numpy is not available)"
+else:
+    import sys
+    from random import Random
+    from StringIO import StringIO
+    from .lockstep import LockstepBattles, ACTIONS
+
+    abilities.update({
+        "recoil": Ability("recoil", "Recoil", effects = (
+            AbilityEffect("damage", "self", ("self attack",),
+                          parameters = {"amount": 3}),)),
+        "lifesteal": Ability("lifesteal", "Lifesteal", effects = (
+            AbilityEffect("heal", "self", ("self post_attack",),
+                          parameters = {"relative": 0.5, "reference": "damage"}),)),
+        "cleave": Ability("cleave", "Cleave", effects = (
+            AbilityEffect("damage", "opponent_adjacent", ("self post_attack",),
+                          parameters = {"relative": 0.2, "reference": "damage"}),)),
+        "death_aoe": Ability("death_aoe", "Disease Cloud", effects = (
+            AbilityEffect("damage", "all", ("self death",),
+                          parameters = {"amount": 2}),)),
+        "long_range": Ability("long_range", "Long Range", effects = (
+            AbilityEffect("damage", "opponent", ("friend_others post_attack",),
+                          parameters = {"amount": 2}),)),
+        "thorns": Ability("thorns", "Thorns", effects = (
+            AbilityEffect("damage", "opponent", ("self defend",),
+                          parameters = {"amount": 3, "type": types["dummy"]}),)),
+        "mourning": Ability("mourning", "Mourning", effects = (
+            AbilityEffect("heal", "self_adjacent", ("friend_others death",),
+                          parameters = {"amount": 4}),))
+    })
+
+    pool = [species["dummy"], species["normal"], species["resistant"],
+            species["weak"]]
+    for i, name in enumerate(("recoil", "lifesteal", "cleave", "death_aoe",
+                              "long_range", "thorns", "mourning")):
+        pool.append(UnitTemplate(name, name, types[("normal", "resistant",
+                                 "weak", "dummy")[i % 4]], 14 + i, 8 + i % 4,
+                                 8 + i % 3, (abilities[name],)))
+
+    rng = Random(42)
+    max_rounds = 30
+    battles = []
+    for _ in xrange(200):
+        battles.append(tuple(tuple(UnitInstance(rng.choice(pool))
+                                   for _ in xrange(rng.randint(1, 4)))
+                             for _ in xrange(2)))
+    actions = numpy.random.RandomState(42).randint(0, 3, (len(battles),
+                                                          max_rounds, 2))
+
+    kernel = LockstepBattles(battles, max_rounds = max_rounds, tie_break = 1)
+    kernel.run(lambda k: actions[k._rows, numpy.minimum(k.round,
+                                                        max_rounds) - 1])
+
+    def request_actions(engine):
+        r = engine.mechanics.round - 1
+        for i in xrange(2):
+            engine.set_action(ACTIONS[actions[b, r, i]], i)
+
+    stdout = sys.stdout
+    try:
+        sys.stdout = StringIO()
+        reference = BattleEngine()
+        reference.on.request_input.sub(request_actions)
+        for b in xrange(len(battles)):
+            reference.set_battle(battles[b])
+            reference.mechanics.tie_break = 1
+            units = [list(team.units) for team in reference.mechanics.teams]
+            while (reference.state != "end"
+                   and reference.mechanics.round <= max_rounds):
+                reference.step()
+            alive = [t.index for t in reference.mechanics.teams if t.alive]
+            winner = alive[0] if reference.state == "end" and len(alive) == 1 else -1
+            assert kernel.winners[b] == winner
+            assert kernel.round[b] == reference.mechanics.round
+            for t in xrange(2):
+                for u in xrange(len(units[t])):
+                    assert kernel.health[b, t, u] == units[t][u].health
+    finally:
+        sys.stdout = stdout
+
+    print "> OK"
@@ -0,0 +1,281 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Pairwise win-rate matrix between team compositions.
+# Usage: python -m obminion matrix -o matrix.csv --max-size 2 -n 200
+# Rows are appended as chunks finish; rerunning with the same output file
+# resumes the matrix, skipping every cell that is already on disk.
+# Battle j of cell (a, b) is seeded with spawn_seed(seed, a, b, j), so every
+# battle in the matrix can be replayed on its own. The root seed is stored
+# on the first line of the file, and a resumed run picks it up from there.
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from .content import SPECIES
+from .engine.mechanics import spawn_seed
+from .simulator import BattleSimulator, SimulationResult, POLICIES, \
+                       make_listing, init_worker
+
+
+HEADER = ("team_a", "team_b", "battles", "wins_a", "wins_b", "draws", "rounds")
+SEED_PREFIX = "# seed "
+
+###############################################################################
+#   Matchup Enumeration
+###############################################################################
+
+def compositions(species, max_size, ordered = False):
+    """Yield every team of 1 to `max_size` units. Unless `ordered` is set,
+    teams that only differ in slot order are generated once."""
+    species = sorted(species)
+    for size in xrange(1, max_size + 1):
+        if ordered:
+            teams = itertools.product(species, repeat = size)
+        else:
+            teams = itertools.combinations_with_replacement(species, size)
+        for team in teams:
+            yield team
+
+
+def matchups(teams):
+    """Yield each unordered pair of teams once; (b, a) mirrors (a, b)."""
+    teams = list(teams)
+    for i in xrange(len(teams)):
+        for j in xrange(i, len(teams)):
+            yield teams[i], teams[j]
+
+
+def team_key(team):
+    return ",".join(team)
+
+
+###############################################################################
+#   Matrix Runner
+###############################################################################
+
+def run_cells(args):
+    """Worker entry point: simulate every cell in a chunk."""
+    cells, policies, battles, max_rounds, seed = args
+    simulator = BattleSimulator(policies, max_rounds = max_rounds)
+    rows = []
+    for a, b in cells:
+        result = SimulationResult(2)
+        for j in xrange(battles):
+            winner = simulator.run((make_listing(a), make_listing(b)),
+                                   seed = spawn_seed(seed, team_key(a),
+                                                     team_key(b), j))
+            result.add(winner, simulator.engine.mechanics.round)
+        rows.append((team_key(a), team_key(b), result.battles,
+                     result.wins[0], result.wins[1], result.draws,
+                     result.rounds))
+    return rows
+
+
+def read_rows(path):
+    """Yield the complete result rows stored in `path`. A line cut short by
+    an interrupted run is skipped, so that cell is simulated again (and
+    open_output cuts it off)."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith("\n") or line.startswith("#"):
+                continue
+            row = next(csv.reader((line,)), None)
+            if row is None or len(row) != len(HEADER) or tuple(row) == HEADER:
+                continue
+            try:
+                counts = [int(value) for value in row[2:]]
+            except ValueError:
+                continue
+            yield row[0], row[1], counts
+
+
+def load_done(path):
+    return set((a, b) for a, b, _ in read_rows(path))
+
+
+def read_seed(path):
+    """The root seed stored in the header of `path`, or None."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        line = f.readline()
+    if not (line.startswith(SEED_PREFIX) and line.endswith("\n")):
+        return None
+    try:
+        return int(line[len(SEED_PREFIX):])
+    except ValueError:
+        return None
+
+
+def resume_seed(path, seed = None):
+    """The root seed to run `path` with. A new file gets `seed`, or a
+    random one; an existing file keeps the seed it was started with.
+    Raises ValueError if `seed` differs from the stored one, or if a file
+    without a stored seed is resumed without one."""
+    stored = read_seed(path)
+    if stored is None:
+        if seed is None:
+            if load_done(path):
+                raise ValueError("{} does not record its seed; resume it "
+                                 "with --seed".format(path))
+            seed = random.SystemRandom().getrandbits(60)
+        return seed
+    if not seed is None and seed != stored:
+        raise ValueError("{} was started with seed {}, not {}".format(
+                         path, stored, seed))
+    return stored
+
+
+def open_output(path, seed = None):
+    """Open `path` to append rows, writing the header (and `seed`, if
+    given) to a new file. A line cut short by an interrupted run is
+    truncated first."""
+    f = open(path, "r+b" if os.path.exists(path) else "w+b")
+    f.seek(0, os.SEEK_END)
+    size = end = f.tell()
+    # look back for the last complete line, a block at a time
+    while end > 0:
+        start = max(0, end - 4096)
+        f.seek(start)
+        i = f.read(end - start).rfind("\n")
+        if i >= 0:
+            end = start + i + 1
+            break
+        end = start
+    if end < size:
+        f.truncate(end)
+    f.seek(end)
+    if end == 0:
+        if not seed is None:
+            f.write("{}{}\n".format(SEED_PREFIX, seed))
+        csv.writer(f).writerow(HEADER)
+    return f
+
+
+def run_matrix(path, species, policies, battles, max_size = 1, ordered = False,
+               jobs = None, chunk_size = 16, max_rounds = 100, seed = None,
+               out = None):
+    out = out or sys.stdout
+    seed = resume_seed(path, seed)
+    done = load_done(path)
+    cells = list(matchups(compositions(species, max_size, ordered = ordered)))
+    total = len(cells)
+    cells = [(a, b) for a, b in cells
+             if not (team_key(a), team_key(b)) in done]
+    skipped = total - len(cells)
+    chunks = [(cells[i:i + chunk_size], policies, battles, max_rounds, seed)
+              for i in xrange(0, len(cells), chunk_size)]
+    out.write("{} cells, {} already done, {} to run, seed {}\n".format(
+              total, skipped, len(cells), seed))
+    jobs = jobs or multiprocessing.cpu_count()
+    start = time.time()
+    completed = 0
+    f = open_output(path, seed)
+    writer = csv.writer(f)
+    pool = multiprocessing.Pool(jobs, initializer = init_worker)
+    try:
+        for rows in pool.imap_unordered(run_cells, chunks):
+            writer.writerows(rows)
+            f.flush()
+            completed += len(rows)
+            elapsed = time.time() - start
+            out.write("\r{}/{} cells, {:.1f} battles/sec".format(
+                      skipped + completed, total,
+                      completed * battles / elapsed if elapsed else 0.0))
+            out.flush()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        f.close()
+        out.write("\n")
+    return completed
+
+
+def load_matrix(path):
+    """Read a matrix file into {(team_a, team_b): win rate of team_a},
+    filling in the mirrored cells."""
+    matrix = {}
+    for a, b, counts in read_rows(path):
+        battles, wins_a, wins_b = counts[0], counts[1], counts[2]
+        if battles:
+            matrix[(a, b)] = wins_a / float(battles)
+            matrix[(b, a)] = wins_b / float(battles)
+    return matrix
+
+
+###############################################################################
+#   Command Line
+###############################################################################
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "obminion matrix",
+                                     description = "Pairwise win-rate matrix.")
+    parser.add_argument("-o", "--output", default = "matrix.csv",
+                        help = "results file; existing cells are skipped")
+    parser.add_argument("-s", "--species", action = "append",
+                        choices = sorted(SPECIES.keys()),
+                        help = "species to include (default: all)")
+    parser.add_argument("--max-size", type = int, default = 1,
+                        help = "largest team size to enumerate")
+    parser.add_argument("--ordered", action = "store_true",
+                        help = "treat slot order as part of a composition")
+    parser.add_argument("-p", "--policy", default = "attack",
+                        choices = sorted(POLICIES.keys()))
+    parser.add_argument("-n", "--battles", type = int, default = 100,
+                        help = "battles per cell")
+    parser.add_argument("-j", "--jobs", type = int, default = 0,
+                        help = "worker processes (default: all cores)")
+    parser.add_argument("--chunk-size", type = int, default = 16,
+                        help = "cells per worker task")
+    parser.add_argument("--max-rounds", type = int, default = 100)
+    parser.add_argument("--seed", type = int,
+                        help = "root seed of the matrix (default: the one "
+                               "stored in the output file, or random)")
+    args = parser.parse_args(argv)
+    if not 1 <= args.max_size <= 4:
+        parser.error("--max-size must be between 1 and 4")
+    return args
+
+
+def main(argv = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    policy = POLICIES[args.policy]
+    try:
+        seed = resume_seed(args.output, args.seed)
+    except ValueError as error:
+        sys.stderr.write("obminion matrix: error: {}\n".format(error))
+        return 2
+    run_matrix(args.output, args.species or SPECIES.keys(), (policy, policy),
+               args.battles, max_size = args.max_size, ordered = args.ordered,
+               jobs = args.jobs, chunk_size = args.chunk_size,
+               max_rounds = args.max_rounds, seed = seed)
+    return 0
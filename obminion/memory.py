@@ -0,0 +1,184 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Memory footprint of the combat model.
+# Usage: python -m obminion memory [-n 10000]
+# The model classes use __slots__. This compares their size against the
+# per-instance __dict__ layout they replaced, per battle and per million
+# units, and measures the resident size of `n` battles kept alive.
+
+import argparse
+import resource
+import sys
+
+from .engine.models import UnitInstance, BattleUnit, BattleTeam, Attribute, \
+                           AbilityEffect
+from .engine.mechanics import BattleEngine
+from .content import ABILITIES
+from .simulator import DEFAULT_TEAMS, make_listing
+
+
+MODELS = (BattleTeam, BattleUnit, UnitInstance, Attribute, AbilityEffect)
+
+###############################################################################
+#   Object Sizes
+###############################################################################
+
+class _Plain(object):
+    pass
+
+
+def slotted_size(obj):
+    return sys.getsizeof(obj)
+
+
+def dict_size(obj):
+    """Size of `obj` laid out as a plain class: the instance itself plus
+    an instance dictionary with the same attributes."""
+    attributes = {}
+    for name in type(obj).__slots__:
+        if name != "__weakref__" and hasattr(obj, name):
+            attributes[name] = getattr(obj, name)
+    return sys.getsizeof(_Plain()) + sys.getsizeof(attributes)
+
+
+def battle_units(engine):
+    return [unit for team in engine.mechanics.teams
+            for unit in team.units + team.grave]
+
+
+def battle_objects(engine):
+    """Model objects created for each battle; ability effects are shared
+    content and are counted apart."""
+    for team in engine.mechanics.teams:
+        yield team
+    for unit in battle_units(engine):
+        for obj in unit_objects(unit):
+            yield obj
+
+
+def effect_objects():
+    return [effect for ability in ABILITIES.values()
+            for effect in ability.effects]
+
+
+def unit_objects(unit):
+    return (unit, unit.instance, unit.max_health, unit.power, unit.speed)
+
+
+class Footprint(object):
+    def __init__(self):
+        self.count      = dict((cls, 0) for cls in MODELS)
+        self.slotted    = dict((cls, 0) for cls in MODELS)
+        self.plain      = dict((cls, 0) for cls in MODELS)
+
+    def add(self, objects):
+        for obj in objects:
+            cls = type(obj)
+            self.count[cls] += 1
+            self.slotted[cls] += slotted_size(obj)
+            self.plain[cls] += dict_size(obj)
+        return self
+
+    @property
+    def total_slotted(self):
+        return sum(self.slotted.values())
+
+    @property
+    def total_plain(self):
+        return sum(self.plain.values())
+
+
+###############################################################################
+#   Benchmark
+###############################################################################
+
+def new_battle(teams = DEFAULT_TEAMS):
+    engine = BattleEngine(seed = 0)
+    engine.set_battle([make_listing(team) for team in teams])
+    return engine
+
+
+def resident_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure_battles(n):
+    """Growth of the resident set (KB) while `n` battles are kept alive."""
+    before = resident_kb()
+    battles = [new_battle() for _ in xrange(n)]
+    after = resident_kb()
+    del battles
+    return after - before
+
+
+def report(battles, out = None):
+    out = out or sys.stdout
+    engine = new_battle()
+    footprint = Footprint().add(battle_objects(engine))
+    effects = Footprint().add(effect_objects())
+    out.write("{:<14}{:>7}{:>10}{:>10}{:>8}\n".format(
+              "class", "count", "slotted", "__dict__", "saved"))
+    for cls in MODELS:
+        # ability effects: every one in the content, not just this battle's
+        counted = effects if cls is AbilityEffect else footprint
+        if counted.count[cls]:
+            out.write("{:<14}{:>7}{:>10}{:>10}{:>7.0%}\n".format(
+                      cls.__name__, counted.count[cls], counted.slotted[cls],
+                      counted.plain[cls],
+                      1.0 - counted.slotted[cls] / float(counted.plain[cls])))
+    out.write("per battle:  {} bytes, {} with __dict__, {} saved\n".format(
+              footprint.total_slotted, footprint.total_plain,
+              footprint.total_plain - footprint.total_slotted))
+    # averaged over every unit of the battle, whatever its species
+    units = battle_units(engine)
+    unit = Footprint().add(obj for u in units for obj in unit_objects(u))
+    scale = 1e6 / len(units) / 2 ** 20
+    out.write("per million units: {:.1f} MB, {:.1f} MB with __dict__, "
+              "{:.1f} MB saved\n".format(unit.total_slotted * scale,
+                                        unit.total_plain * scale,
+                                        (unit.total_plain - unit.total_slotted)
+                                        * scale))
+    out.write("shared ability effects: {} bytes, {} with __dict__\n".format(
+              effects.total_slotted, effects.total_plain))
+    if battles:
+        grown = measure_battles(battles)
+        out.write("resident growth for {} battles: {} KB ({:.0f} bytes "
+                  "per battle, engine included)\n".format(
+                  battles, grown, grown * 1024.0 / battles))
+
+
+###############################################################################
+#   Command Line
+###############################################################################
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "obminion memory",
+                                     description = "Combat model footprint.")
+    parser.add_argument("-n", "--battles", type = int, default = 10000,
+                        help = "battles to keep alive for the resident "
+                               "size measurement (0 to skip)")
+    return parser.parse_args(argv)
+
+
+def main(argv = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    report(args.battles)
+    return 0
@@ -18,81 +18,46 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 
+import os
+from functools import partial
+
 import pygame as pg
 
-from .engine.models import UnitTemplate, UnitInstance, UnitType, Ability, AbilityEffect
+from .engine.models import UnitInstance
 from .engine.mechanics import BattleEngine
+from .engine.search import ParallelSearch
+from .replay import BattleRecorder, open_archive, write_replay
 from .view.battle import BattleScene
 from .view.overworld import OverworldScene
 from .view.sprites import Spritesheet, ImageSequence, MultiPoseSprite
 from .view.widgets import HighlightWidget
+from .view.assets import AssetManager, AssetStreamer, load_image
+from .view.atlas import Atlas
+from .view.pixels import PixelCache
+from .content import SPECIES, PLAYER, DUMMY, CACHE_DIR, store_cache
+from .timeline import Timeline, STARTUP
 
 
 SCREEN_WIDTH = 640
 SCREEN_HEIGHT = 480
+REPLAY_ARCHIVE = "replays.obr"  # every battle played is appended here
+ASSET_BUDGET = 16 << 20         # bytes of released images kept cached
+STREAM_SLICE = 0.004            # seconds per frame spent converting images
+ATLAS_INDEX = "images/atlas.json"   # built by "python -m obminion atlas"
 
-###############################################################################
-# Temporary hard-coded data
-
-TYPES = {
-    "dummy": UnitType("dummy", "Dummy Type"),
-    "normal": UnitType("normal", "Normal"),
-    "resistant": UnitType("resistant", "Resistant", resistances = ("dummy",)),
-    "weak": UnitType("weak", "Weak", weaknesses = ("dummy",))
-}
-
-ABILITIES = {
-    "none": Ability("none", "Do Nothing"),
-    "log": Ability("log", "Log Ability",
-                   effects = (AbilityEffect("log", "self", ("self attack", "opponent defend")),)),
-    "recoil": Ability("recoil", "Recoil", effects = (
-                      AbilityEffect("damage", "self", ("self attack",),
-                                    parameters = {"amount": 3}),)),
-    "lifesteal": Ability("lifesteal", "Lifesteal", effects = (
-                         AbilityEffect("heal", "self", ("self post_attack",),
-                                       parameters = {"relative": 0.5, "reference": "damage"}),)),
-    "cleave": Ability("cleave", "Cleave", effects = (
-                         AbilityEffect("damage", "opponent_adjacent", ("self post_attack",),
-                                       parameters = {"relative": 0.2, "reference": "damage"}),)),
-    "death_aoe": Ability("death_aoe", "Disease Cloud", effects = (
-                         AbilityEffect("damage", "all", ("self death",),
-                                       parameters = {"amount": 2}),)),
-    "long_range": Ability("long_range", "Long Range", effects = (
-                         AbilityEffect("damage", "opponent", ("friend_others post_attack",),
-                                       parameters = {"amount": 2}),))
-}
-
-SPECIES = {
-    "dummy": UnitTemplate("0000", "Target Dummy", TYPES["dummy"], 20, 10, 10, (ABILITIES["none"],)),
-    "normal": UnitTemplate("0001", "Normal Tester", TYPES["normal"], 20, 10, 12, ()),
-    "resistant": UnitTemplate("0002", "Resistant Tester", TYPES["resistant"], 20, 10, 12, ()),
-    "weak": UnitTemplate("0003", "Weak Tester", TYPES["weak"], 20, 10, 12, ()),
-    "logger": UnitTemplate("0004", "Logger", TYPES["normal"], 10, 10, 12,
-                           (ABILITIES["log"],)),
-    "double-edge": UnitTemplate("0005", "Double-Edge", TYPES["normal"], 16, 18, 12,
-                                (ABILITIES["recoil"],)),
-    "lifesteal": UnitTemplate("0006", "Vampire", TYPES["normal"], 16, 10, 8,
-                                (ABILITIES["lifesteal"],)),
-    "cleave": UnitTemplate("0007", "Brutal Warrior", TYPES["normal"], 20, 10, 8,
-                                (ABILITIES["cleave"],)),
-    "abomination": UnitTemplate("0008", "Abomination", TYPES["normal"], 16, 12, 8,
-                                (ABILITIES["death_aoe"],)),
-    "footman": UnitTemplate("0009", "Footman", TYPES["normal"], 20, 10, 10,
-                                (ABILITIES["none"],)),
-    "bowman": UnitTemplate("0010", "Bowman", TYPES["normal"], 14, 12, 10,
-                                (ABILITIES["long_range"],))
-}
-
-PLAYER = (UnitInstance(SPECIES["lifesteal"]), UnitInstance(SPECIES["double-edge"]),
-          UnitInstance(SPECIES["cleave"]), UnitInstance(SPECIES["abomination"]))
-DUMMY = (UnitInstance(SPECIES["dummy"]), UnitInstance(SPECIES["dummy"]),
-         UnitInstance(SPECIES["dummy"]), UnitInstance(SPECIES["dummy"]))
-###############################################################################
 
 class GameData(object):
-    def __init__(self):
+    def __init__(self, asset_budget = ASSET_BUDGET):
         self.player_team = PLAYER
         self.enemy_team = DUMMY
+        # decoded images are kept next to the content cache
+        self.pixels = PixelCache(os.path.join(CACHE_DIR, "pixels")) \
+                      if CACHE_DIR else None
+        self.assets = AssetManager(budget = asset_budget,
+                                   atlas = Atlas.load(ATLAS_INDEX),
+                                   loader = self.pixels.load if self.pixels
+                                            else load_image)
+        self.streamer = AssetStreamer(self.assets, pixels = self.pixels)
 
 
 class State(object):
@@ -109,6 +74,11 @@ class State(object):
     def startup(self):
         pass
 
+    def shutdown(self):
+        """Called once when the game exits, whether or not the state is
+        the current one."""
+        pass
+
     def get_event(self, event):
         pass
 
@@ -118,6 +88,25 @@ class State(object):
     def draw(self, screen):
         pass
 
+    def image(self, path, mode = "convert"):
+        """Acquire a shared image, held for as long as the state lives."""
+        return self.shared_data.assets.acquire(path, mode, owner = self)
+
+    def request_images(self):
+        """Decode the images of the game states in the background."""
+        self.shared_data.streamer.request(Overworld.IMAGES + Battle.IMAGES)
+
+    def stream_images(self):
+        """Convert this frame's share of the decoded images."""
+        self.shared_data.streamer.update(STREAM_SLICE)
+
+
+def draw_progress(screen, progress, colour = (255, 255, 255)):
+    rect = pg.Rect(SCREEN_WIDTH // 4, SCREEN_HEIGHT - 48, SCREEN_WIDTH // 2, 8)
+    pg.draw.rect(screen, colour, rect, 1)
+    rect.width = int(rect.width * progress)
+    screen.fill(colour, rect)
+
 
 class StartScreen(State):
     def __init__(self, shared_data):
@@ -126,6 +115,7 @@ class StartScreen(State):
 
     def startup(self):
         print "> Start Screen"
+        self.request_images()
 
     def get_event(self, event):
         if event.type == pg.KEYDOWN:
@@ -136,17 +126,23 @@ class StartScreen(State):
         elif event.type == pg.MOUSEBUTTONDOWN:
             self.done = True
 
+    def update(self, dt):
+        self.stream_images()
+
     def draw(self, screen):
         screen.fill((255, 51, 51))
+        if not self.shared_data.streamer.done:
+            draw_progress(screen, self.shared_data.streamer.progress)
 
 
 class MainMenu(State):
     def __init__(self, shared_data):
         State.__init__(self, shared_data)
-        self.next = "overworld"
+        self.next = "loading"
 
     def startup(self):
         print "> Main Menu"
+        self.request_images()
 
     def get_event(self, event):
         if event.type == pg.KEYDOWN:
@@ -157,45 +153,93 @@ class MainMenu(State):
         elif event.type == pg.MOUSEBUTTONDOWN:
             self.done = True
 
+    def update(self, dt):
+        self.stream_images()
+
     def draw(self, screen):
         screen.fill((192, 192, 192))
+        if not self.shared_data.streamer.done:
+            draw_progress(screen, self.shared_data.streamer.progress)
+
+
+class Loading(State):
+    """Waits for the streamed images, unless they are ready already."""
+    def __init__(self, shared_data):
+        State.__init__(self, shared_data)
+        self.next = "overworld"
+
+    def startup(self):
+        print "> Loading"
+        self.request_images()
+
+    def get_event(self, event):
+        if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
+            self.quit = True
+
+    def update(self, dt):
+        self.stream_images()
+        if self.shared_data.streamer.done:
+            self.done = True
+
+    def draw(self, screen):
+        screen.fill((24, 24, 24))
+        draw_progress(screen, self.shared_data.streamer.progress)
 
 
 class Overworld(State):
+    # streamed ahead of _build_scene
+    IMAGES = (
+        ("images/overworld_map.jpg", "convert"),
+        ("images/dummy.png", "convert"),
+        ("images/pyro.png", "convert"),
+        ("images/vampire.png", "convert"),
+        ("images/pitlord.png", "convert"),
+        ("images/abomination.png", "convert"),
+        ("images/footman.png", "convert"),
+        ("images/bowman.png", "convert"),
+        ("images/highlight_circle.png", "convert_alpha"),
+        ("images/portrait_simple.png", "convert_alpha"),
+        ("images/mission_panel.png", "convert_alpha"),
+        ("images/button_close.png", "convert_alpha"),
+        ("images/battle_button_frame.png", "convert_alpha")
+    )
+
     def __init__(self, shared_data):
         State.__init__(self, shared_data)
         self.next = None
         self._waiting_for_mission = False
+        self.missions = {
+            "hold": (UnitInstance(SPECIES["footman"]),
+                     UnitInstance(SPECIES["footman"]),
+                     UnitInstance(SPECIES["footman"]),
+                     UnitInstance(SPECIES["bowman"]))
+        }
+        # built once, with its images and fonts, and reused on every visit
+        self._build_scene()
 
+    def _build_scene(self):
         image_bank = {
-            "durotar": pg.image.load("images/overworld_map.jpg").convert()
+            "durotar": self.image("images/overworld_map.jpg")
         }
         animation_bank = MultiPoseSprite()
-        dummy_pic = pg.image.load("images/dummy.png").convert()
+        dummy_pic = self.image("images/dummy.png")
         sprite_bank = {
             "0000": dummy_pic,
             "0001": dummy_pic,
             "0002": dummy_pic,
             "0003": dummy_pic,
             "0004": dummy_pic,
-            "0005": pg.image.load("images/pyro.png").convert(),
-            "0006": pg.image.load("images/vampire.png").convert(),
-            "0007": pg.image.load("images/pitlord.png").convert(),
-            "0008": pg.image.load("images/abomination.png").convert(),
-            "0009": pg.image.load("images/footman.png").convert(),
-            "0010": pg.image.load("images/bowman.png").convert()
+            "0005": self.image("images/pyro.png"),
+            "0006": self.image("images/vampire.png"),
+            "0007": self.image("images/pitlord.png"),
+            "0008": self.image("images/abomination.png"),
+            "0009": self.image("images/footman.png"),
+            "0010": self.image("images/bowman.png")
         }
 
         common_font = pg.font.Font("OxygenMono-Regular.ttf", 12)
-        highlight = pg.image.load("images/highlight_circle.png").convert_alpha()
-        icon_combat = pg.image.load("images/overworld_button_combat.png").convert_alpha()
-        portrait_frame = pg.image.load("images/portrait_simple.png").convert_alpha()
-        self.missions = {
-            "hold": (UnitInstance(SPECIES["footman"]),
-                     UnitInstance(SPECIES["footman"]),
-                     UnitInstance(SPECIES["footman"]),
-                     UnitInstance(SPECIES["bowman"]))
-        }
+        highlight = self.image("images/highlight_circle.png", "convert_alpha")
+        portrait_frame = self.image("images/portrait_simple.png", "convert_alpha")
         self.level_data = {
             "senjin": {
                 "name": "Sen'jin Village",
@@ -259,7 +303,7 @@ class Overworld(State):
                 "mission_panel": {
                     "x": 0,
                     "y": 0,
-                    "frame": pg.image.load("images/mission_panel.png").convert_alpha(),
+                    "frame": self.image("images/mission_panel.png", "convert_alpha"),
                     "title": {
                         "x": 75,
                         "y": 36,
@@ -270,13 +314,13 @@ class Overworld(State):
                         "cancel": {
                             "x": 353,
                             "y": 20,
-                            "icon": pg.image.load("images/button_close.png").convert_alpha()
+                            "icon": self.image("images/button_close.png", "convert_alpha")
                         }
                     },
                     "opponent": {
                         "x": 77,
                         "y": 314,
-                        "frame": pg.image.load("images/battle_button_frame.png").convert_alpha(),
+                        "frame": self.image("images/battle_button_frame.png", "convert_alpha"),
                         "picture": (98, 33, 64, 64),
                         "bg_colour": (24, 24, 24)
                     },
@@ -349,10 +393,8 @@ class Overworld(State):
         print "> Overworld / Level Selection"
         self.next = None
         self._waiting_for_mission = False
-        self.scene.set_map("durotar", self.level_data)
-
-    def cleanup(self):
         self.scene.reset()
+        self.scene.set_map("durotar", self.level_data)
 
     def get_event(self, event):
         if event.type == pg.KEYDOWN:
@@ -386,31 +428,64 @@ class Overworld(State):
                                        self.shared_data.enemy_team[0])
 
     def draw(self, screen):
-        self.scene.draw(screen)
+        return self.scene.render(screen)
 
 
 class Battle(State):
+    # streamed ahead of _build_scene
+    IMAGES = (
+        ("images/battle_bg2.jpg", "convert"),
+        ("images/rotation_sheet.png", "convert_alpha"),
+        ("images/portrait_frame4_lr.png", "convert_alpha"),
+        ("images/portrait_frame4_rl.png", "convert_alpha"),
+        ("images/portrait_frame_lg4_lr.png", "convert_alpha"),
+        ("images/portrait_frame_lg4_rl.png", "convert_alpha"),
+        ("images/type.png", "convert_alpha"),
+        ("images/panel_frame.png", "convert_alpha"),
+        ("images/action_panel.png", "convert_alpha"),
+        ("images/button_attack.png", "convert_alpha"),
+        ("images/button_rotate_counter.png", "convert_alpha"),
+        ("images/button_rotate_clock.png", "convert_alpha"),
+        ("images/button_surrender.png", "convert_alpha")
+    ) + tuple(("images/{}{}.png".format(name, size), "convert")
+              for name in ("dummy", "pyro", "vampire", "pitlord",
+                           "abomination", "footman", "bowman")
+              for size in ("", "_lg"))
+
     def __init__(self, shared_data):
         State.__init__(self, shared_data)
         self.next = "overworld"
         self.engine = BattleEngine()
-        self.bg_image = pg.image.load("images/battle_bg2.jpg").convert()
+        self.engine.on.battle_end.sub(self._on_battle_end)
+        self.engine.on.request_input.sub(self._on_input_request)
+        self.recorder = BattleRecorder(self.engine)
+        self._waiting_for_input = False
+        # shared by every battle; the worker pool starts on first use and
+        # lives until the game exits
+        self.enemy_ai = ParallelSearch(budget = 100)
+        self._enemy_action = None
+        # built once, with its images and fonts, and reused by every battle
+        self._build_scene()
+
+    def _build_scene(self):
+        self.bg_image = self.image("images/battle_bg2.jpg")
 
         animation_bank = MultiPoseSprite()
-        battle_animations = Spritesheet("images/rotation_sheet.png")
+        battle_animations = Spritesheet("images/rotation_sheet.png",
+                            self.image("images/rotation_sheet.png", "convert_alpha"))
         animation_bank.add_sprite("rotation_clock", ImageSequence(battle_animations,
                                   (0, 0, 128, 128), 4, 0.1))
         animation_bank.add_sprite("rotation_counter", ImageSequence(battle_animations,
                                   (0, 128, 128, 128), 4, 0.1))
 
         bar_colour = (0, 204, 0)
-        frame_l = pg.image.load("images/portrait_frame4_lr.png").convert_alpha()
-        frame_r = pg.image.load("images/portrait_frame4_rl.png").convert_alpha()
-        dummy_pic = pg.image.load("images/dummy.png").convert()
-        dummy_pic_lg = pg.image.load("images/dummy_lg.png").convert()
-        type_icon = pg.image.load("images/type.png").convert_alpha()
-        panel_frame = pg.image.load("images/panel_frame.png").convert_alpha()
-        action_panel = pg.image.load("images/action_panel.png").convert_alpha()
+        frame_l = self.image("images/portrait_frame4_lr.png", "convert_alpha")
+        frame_r = self.image("images/portrait_frame4_rl.png", "convert_alpha")
+        dummy_pic = self.image("images/dummy.png")
+        dummy_pic_lg = self.image("images/dummy_lg.png")
+        type_icon = self.image("images/type.png", "convert_alpha")
+        panel_frame = self.image("images/panel_frame.png", "convert_alpha")
+        action_panel = self.image("images/action_panel.png", "convert_alpha")
         common_font = pg.font.Font("OxygenMono-Regular.ttf", 12)
         sprite_bank = {
             "0000": dummy_pic,
@@ -423,18 +498,18 @@ class Battle(State):
             "0003_main": dummy_pic_lg,
             "0004": dummy_pic,
             "0004_main": dummy_pic_lg,
-            "0005": pg.image.load("images/pyro.png").convert(),
-            "0005_main": pg.image.load("images/pyro_lg.png").convert(),
-            "0006": pg.image.load("images/vampire.png").convert(),
-            "0006_main": pg.image.load("images/vampire_lg.png").convert(),
-            "0007": pg.image.load("images/pitlord.png").convert(),
-            "0007_main": pg.image.load("images/pitlord_lg.png").convert(),
-            "0008": pg.image.load("images/abomination.png").convert(),
-            "0008_main": pg.image.load("images/abomination_lg.png").convert(),
-            "0009": pg.image.load("images/footman.png").convert(),
-            "0009_main": pg.image.load("images/footman_lg.png").convert(),
-            "0010": pg.image.load("images/bowman.png").convert(),
-            "0010_main": pg.image.load("images/bowman_lg.png").convert(),
+            "0005": self.image("images/pyro.png"),
+            "0005_main": self.image("images/pyro_lg.png"),
+            "0006": self.image("images/vampire.png"),
+            "0006_main": self.image("images/vampire_lg.png"),
+            "0007": self.image("images/pitlord.png"),
+            "0007_main": self.image("images/pitlord_lg.png"),
+            "0008": self.image("images/abomination.png"),
+            "0008_main": self.image("images/abomination_lg.png"),
+            "0009": self.image("images/footman.png"),
+            "0009_main": self.image("images/footman_lg.png"),
+            "0010": self.image("images/bowman.png"),
+            "0010_main": self.image("images/bowman_lg.png"),
             "dummy": type_icon,
             "normal": type_icon,
             "resistant": type_icon,
@@ -449,7 +524,7 @@ class Battle(State):
                         "name": "portrait-0-0",
                         "x": 16 + 82 - 16,
                         "y": SCREEN_HEIGHT - 16 - 69 - 8 - 133,
-                        "frame": pg.image.load("images/portrait_frame_lg4_lr.png").convert_alpha(),
+                        "frame": self.image("images/portrait_frame_lg4_lr.png", "convert_alpha"),
                         "border": (5, 4, 4, 4),
                         "picture": (39, 2, 128, 128),
                         "icon": (4, 11, 32, 32),
@@ -519,7 +594,7 @@ class Battle(State):
                         "name": "portrait-1-0",
                         "x": SCREEN_WIDTH - 16 - 82 - (170 - 16),
                         "y": 16 + 69 + 8,
-                        "frame": pg.image.load("images/portrait_frame_lg4_rl.png").convert_alpha(),
+                        "frame": self.image("images/portrait_frame_lg4_rl.png", "convert_alpha"),
                         "border": (3, 4, 4, 4),
                         "picture": (3, 2, 128, 128),
                         "icon": (135, 87, 32, 32),
@@ -597,28 +672,28 @@ class Battle(State):
                         "attack": {
                             "x": 206,
                             "y": 15,
-                            "icon": pg.image.load("images/button_attack.png").convert_alpha(),
+                            "icon": self.image("images/button_attack.png", "convert_alpha"),
                             "border": (6, 9, 9, 9),
                             "description": "Attack the opponent"
                         },
                         "rotate_counter": {
                             "x": 132,
                             "y": 15,
-                            "icon": pg.image.load("images/button_rotate_counter.png").convert_alpha(),
+                            "icon": self.image("images/button_rotate_counter.png", "convert_alpha"),
                             "border": (6, 9, 9, 9),
                             "description": "Rotate counter-clockwise"
                         },
                         "rotate_clock": {
                             "x": 280,
                             "y": 15,
-                            "icon": pg.image.load("images/button_rotate_clock.png").convert_alpha(),
+                            "icon": self.image("images/button_rotate_clock.png", "convert_alpha"),
                             "border": (6, 9, 9, 9),
                             "description": "Rotate clockwise"
                         },
                         "surrender": {
                             "x": 354,
                             "y": 15,
-                            "icon": pg.image.load("images/button_surrender.png").convert_alpha(),
+                            "icon": self.image("images/button_surrender.png", "convert_alpha"),
                             "border": (6, 9, 9, 9),
                             "description": "Surrender to the opponent"
                         }
@@ -638,23 +713,33 @@ class Battle(State):
             }
         }
         self.scene = BattleScene(gx_config["battle_scene"], sprite_bank,
-                                 animation_bank)
-
-        self.engine.on.battle_start.sub(self.scene.on_battle_start)
-        self.engine.on.battle_attack.sub(self.scene.on_battle_attack)
-        self.engine.on.battle_between_rounds.sub(self.scene.on_between_rounds)
-
-        self.engine.on.battle_end.sub(self._on_battle_end)
-        self.engine.on.request_input.sub(self._on_input_request)
-        self._waiting_for_input = False
+                                 animation_bank, background = self.bg_image)
 
     def startup(self):
         print "> Battle"
         self.scene.reset()
+        self.engine.on.battle_start.sub(self.scene.on_battle_start)
+        self.engine.on.battle_attack.sub(self.scene.on_battle_attack)
+        self.engine.on.battle_between_rounds.sub(self.scene.on_between_rounds)
         self.engine.set_battle((self.shared_data.player_team,
                                 self.shared_data.enemy_team))
         self.scene.set_battle(self.engine)
 
+    def cleanup(self):
+        self.engine.on.battle_start.unsub(self.scene.on_battle_start)
+        self.engine.on.battle_attack.unsub(self.scene.on_battle_attack)
+        self.engine.on.battle_between_rounds.unsub(self.scene.on_between_rounds)
+        replay = self.recorder.replay()
+        if replay and replay.rounds:
+            f = open_archive(REPLAY_ARCHIVE)
+            try:
+                write_replay(f, replay)
+            finally:
+                f.close()
+
+    def shutdown(self):
+        self.enemy_ai.close()
+
     def get_event(self, event):
         if event.type == pg.KEYDOWN:
             if event.key == pg.K_RETURN or event.key == pg.K_SPACE:
@@ -667,49 +752,84 @@ class Battle(State):
     def update(self, dt):
         self.scene.update(dt)
         if self._waiting_for_input:
-            action = self.scene.get_player_input()
+            if self._enemy_action is None:
+                self._enemy_action = self.enemy_ai.poll()
+                if self._enemy_action:
+                    print "> Enemy AI:", self._enemy_action, "-", \
+                          self.enemy_ai.report()
+            # the player's choice stays pending until the enemy has decided
+            action = self._enemy_action and self.scene.get_player_input()
             if action:
                 self.engine.set_action(action, 0)
+                if action != "surrender":
+                    self.engine.set_action(self._enemy_action, 1)
+                self._enemy_action = None
                 self._waiting_for_input = False
-        if not self.scene.busy:
+        if not self.scene.busy and not self._waiting_for_input:
             self.engine.step()
 
     def draw(self, screen):
-        if self.bg_image:
-            screen.blit(self.bg_image, (0, 0))
-        else:
-            screen.fill((0,0,0))
-        self.scene.draw(screen)
+        return self.scene.render(screen)
 
     def _on_battle_end(self, engine):
         self.done = True
 
     def _on_input_request(self, engine):
+        self.enemy_ai.start(engine, 1)
+        self._enemy_action = None
         self._waiting_for_input = True
         self.scene.request_player_input()
 
 
 class Control(object):
     def __init__(self, **settings):
+        self.trace = None
         self.__dict__.update(settings)
+        self.trace = self.trace or Timeline()
         self.done = False
-        self.screen = pg.display.set_mode(self.size)
+        with self.trace.span("display setup"):
+            self.screen = pg.display.set_mode(self.size)
         self.clock = pg.time.Clock()
+        self._started = set()
 
     def setup_states(self, state_dict, start_state):
+        """Map state names to states, or to factories that build the
+        state the first time it is entered."""
         self.state_dict = state_dict
         self.state_name = start_state
-        self.state = self.state_dict[self.state_name]
-        self.state.startup()
+        self.state = self.get_state(self.state_name)
+        self._startup()
+
+    def get_state(self, name):
+        state = self.state_dict[name]
+        if not isinstance(state, State):
+            with self.trace.span(name + " state"):
+                state = state()
+            self.state_dict[name] = state
+        return state
 
     def flip_state(self):
         self.state.done = False
         previous, self.state_name = self.state_name, self.state.next
         self.state.cleanup()
-        self.state = self.state_dict[self.state_name]
-        self.state.startup()
+        self.state = self.get_state(self.state_name)
+        self._startup()
         self.state.previous = previous
 
+    def _startup(self):
+        # the first startup of each state is timed
+        if self.state_name in self._started:
+            self.state.startup()
+        else:
+            self._started.add(self.state_name)
+            with self.trace.span(self.state_name + " startup"):
+                self.state.startup()
+
+    def shutdown(self):
+        for state in self.state_dict.itervalues():
+            if isinstance(state, State):
+                state.shutdown()
+
     def update(self, dt):
         if self.state.quit:
             self.done = True
@@ -725,6 +845,7 @@ class Control(object):
             self.state.get_event(event)
 
     def main_game_loop(self):
+        first_frame = True
         while not self.done:
             delta_time = self.clock.tick(self.fps)/1000.0
             self.event_loop()
@@ -733,24 +854,37 @@ class Control(object):
                 pg.display.update()
             else:
                 pg.display.update(dirty)
+            if first_frame:
+                first_frame = False
+                self.trace.mark("first frame")
+                if self.trace.out:
+                    self.trace.report(self.trace.out)
 
 
 
 def main():
     settings = {
         "size": (SCREEN_WIDTH, SCREEN_HEIGHT),
-        "fps" : 30
+        "fps" : 30,
+        "trace": STARTUP
     }
 
-    pg.init()
+    with STARTUP.span("content cache"):
+        store_cache()
+    with STARTUP.span("pg.init"):
+        pg.init()
     app = Control(**settings)
     shared_data = GameData()
     state_dict = {
-        "start":        StartScreen(shared_data),
-        "main_menu":    MainMenu(shared_data),
-        "overworld":    Overworld(shared_data),
-        "battle":       Battle(shared_data)
+        "start":        partial(StartScreen, shared_data),
+        "main_menu":    partial(MainMenu, shared_data),
+        "loading":      partial(Loading, shared_data),
+        "overworld":    partial(Overworld, shared_data),
+        "battle":       partial(Battle, shared_data)
     }
     app.setup_states(state_dict, "start")
-    app.main_game_loop()
-    pg.quit()
+    try:
+        app.main_game_loop()
+    finally:
+        app.shutdown()
+        pg.quit()
@@ -0,0 +1,283 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Compact binary battle replays.
+# Usage: python -m obminion replay battles.obr [more.obr ...]
+# A replay holds the initial team listings, the battle seed and the
+# BattleEngine.set_action calls, a byte each. Playing it back through a
+# headless engine re-executes the battle exactly, so statistics can be
+# derived later from an archive of replays instead of event logs.
+#
+# Archive layout: MAGIC, then one record per battle:
+#   flags (bit 0: deferred), seed, max_cascade, number of teams
+#   per team: number of units, then per unit
+#       level, experience, health, power, speed, template id, ability id
+#   number of calls, then one byte per set_action call:
+#       bit 7 set on the last call for an input request, bits 2-6 the
+#       team index, bits 0-1 the action
+
+import argparse
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+
+from .engine.models import UnitInstance
+from .engine.mechanics import BattleEngine
+from .engine.search import NullWriter
+from .content import SPECIES, ABILITIES
+
+
+MAGIC = "OBR\x01"
+
+ACTIONS = ("attack", "rotate_clock", "rotate_counter", "surrender")
+ACTION_CODES = dict((action, i) for i, action in enumerate(ACTIONS))
+LAST = 0x80
+
+_battle = struct.Struct("<BQBB")
+_unit   = struct.Struct("<BHHHH")
+_count  = struct.Struct("<I")
+
+# teams: tuple of UnitInstance tuples
+# rounds: per input request, a tuple of (team index, action) calls
+Replay = namedtuple("Replay", ("seed", "teams", "rounds", "deferred",
+                               "max_cascade"))
+
+###############################################################################
+#   Encoding
+###############################################################################
+
+def _string(text):
+    return chr(len(text)) + text
+
+def encode_replay(replay):
+    parts = [_battle.pack(1 if replay.deferred else 0, replay.seed,
+                          replay.max_cascade, len(replay.teams))]
+    for team in replay.teams:
+        parts.append(chr(len(team)))
+        for unit in team:
+            parts.append(_unit.pack(unit.level, unit.xp, unit.health,
+                                    unit.power, unit.speed))
+            parts.append(_string(unit.template.id))
+            parts.append(_string(unit.ability.id if unit.ability else ""))
+    calls = []
+    for calls_made in replay.rounds:
+        for team, action in calls_made:
+            calls.append((team << 2) | ACTION_CODES[action])
+        calls[-1] |= LAST
+    parts.append(_count.pack(len(calls)))
+    parts.append("".join([chr(call) for call in calls]))
+    return "".join(parts)
+
+
+def decode_replay(data, offset = 0, templates = None, abilities = None):
+    """Decode the record at `offset`. Returns (replay, end offset).
+    Templates and abilities are looked up by id, in the game content by
+    default."""
+    templates = templates or TEMPLATES
+    abilities = abilities or ABILITIES
+    flags, seed, max_cascade, num_teams = _battle.unpack_from(data, offset)
+    offset += _battle.size
+    teams = []
+    for _ in xrange(num_teams):
+        num_units = ord(data[offset])
+        offset += 1
+        team = []
+        for _ in xrange(num_units):
+            level, xp, health, power, speed = _unit.unpack_from(data, offset)
+            offset += _unit.size
+            template, offset = _read_string(data, offset)
+            ability, offset = _read_string(data, offset)
+            team.append(UnitInstance(templates[template], level = level,
+                                     experience = xp, health = health,
+                                     power = power, speed = speed,
+                                     ability = abilities[ability]
+                                               if ability else None))
+        teams.append(tuple(team))
+    num_calls = _count.unpack_from(data, offset)[0]
+    offset += _count.size
+    rounds = []
+    calls_made = []
+    for call in bytearray(data[offset:offset + num_calls]):
+        calls_made.append(((call & ~LAST) >> 2, ACTIONS[call & 3]))
+        if call & LAST:
+            rounds.append(tuple(calls_made))
+            calls_made = []
+    if calls_made:
+        raise ValueError("replay ends in the middle of an input request")
+    offset += num_calls
+    return Replay(seed, tuple(teams), tuple(rounds), bool(flags & 1),
+                  max_cascade), offset
+
+
+def _read_string(data, offset):
+    n = ord(data[offset])
+    return data[offset + 1:offset + 1 + n], offset + 1 + n
+
+
+TEMPLATES = dict((template.id, template) for template in SPECIES.values())
+
+
+###############################################################################
+#   Archives
+###############################################################################
+
+def open_archive(path):
+    """Open a replay archive for appending, creating it if needed."""
+    exists = os.path.exists(path) and os.path.getsize(path) > 0
+    f = open(path, "ab")
+    if not exists:
+        f.write(MAGIC)
+    return f
+
+
+def write_replay(f, replay):
+    f.write(encode_replay(replay))
+
+
+def read_replays(path, templates = None, abilities = None):
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("not a replay archive: " + path)
+    offset = len(MAGIC)
+    while offset < len(data):
+        replay, offset = decode_replay(data, offset, templates = templates,
+                                       abilities = abilities)
+        yield replay
+
+
+###############################################################################
+#   Recording
+###############################################################################
+
+class BattleRecorder(object):
+    """Records the battles of an engine; replay() returns the one in
+    progress or last played, or None before any battle started."""
+    def __init__(self, engine):
+        self.engine = engine
+        self._teams = None
+        self._calls = []    # (round, team index, action)
+        engine.on.battle_start.sub(self._on_battle_start)
+        engine.on.action.sub(self._on_action)
+
+    def replay(self):
+        if self._teams is None:
+            return None
+        rounds = []
+        current = None
+        for round, team, action in self._calls:
+            if round != current:
+                rounds.append([])
+                current = round
+            rounds[-1].append((team, action))
+        engine = self.engine
+        return Replay(engine.seed, self._teams,
+                      tuple([tuple(calls) for calls in rounds]),
+                      engine.deferred, engine.max_cascade)
+
+    def _on_battle_start(self, engine):
+        self._teams = tuple([tuple([unit.instance for unit in team.units])
+                             for team in engine.mechanics.teams])
+        self._calls = []
+
+    def _on_action(self, engine, team = None, action = None):
+        self._calls.append((engine.mechanics.round, team, action))
+
+
+###############################################################################
+#   Playback
+###############################################################################
+
+class ReplayPlayer(object):
+    """Re-executes replays through a BattleEngine with no view attached.
+    The engine is kept between replays with the same engine settings."""
+    def __init__(self):
+        self.engine = None
+        self.cut_off = False    # the battle stopped before it ended
+        self._settings = None
+        self._rounds = iter(())
+
+    def play(self, replay):
+        """Play a replay to its last call. Returns the engine."""
+        settings = (replay.deferred, replay.max_cascade)
+        if self.engine is None or settings != self._settings:
+            self.engine = BattleEngine(deferred = replay.deferred,
+                                       max_cascade = replay.max_cascade)
+            self.engine.on.request_input.sub(self._on_request_input)
+            self._settings = settings
+        engine = self.engine
+        self._rounds = iter(replay.rounds)
+        self.cut_off = False
+        stdout = sys.stdout
+        sys.stdout = NullWriter()   # the engine prints debug traces
+        try:
+            engine.set_battle(replay.teams, seed = replay.seed)
+            while engine.state != "end" and not self.cut_off:
+                engine.step()
+        finally:
+            sys.stdout = stdout
+        return engine
+
+    def winner(self, replay):
+        """Winning team index of the replay just played, or None."""
+        teams = self.engine.mechanics.teams
+        if replay.rounds and replay.rounds[-1][-1][1] == "surrender":
+            i = replay.rounds[-1][-1][0]
+            return 1 - i if len(teams) == 2 else None
+        alive = [team.index for team in teams if team.alive]
+        if not self.cut_off and len(alive) == 1:
+            return alive[0]
+        return None
+
+    def _on_request_input(self, engine):
+        calls = next(self._rounds, None)
+        if calls is None:
+            self.cut_off = True
+            return
+        for team, action in calls:
+            engine.set_action(action, team)
+
+
+###############################################################################
+#   Command Line
+###############################################################################
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "obminion replay",
+                                     description = "Headless replay player.")
+    parser.add_argument("archives", nargs = "+", help = "replay archives")
+    return parser.parse_args(argv)
+
+
+def main(argv = None):
+    from .simulator import SimulationResult
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    player = ReplayPlayer()
+    result = SimulationResult(2)
+    start = time.time()
+    for path in args.archives:
+        for replay in read_replays(path):
+            engine = player.play(replay)
+            result.add(player.winner(replay), engine.mechanics.round)
+    result.elapsed = time.time() - start
+    result.report()
+    return 0
@@ -0,0 +1,309 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Headless battle simulation.
+# Usage: python -m obminion simulate --team a,b,c --team d,e -n 10000
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from .engine.models import UnitInstance
+from .engine.mechanics import BattleEngine, spawn_seed
+from .engine.search import SearchPolicy
+from .content import SPECIES
+from .replay import BattleRecorder, encode_replay, open_archive
+
+
+DEFAULT_TEAMS = (
+    ("lifesteal", "double-edge", "cleave", "abomination"),
+    ("footman", "footman", "footman", "bowman")
+)
+
+###############################################################################
+#   Action Policies
+###############################################################################
+
+# A policy is any picklable callable policy(engine, team_index) -> action.
+# Policies that need randomness draw from engine.rng, so that a battle is
+# replayed exactly from its seed.
+
+def policy_attack(engine, i):
+    return "attack"
+
+def policy_rotate_clock(engine, i):
+    return "rotate_clock"
+
+def policy_rotate_counter(engine, i):
+    return "rotate_counter"
+
+def policy_random(engine, i):
+    if engine.mechanics.teams[i].can_rotate:
+        return engine.rng.choice(("attack", "rotate_clock", "rotate_counter"))
+    return "attack"
+
+POLICIES = {
+    "attack":           policy_attack,
+    "rotate_clock":     policy_rotate_clock,
+    "rotate_counter":   policy_rotate_counter,
+    "random":           policy_random,
+    "search":           SearchPolicy(budget = 20)
+}
+
+
+###############################################################################
+#   Battle Simulator
+###############################################################################
+
+def make_listing(species_ids, level = 1):
+    return tuple(UnitInstance(SPECIES[sid], level = level)
+                 for sid in species_ids)
+
+
+class BattleSimulator(object):
+    def __init__(self, policies, max_rounds = 100):
+        self.policies = policies
+        self.max_rounds = max_rounds
+        self.engine = BattleEngine()
+        self.engine.on.request_input.sub(self._on_request_input)
+        self._surrendered = None
+
+    def run(self, unit_listings, seed = None):
+        """Run a battle to completion. Returns the winning team index,
+        or None for draws and battles cut off after max_rounds."""
+        engine = self.engine
+        self._surrendered = None
+        engine.set_battle(unit_listings, seed = seed)
+        while engine.state != "end":
+            if engine.mechanics.round > self.max_rounds:
+                return None
+            engine.step()
+        return self.winner()
+
+    def winner(self):
+        teams = self.engine.mechanics.teams
+        if self._surrendered is not None:
+            if len(teams) == 2:
+                return 1 - self._surrendered
+            return None
+        alive = [team.index for team in teams if team.alive]
+        if len(alive) == 1:
+            return alive[0]
+        return None
+
+    def _on_request_input(self, engine):
+        for i in xrange(len(engine.mechanics.teams)):
+            action = self.policies[i](engine, i)
+            engine.set_action(action, i)
+            if action == "surrender":
+                self._surrendered = i
+                return
+
+
+class SimulationResult(object):
+    def __init__(self, num_teams):
+        self.battles = 0
+        self.wins   = [0] * num_teams
+        self.draws  = 0
+        self.rounds = 0
+        self.elapsed = 0.0
+        self.seed   = None
+        self.replays = []   # encoded replays, when recording
+
+    def add(self, winner, rounds):
+        self.battles += 1
+        self.rounds += rounds
+        if winner is None:
+            self.draws += 1
+        else:
+            self.wins[winner] += 1
+
+    def merge(self, other):
+        self.battles += other.battles
+        self.draws += other.draws
+        self.rounds += other.rounds
+        self.replays.extend(other.replays)
+        for i in xrange(len(self.wins)):
+            self.wins[i] += other.wins[i]
+
+    @property
+    def battles_per_second(self):
+        if self.elapsed <= 0.0:
+            return 0.0
+        return self.battles / self.elapsed
+
+    def win_rate(self, i):
+        return self.wins[i] / float(self.battles) if self.battles else 0.0
+
+    def report(self, team_names = None, out = None):
+        out = out or sys.stdout
+        if not self.seed is None:
+            out.write("seed:        {}\n".format(self.seed))
+        out.write("battles:     {}\n".format(self.battles))
+        out.write("elapsed:     {:.3f}s\n".format(self.elapsed))
+        out.write("battles/sec: {:.1f}\n".format(self.battles_per_second))
+        if self.battles:
+            out.write("mean rounds: {:.2f}\n".format(
+                      self.rounds / float(self.battles)))
+        for i in xrange(len(self.wins)):
+            name = team_names[i] if team_names else str(i)
+            out.write("team {} win rate: {:.2%} ({})\n".format(
+                      name, self.win_rate(i), self.wins[i]))
+        out.write("draws: {:.2%} ({})\n".format(
+                  self.draws / float(self.battles) if self.battles else 0.0,
+                  self.draws))
+
+
+def battle_seed(seed, b):
+    """Seed of battle `b` in a batch; the battle replays from it alone."""
+    return spawn_seed(seed, b)
+
+
+def run_chunk(args):
+    """Worker entry point: simulate battles `start` to `start + n` of a
+    batch between species teams."""
+    teams, policies, start, n, max_rounds, seed, record = args
+    simulator = BattleSimulator(policies, max_rounds = max_rounds)
+    recorder = BattleRecorder(simulator.engine) if record else None
+    result = SimulationResult(len(teams))
+    for b in xrange(start, start + n):
+        listings = [make_listing(team) for team in teams]
+        winner = simulator.run(listings, seed = battle_seed(seed, b))
+        result.add(winner, simulator.engine.mechanics.round)
+        if record:
+            result.replays.append(encode_replay(recorder.replay()))
+    return result
+
+
+def init_worker():
+    # The engine prints debug traces; keep worker output clean.
+    sys.stdout = open(os.devnull, "w")
+    # Forked workers inherit the parent's random state.
+    random.seed()
+
+
+def simulate(teams, policies, battles, jobs = None, chunk_size = 100,
+             max_rounds = 100, seed = None, record = None):
+    """Simulate a batch of battles. Results do not depend on `jobs` or
+    `chunk_size`: battle b is seeded with battle_seed(seed, b).
+    With `record`, the replay of every battle is appended to that file."""
+    jobs = jobs or multiprocessing.cpu_count()
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(60)
+    chunks = []
+    for start in xrange(0, battles, chunk_size):
+        n = min(chunk_size, battles - start)
+        chunks.append((teams, policies, start, n, max_rounds, seed,
+                       not record is None))
+    result = SimulationResult(len(teams))
+    result.seed = seed
+    archive = open_archive(record) if record else None
+    start = time.time()
+    try:
+        if jobs == 1:
+            stdout = sys.stdout
+            init_worker()
+            try:
+                for chunk in chunks:
+                    _merge(result, run_chunk(chunk), archive)
+            finally:
+                sys.stdout = stdout
+        else:
+            pool = multiprocessing.Pool(jobs, initializer = init_worker)
+            try:
+                for partial in pool.imap_unordered(run_chunk, chunks):
+                    _merge(result, partial, archive)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+    finally:
+        if archive:
+            archive.close()
+    result.elapsed = time.time() - start
+    return result
+
+
+def _merge(result, partial, archive):
+    if archive:
+        archive.write("".join(partial.replays))
+    partial.replays = []
+    result.merge(partial)
+
+
+###############################################################################
+#   Command Line
+###############################################################################
+
+def parse_team(text):
+    team = tuple(sid.strip() for sid in text.split(",") if sid.strip())
+    for sid in team:
+        if not sid in SPECIES:
+            raise argparse.ArgumentTypeError("unknown species: " + sid)
+    if not team or len(team) > 4:
+        raise argparse.ArgumentTypeError("teams must have 1 to 4 units")
+    return team
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "obminion simulate",
+                                     description = "Headless battle simulator.")
+    parser.add_argument("-t", "--team", action = "append", type = parse_team,
+                        help = "comma-separated species ids (give twice)")
+    parser.add_argument("-p", "--policy", action = "append",
+                        choices = sorted(POLICIES.keys()),
+                        help = "action policy per team (default: attack)")
+    parser.add_argument("-n", "--battles", type = int, default = 1000)
+    parser.add_argument("-j", "--jobs", type = int, default = 0,
+                        help = "worker processes (default: all cores)")
+    parser.add_argument("--chunk-size", type = int, default = 100)
+    parser.add_argument("--max-rounds", type = int, default = 100)
+    parser.add_argument("--seed", type = int,
+                        help = "root seed of the batch (default: random)")
+    parser.add_argument("--record", metavar = "FILE",
+                        help = "append the replay of every battle to FILE")
+    args = parser.parse_args(argv)
+    if args.team is None:
+        args.team = list(DEFAULT_TEAMS)
+    if len(args.team) != 2:
+        parser.error("exactly two teams are required")
+    policies = args.policy or ["attack"]
+    if len(policies) == 1:
+        policies = policies * len(args.team)
+    if len(policies) != len(args.team):
+        parser.error("give one policy, or one policy per team")
+    args.policy = policies
+    return args
+
+
+def main(argv = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    policies = [POLICIES[name] for name in args.policy]
+    result = simulate(args.team, policies, args.battles, jobs = args.jobs,
+                      chunk_size = args.chunk_size,
+                      max_rounds = args.max_rounds, seed = args.seed,
+                      record = args.record)
+    result.report(team_names = [",".join(team) for team in args.team])
+    return 0
@@ -0,0 +1,244 @@
+from .simulator import simulate, policy_random, make_listing, DEFAULT_TEAMS
+
+###############################################################################
+# Simulator determinism test
+
+print "Testing simulator determinism..."
+
+def outcome(result):
+    return (result.seed, result.battles, result.wins, result.draws,
+            result.rounds)
+
+policies = (policy_random, policy_random)
+expected = outcome(simulate(DEFAULT_TEAMS, policies, 24, jobs = 1,
+                            chunk_size = 5, seed = 1234))
+assert expected[1] == 24
+# the same seed gives the same results, however the battles are split
+for jobs, chunk_size in ((1, 24), (2, 5), (3, 7)):
+    result = simulate(DEFAULT_TEAMS, policies, 24, jobs = jobs,
+                      chunk_size = chunk_size, seed = 1234)
+    assert outcome(result) == expected
+
+print "> OK"
+
+###############################################################################
+# Memory footprint test
+
+print "Testing memory footprint report..."
+
+from StringIO import StringIO
+from . import memory
+
+engine = memory.new_battle()
+footprint = memory.Footprint().add(memory.battle_objects(engine))
+footprint.add(memory.effect_objects())
+for cls in memory.MODELS:
+    assert footprint.count[cls] > 0, cls.__name__
+    assert footprint.slotted[cls] < footprint.plain[cls], cls.__name__
+# and object by object
+objects = list(memory.battle_objects(engine)) + memory.effect_objects()
+assert set(type(obj) for obj in objects) == set(memory.MODELS)
+for obj in objects:
+    assert memory.slotted_size(obj) < memory.dict_size(obj)
+out = StringIO()
+memory.report(0, out = out)
+text = out.getvalue()
+for cls in memory.MODELS:
+    assert cls.__name__ in text
+assert not "resident growth" in text
+
+print "> OK"
+
+###############################################################################
+# Replay test
+
+print "Testing binary replays..."
+
+from .engine.mechanics import BattleEngine
+from .replay import BattleRecorder, ReplayPlayer, encode_replay, decode_replay
+
+def outcome(engine):
+    return [([(u.template.id, u.health) for u in team.units],
+             [u.template.id for u in team.grave])
+            for team in engine.mechanics.teams]
+
+def finish(engine):
+    while engine.state != "end":
+        engine.step()
+    return outcome(engine)
+
+recorded = BattleEngine(seed = 11)
+recorder = BattleRecorder(recorded)
+def alternate(engine):
+    actions = ("rotate_clock", "attack", "rotate_counter")
+    for i in xrange(2):
+        engine.set_action(actions[(engine.mechanics.round + i) % 3], i)
+recorded.on.request_input.sub(alternate)
+recorded.set_battle((make_listing(("footman", "bowman", "lifesteal")),
+                     make_listing(("abomination", "cleave"))))
+expected = finish(recorded)
+replay = recorder.replay()
+data = encode_replay(replay)
+# one byte per set_action call
+assert len(data) - len(encode_replay(replay._replace(rounds = ()))) \
+       == 2 * len(replay.rounds)
+copy, end = decode_replay(data)
+assert end == len(data)
+assert copy.rounds == replay.rounds and copy.seed == recorded.seed
+player = ReplayPlayer()
+played = player.play(copy)
+assert outcome(played) == expected
+assert played.mechanics.round == recorded.mechanics.round
+assert not player.cut_off
+short = copy._replace(rounds = copy.rounds[:2])
+assert player.play(short).mechanics.round == 3 and player.cut_off
+
+print "> OK"
+
+###############################################################################
+# Content pack test
+
+print "Testing content packs..."
+
+import json, marshal, os, shutil, tempfile
+from .engine.models import PLUS
+from . import content
+
+folder = tempfile.mkdtemp()
+try:
+    pack = {"version": 1,
+            "types": {"plain": {"name": "Plain", "weaknesses": ["plain"]}},
+            "abilities": {"thorns": {"name": "Thorns", "effects": [
+                {"mechanic": "damage", "target": "opponent",
+                 "events": ["self defend"], "parameters": {"amount": 1}}]}},
+            "species": {"spiky": {"id": "0100", "name": "Spiky", "type": "plain",
+                                  "health": 9, "power": 3, "speed": 5,
+                                  "abilities": ["thorns"]}},
+            "teams": {"solo": ["spiky"]}}
+    path = os.path.join(folder, "pack.json")
+    def write_pack(pack):
+        with open(path, "wb") as f:
+            json.dump(pack, f)
+    cache_dir = os.path.join(folder, "cache")
+    write_pack(pack)
+    loaded = content.load(paths = [path], cache_dir = cache_dir)
+    spiky = loaded.teams["solo"][0].template
+    assert spiky.name == "Spiky" and type(spiky.name) is str
+    assert spiky.abilities == (loaded.abilities["thorns"],)
+    assert loaded.chart.kind(spiky.type, spiky.type) == PLUS
+    # an unchanged pack is read back from the cache without parsing
+    cached, = os.listdir(cache_dir)
+    data = content.load_data(paths = [path], cache_dir = cache_dir)
+    data["species"]["spiky"]["name"] = "Cached"
+    with open(os.path.join(cache_dir, cached), "wb") as f:
+        marshal.dump(data, f)
+    assert content.load(paths = [path], cache_dir = cache_dir) \
+                  .species["spiky"].name == "Cached"
+    for broken in ({"speed": "fast"}, {"type": "missing"},
+                   {"abilities": ["missing"]}, {"colour": "red"}):
+        bad = json.loads(json.dumps(pack))
+        bad["species"]["spiky"].update(broken)
+        write_pack(bad)
+        try:
+            content.load(paths = [path], cache_dir = cache_dir)
+            assert False, broken
+        except content.ContentError as e:
+            assert "species.spiky" in str(e)
+    bad = json.loads(json.dumps(pack))
+    bad["abilities"]["thorns"]["effects"][0]["target"] = "nobody"
+    write_pack(bad)
+    try:
+        content.load(paths = [path], cache_dir = cache_dir)
+        assert False
+    except content.ContentError as e:
+        assert "abilities.thorns.effects[0]" in str(e)
+    # misspelt events and references fail at load, not once a battle starts
+    for broken in ({"events": ["self attak"]},
+                   {"events": ["self post_attack"],
+                    "parameters": {"relative": 0.5, "reference": "dmg"}}):
+        bad = json.loads(json.dumps(pack))
+        bad["abilities"]["thorns"]["effects"][0].update(broken)
+        write_pack(bad)
+        try:
+            content.load(paths = [path], cache_dir = cache_dir)
+            assert False, broken
+        except content.ContentError as e:
+            assert str(e).startswith(path + ": abilities.thorns.effects[0]")
+    assert len(os.listdir(cache_dir)) == 1
+    # importing reads the cache but leaves writing it to the game
+    shutil.rmtree(cache_dir)
+    write_pack(pack)
+    content.load_data(paths = [path], cache_dir = cache_dir, store = False)
+    assert not os.path.exists(cache_dir)
+    content.store_cache(cache_dir = cache_dir)
+    cached, = os.listdir(cache_dir)
+    assert content.load_data(cache_dir = cache_dir, store = False) \
+           == content._data
+    content.store_cache(cache_dir = cache_dir)
+    assert os.listdir(cache_dir) == [cached]
+finally:
+    shutil.rmtree(folder)
+
+print "> OK"
+
+###############################################################################
+# Matrix resume test
+
+print "Testing matrix resume..."
+
+import csv
+from . import matrix
+
+folder = tempfile.mkdtemp()
+try:
+    path = os.path.join(folder, "matrix.csv")
+    def write_rows(rows):
+        f = matrix.open_output(path)
+        try:
+            csv.writer(f).writerows(rows)
+        finally:
+            f.close()
+    write_rows([("a", "b", 10, 6, 4, 0, 30)])
+    assert list(matrix.read_rows(path)) == [("a", "b", [10, 6, 4, 0, 30])]
+    # a run interrupted halfway through writing a row
+    with open(path, "ab") as f:
+        f.write("a,c,10,3")
+    assert len(list(matrix.read_rows(path))) == 1
+    write_rows([("a", "c", 10, 3, 7, 0, 25)])
+    with open(path, "rb") as f:
+        lines = f.read().splitlines()
+    assert lines == [",".join(matrix.HEADER), "a,b,10,6,4,0,30",
+                     "a,c,10,3,7,0,25"]
+    assert matrix.load_done(path) == set([("a", "b"), ("a", "c")])
+    # or even through the header
+    with open(path, "wb") as f:
+        f.write("team_a,te")
+    write_rows([("b", "c", 10, 5, 5, 0, 20)])
+    with open(path, "rb") as f:
+        lines = f.read().splitlines()
+    assert lines == [",".join(matrix.HEADER), "b,c,10,5,5,0,20"]
+    # a resumed run keeps the seed it was started with
+    try:
+        matrix.resume_seed(path)
+        assert False, "resumed rows without a seed"
+    except ValueError:
+        pass
+    assert matrix.resume_seed(path, 5) == 5
+    os.remove(path)
+    seed = matrix.resume_seed(path)
+    f = matrix.open_output(path, seed)
+    csv.writer(f).writerow(("a", "b", 10, 6, 4, 0, 30))
+    f.close()
+    assert matrix.read_seed(path) == seed
+    assert matrix.resume_seed(path) == seed
+    assert matrix.resume_seed(path, seed) == seed
+    try:
+        matrix.resume_seed(path, seed + 1)
+        assert False, "resumed with another seed"
+    except ValueError:
+        pass
+    assert list(matrix.read_rows(path)) == [("a", "b", [10, 6, 4, 0, 30])]
+finally:
+    shutil.rmtree(folder)
+
+print "> OK"
@@ -0,0 +1,63 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Startup timeline of the game: how long imports, pg.init, display setup
+# and the first construction and startup of each state take.
+# Kept free of heavy imports, so it can time them.
+# Set OBMINION_TRACE to print each entry as it is recorded, and the whole
+# timeline once the first frame is drawn.
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+class Timeline(object):
+    def __init__(self, out = None):
+        self.start = time.time()
+        self.entries = []   # (name, milliseconds)
+        self.out = out
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, (time.time() - start) * 1000.0)
+
+    def mark(self, name):
+        """Record the time since the timeline started."""
+        self.add(name, (time.time() - self.start) * 1000.0)
+
+    def add(self, name, ms):
+        self.entries.append((name, ms))
+        if self.out:
+            self.out.write("> Startup: {} {:.1f} ms\n".format(name, ms))
+
+    def report(self, out = None):
+        out = out or sys.stdout
+        for name, ms in self.entries:
+            out.write("{:>9.1f} ms  {}\n".format(ms, name))
+
+
+STARTUP = Timeline(out = sys.stdout if os.environ.get("OBMINION_TRACE")
+                         else None)
@@ -176,6 +176,7 @@ class AnimationQueue(object):
     def __init__(self):
         self.queue = []
         self.current = None
+        self._shown = None
 
     @property
     def busy(self):
@@ -216,6 +217,16 @@ class AnimationQueue(object):
         if not self.current is None:
             self.current.draw(screen)
 
+    def get_dirty(self, rects):
+        """Append the areas of the last and the next sprite drawn.
+        Other animations change widgets, which track their own areas."""
+        if self._shown:
+            rects.append(self._shown)
+        rect = getattr(self.current, "rect", None)
+        self._shown = rect.copy() if rect else None
+        if self._shown:
+            rects.append(self._shown)
+
 
     def _next(self):
         if self.queue:
@@ -0,0 +1,271 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+import sys
+import time
+import threading
+from collections import OrderedDict
+from Queue import Queue, Empty
+
+import pygame as pg
+
+
+MODES = ("convert", "convert_alpha")
+
+
+###############################################################################
+#   Image Loading
+###############################################################################
+
+def load_image(path, mode = "convert"):
+    return convert_image(pg.image.load(path), mode)
+
+
+def convert_image(image, mode = "convert"):
+    """Convert a decoded image to the display format; main thread only."""
+    if mode == "convert_alpha":
+        return image.convert_alpha()
+    return image.convert()
+
+
+def surface_bytes(surface):
+    return surface.get_pitch() * surface.get_height()
+
+
+###############################################################################
+#   Asset Manager
+###############################################################################
+
+class Asset(object):
+    __slots__ = ("path", "mode", "surface", "size", "refs", "parent")
+
+    def __init__(self, path, mode, surface, parent = None):
+        self.path       = path
+        self.mode       = mode
+        self.surface    = surface
+        # a view into an atlas page shares the pixels of the page asset
+        self.size       = 0 if parent else surface_bytes(surface)
+        self.refs       = 0
+        self.parent     = parent
+
+
+class AssetManager(object):
+    """Images shared between states, keyed by path and conversion mode.
+
+    States acquire the images they use and release them all on exit.
+    Released images stay cached until the resident size goes over `budget`
+    bytes; then the least recently used ones are evicted. Images still in
+    use are never evicted, so holding them may exceed the budget.
+    Images packed in an `atlas` are subsurfaces of the page, which stays
+    cached while any of its images are.
+    """
+    def __init__(self, budget = None, loader = load_image, atlas = None):
+        self.budget     = budget
+        self.loader     = loader
+        self.atlas      = atlas
+        self.resident   = 0
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self._assets    = OrderedDict()     # least recently used first
+        self._owners    = {}
+
+    def __len__(self):
+        return len(self._assets)
+
+    def __contains__(self, key):
+        return key in self._assets
+
+    def acquire(self, path, mode = "convert", owner = None):
+        """Return the surface of an image, loading it on a miss. Each call
+        takes a reference on behalf of `owner`."""
+        if not mode in MODES:
+            raise ValueError("unknown conversion mode: " + mode)
+        key = (path, mode)
+        asset = self._assets.pop(key, None)
+        if asset is None:
+            self.misses += 1
+            asset = self._load(path, mode)
+            self.resident += asset.size
+        else:
+            self.hits += 1
+        self._assets[key] = asset
+        asset.refs += 1
+        self._owners.setdefault(owner, []).append(key)
+        self._evict()
+        return asset.surface
+
+    def source(self, path, mode = "convert"):
+        """The (path, mode) of the file an image is loaded from."""
+        entry = self.atlas.get(path, mode) if self.atlas else None
+        return entry.page if entry else (path, mode)
+
+    def _load(self, path, mode):
+        entry = self.atlas.get(path, mode) if self.atlas else None
+        if entry is None:
+            return Asset(path, mode, self.loader(path, mode))
+        page = self._assets.pop(entry.page, None)
+        if page is None:
+            page = Asset(entry.page[0], mode, self.loader(*entry.page))
+            self.resident += page.size
+        self._assets[entry.page] = page
+        page.refs += 1
+        return Asset(path, mode, page.surface.subsurface(entry.rect),
+                     parent = page)
+
+    def insert(self, path, mode, surface):
+        """Cache an image that was loaded elsewhere, with no references."""
+        key = (path, mode)
+        if key in self._assets:
+            return
+        asset = Asset(path, mode, surface)
+        self._assets[key] = asset
+        self.resident += asset.size
+        self._evict()
+
+    def release(self, owner = None):
+        """Drop every reference taken by `owner`."""
+        for key in self._owners.pop(owner, ()):
+            self._assets[key].refs -= 1
+        self._evict()
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict()
+
+    def _evict(self):
+        if self.budget is None:
+            return
+        while self.resident > self.budget:
+            # evicting a view can free its page, so look again each time
+            for key, asset in self._assets.iteritems():
+                if asset.refs == 0:
+                    break
+            else:
+                return
+            del self._assets[key]
+            self.resident -= asset.size
+            self.evictions += 1
+            if asset.parent:
+                asset.parent.refs -= 1
+
+    def assets(self):
+        """Cached assets, least recently used first."""
+        return self._assets.values()
+
+    def report(self, out = None):
+        out = out or sys.stdout
+        for asset in sorted(self._assets.itervalues(),
+                            key = lambda asset: -asset.size):
+            out.write("{:>9} {:>3} {:<13} {}\n".format(
+                      "view" if asset.parent else asset.size, asset.refs,
+                      asset.mode, asset.path))
+        out.write("{:>9} bytes in {} assets, budget {}; "
+                  "{} hits, {} misses, {} evictions\n".format(
+                  self.resident, len(self._assets),
+                  "none" if self.budget is None else self.budget,
+                  self.hits, self.misses, self.evictions))
+
+
+###############################################################################
+#   Background Streaming
+###############################################################################
+
+class AssetStreamer(object):
+    """Fills an AssetManager ahead of time.
+
+    A worker thread reads and decodes requested images into plain
+    surfaces. The main thread calls update once per frame to convert some
+    of them to the display format, for at most `budget` seconds, and adds
+    them to the manager. Images that fail to decode are skipped; acquiring
+    them later raises the error, and they are not requested again. With a
+    PixelCache, the worker reads images from it when it can, and the main
+    thread stores the ones it converted.
+    """
+    def __init__(self, assets, decode = pg.image.load, pixels = None):
+        self.assets     = assets
+        self.decode     = decode
+        self.pixels     = pixels
+        self.requested  = 0
+        self.completed  = 0
+        self._keys      = set()     # queued, or failed to decode
+        self._pending   = Queue()
+        self._decoded   = Queue()
+        self._thread    = None
+
+    @property
+    def done(self):
+        return self.completed >= self.requested
+
+    @property
+    def progress(self):
+        if not self.requested:
+            return 1.0
+        return self.completed / float(self.requested)
+
+    def request(self, keys):
+        """Queue (path, mode) pairs that are not cached or queued yet.
+        Packed images stream their atlas page instead."""
+        if self.pixels:
+            self.pixels.prepare()
+        for key in keys:
+            key = self.assets.source(*key)
+            if key in self._keys or key in self.assets:
+                continue
+            self._keys.add(key)
+            self.requested += 1
+            self._pending.put(key)
+        if self._thread is None and not self.done:
+            self._thread = threading.Thread(target = self._work,
+                                            name = "asset-streamer")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def update(self, budget = 0.004):
+        deadline = time.time() + budget
+        while not self.done:
+            try:
+                path, mode, image, converted = self._decoded.get_nowait()
+            except Empty:
+                return
+            if not image is None:
+                if not converted:
+                    image = convert_image(image, mode)
+                    if self.pixels:
+                        self.pixels.store(path, mode, image)
+                self.assets.insert(path, mode, image)
+                # the manager has it now
+                self._keys.discard((path, mode))
+            self.completed += 1
+            if time.time() >= deadline:
+                return
+
+    def _work(self):
+        while True:
+            path, mode = self._pending.get()
+            # every request gets a result, or the loading screen never ends
+            try:
+                image = self.pixels.read(path, mode) if self.pixels else None
+                converted = not image is None
+                if not converted:
+                    image = self.decode(path)
+            except Exception:
+                image, converted = None, False
+            self._decoded.put((path, mode, image, converted))
@@ -0,0 +1,222 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Texture atlases for the small images.
+# Usage: python -m obminion atlas [--images images]
+# Packs the images matching PACKED into a few pages per conversion mode and
+# writes them next to an index, images/atlas.json. The asset manager then
+# serves those images as subsurface views of a page, so one file is read
+# and one pixel buffer is kept for all of them. Rerun after changing an
+# image; entries whose source file changed are loaded from the file again.
+# Paths in the index are relative to the asset root, the folder holding the
+# image folder, as the game names its images ("images/dummy.png").
+
+import argparse
+import fnmatch
+import json
+import os
+import sys
+from collections import namedtuple
+
+import pygame as pg
+
+
+INDEX_VERSION = 2
+INDEX_NAME = "atlas.json"
+PAGE_SIZE = 1024
+
+# first match wins; the mode is the one the game loads the image with
+PACKED = (
+    ("portrait_frame*.png",     "convert_alpha"),
+    ("button_*.png",            "convert_alpha"),
+    ("highlight_circle*.png",   "convert_alpha"),
+    ("overworld_button*.png",   "convert_alpha"),
+    ("*_lg.png",                "convert")
+)
+
+AtlasEntry = namedtuple("AtlasEntry", ("page", "rect", "size", "mtime"))
+
+
+###############################################################################
+#   Runtime Index
+###############################################################################
+
+class Atlas(object):
+    """Where each packed image lives: (page path, mode) and its rect.
+    Images are named relative to the asset `root`; page paths are
+    resolved against it."""
+    def __init__(self, entries, root = "."):
+        self.entries = entries      # (path, mode) -> AtlasEntry
+        self.root = root
+        self._fresh = {}
+
+    @classmethod
+    def load(cls, path):
+        """Read an index, or return None when there is none."""
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            index = json.load(f)
+        if index.get("version") != INDEX_VERSION:
+            return None
+        root = os.path.normpath(os.path.join(os.path.dirname(path),
+                                             str(index["root"])))
+        pages = [(_resolve(root, page["file"]), str(page["mode"]))
+                 for page in index["pages"]]
+        entries = {}
+        for sprite in index["sprites"]:
+            page = pages[sprite["page"]]
+            entries[(str(sprite["file"]), page[1])] = AtlasEntry(page,
+                    tuple(sprite["rect"]), sprite["size"], sprite["mtime"])
+        return cls(entries, root = root)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path, mode):
+        """The entry of an image, unless it is not packed or its source
+        file changed after the atlas was built."""
+        entry = self.entries.get((path, mode))
+        if entry is None:
+            return None
+        fresh = self._fresh.get(path)
+        if fresh is None:
+            try:
+                st = os.stat(_resolve(self.root, path))
+                fresh = st.st_size == entry.size and int(st.st_mtime) == entry.mtime
+            except OSError:
+                fresh = True    # the atlas is all that ships
+            self._fresh[path] = fresh
+        return entry if fresh else None
+
+
+def _resolve(root, path):
+    return os.path.normpath(os.path.join(root, str(path)))
+
+
+def _relative(path, root):
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+
+###############################################################################
+#   Packing
+###############################################################################
+
+def pack(sizes, width = PAGE_SIZE, height = PAGE_SIZE):
+    """Shelf-pack (w, h) sizes, tallest first, on pages of at most
+    `width` x `height`. Returns (page, x, y) per size, in input order, and
+    the used (w, h) of each page."""
+    order = sorted(xrange(len(sizes)), key = lambda i: (-sizes[i][1], -sizes[i][0]))
+    places = [None] * len(sizes)
+    pages = []
+    x = y = shelf = 0
+    for i in order:
+        w, h = sizes[i]
+        if w > width or h > height:
+            raise ValueError("image larger than an atlas page: {}x{}".format(w, h))
+        if x + w > width:
+            x, y, shelf = 0, y + shelf, 0
+        if not pages or y + h > height:
+            pages.append([0, 0])
+            x = y = shelf = 0
+        places[i] = (len(pages) - 1, x, y)
+        page = pages[-1]
+        page[0] = max(page[0], x + w)
+        page[1] = max(page[1], y + h)
+        x += w
+        shelf = max(shelf, h)
+    return places, [tuple(page) for page in pages]
+
+
+def packed_mode(name):
+    for pattern, mode in PACKED:
+        if fnmatch.fnmatch(name, pattern):
+            return mode
+    return None
+
+
+def build_atlas(folder, root = None, out = None):
+    """Pack the matching images of `folder` and write the pages and the
+    index into it. Paths are stored relative to `root`, by default the
+    folder that holds `folder`. Returns the number of images packed."""
+    out = out or sys.stdout
+    if root is None:
+        root = os.path.dirname(os.path.abspath(folder))
+    groups = {}
+    for name in sorted(os.listdir(folder)):
+        mode = packed_mode(name)
+        if mode and not name.startswith("atlas-"):
+            groups.setdefault(mode, []).append(os.path.join(folder, name))
+    index = {"version": INDEX_VERSION, "root": _relative(root, folder),
+             "pages": [], "sprites": []}
+    for mode in sorted(groups):
+        paths = groups[mode]
+        images = [pg.image.load(path) for path in paths]
+        places, sizes = pack([image.get_size() for image in images])
+        first = len(index["pages"])
+        pages = []
+        for size in sizes:
+            page = pg.Surface(size, pg.SRCALPHA, 32)
+            page.fill((0, 0, 0, 0))
+            pages.append(page)
+        for path, image, (p, x, y) in zip(paths, images, places):
+            # an exact copy of every channel, unlike alpha blending
+            pages[p].blit(image, (x, y), special_flags = pg.BLEND_RGBA_MAX)
+            st = os.stat(path)
+            index["sprites"].append({
+                "file":     _relative(path, root),
+                "page":     first + p,
+                "rect":     [x, y] + list(image.get_size()),
+                "size":     st.st_size,
+                "mtime":    int(st.st_mtime)
+            })
+        for i, page in enumerate(pages):
+            path = os.path.join(folder, "atlas-{}-{}.png".format(mode, i))
+            pg.image.save(page, path)
+            index["pages"].append({"file": _relative(path, root),
+                                   "mode": mode,
+                                   "size": list(page.get_size())})
+            out.write("{}: {}x{}\n".format(path, *page.get_size()))
+    with open(os.path.join(folder, INDEX_NAME), "wb") as f:
+        json.dump(index, f, indent = 1, sort_keys = True)
+    out.write("{} images in {} pages\n".format(len(index["sprites"]),
+                                               len(index["pages"])))
+    return len(index["sprites"])
+
+
+###############################################################################
+#   Command Line
+###############################################################################
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "obminion atlas",
+                                     description = "Build the texture atlases.")
+    parser.add_argument("--images", default = "images",
+                        help = "image folder, also where the atlas is written")
+    parser.add_argument("--root", default = None,
+                        help = "asset root the game names images from "
+                               "(default: the folder holding --images)")
+    return parser.parse_args(argv)
+
+
+def main(argv = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    build_atlas(args.images, root = args.root)
+    return 0
@@ -19,7 +19,7 @@
 #THE SOFTWARE.
 
 from .widgets import BattleTeamWidgetL, BattleTeamWidgetR, \
-                     BattleActionPanel, CombatLogWidget
+                     BattleActionPanel, CombatLogWidget, render_dirty
 from .animation import AnimationQueue, Animation, BarLevelAnimation, \
                        WriteAnimation, GetActionAnimation, AnimatedSprite
 
@@ -29,9 +29,11 @@ from .animation import AnimationQueue, Animation, BarLevelAnimation, \
 ###############################################################################
 
 class BattleScene(object):
-    def __init__(self, gx_config, sprite_bank, animation_bank):
+    def __init__(self, gx_config, sprite_bank, animation_bank,
+                 background = None):
         self.sprite_bank = sprite_bank
         self.animation_bank = animation_bank
+        self.background = background
         self.teams = [
             BattleTeamWidgetL(**gx_config["team_left"]),
             BattleTeamWidgetR(**gx_config["team_right"])
@@ -43,6 +45,7 @@ class BattleScene(object):
         self.action_panel = BattleActionPanel(**gx_config["action_panel"])
         self.combat_log = CombatLogWidget(**gx_config["combat_log"])
         self._animations = AnimationQueue()
+        self._redraw_all = True
 
     @property
     def busy(self):
@@ -51,7 +54,33 @@ class BattleScene(object):
     def update(self, dt):
         self._animations.update(dt)
 
+    def render(self, screen):
+        """Draw the areas that changed since the last render.
+        Returns them, for pg.display.update."""
+        rects = self.get_dirty()
+        if self._redraw_all:
+            self._redraw_all = False
+            self.draw(screen)
+            return [screen.get_rect()]
+        return render_dirty(screen, rects, self.draw)
+
+    def invalidate(self):
+        self._redraw_all = True
+
+    def get_dirty(self):
+        rects = []
+        for team in self.teams:
+            team.get_dirty(rects)
+        self.combat_log.get_dirty(rects)
+        self.action_panel.get_dirty(rects)
+        self._animations.get_dirty(rects)
+        return rects
+
     def draw(self, screen):
+        if self.background is None:
+            screen.fill((0, 0, 0))
+        else:
+            screen.blit(self.background, (0, 0))
         for team in self.teams:
             team.draw(screen)
         self.combat_log.draw(screen)
@@ -67,15 +96,20 @@ class BattleScene(object):
         return False
 
     def reset(self):
+        self.selected_action = None
         self.combat_log.clear()
         self.action_panel.set_active(False)
         self._animations.cancel_all()
+        self.invalidate()
 
     def set_battle(self, engine):
         team_index = 0
         for battle_team in engine.mechanics.teams:
             self._update_team_portraits(team_index, battle_team)
             team_index += 1
+        if engine.mechanics.queue is not None:
+            engine.mechanics.events.batch.sub(self.on_event_batch)
+            return
         engine.mechanics.team_events.rotate_left.sub(self.on_team_rotate_left)
         engine.mechanics.team_events.rotate_right.sub(self.on_team_rotate_right)
         engine.mechanics.team_events.add.sub(self.on_team_add)
@@ -143,6 +177,22 @@ class BattleScene(object):
     def on_trigger_ability(self, ability, unit = None):
         self._log("{} triggered {}.".format(unit.template.name, ability.name))
 
+    def on_event_batch(self, mechanics, records = ()):
+        handlers = {
+            "rotate_left":  self.on_team_rotate_left,
+            "rotate_right": self.on_team_rotate_right,
+            "add":          self.on_team_add,
+            "remove":       self.on_team_remove,
+            "attack":       self.on_attack,
+            "damage":       self.on_damage,
+            "heal":         self.on_heal,
+            "ability":      self.on_trigger_ability
+        }
+        for record in records:
+            handler = handlers.get(record.event.name)
+            if handler:
+                handler(*record.args)
+
     def on_team_rotate_left(self, team, active = None, previous = None):
         if team.index == 0:
             self._log("Your team rotated counter-clockwise.")
@@ -189,6 +239,8 @@ class BattleScene(object):
             portrait.visible = False
             portrait.set_picture(None)
         n = battle_team.size
+        if not n:
+            return
         for i in xrange(1, n):
             unit = battle_team.units[i]
             portrait = team.get_portrait_for(i, n)
@@ -20,7 +20,7 @@
 
 import pygame as pg
 
-from .widgets import UIWidget, HighlightWidget, MissionPanel
+from .widgets import UIWidget, HighlightWidget, MissionPanel, render_dirty
 from .animation import AnimationQueue, Animation
 
 
@@ -40,6 +40,7 @@ class OverworldScene(object):
         self.mission_panel = MissionPanel(**gx_config["mission_panel"])
         self.mission_panel.visible = False
         self._animations = AnimationQueue()
+        self._redraw_all = True
 
     @property
     def busy(self):
@@ -56,6 +57,28 @@ class OverworldScene(object):
                 node.update_mouse(pos)
         self._animations.update(dt)
 
+    def render(self, screen):
+        """Draw the areas that changed since the last render.
+        Returns them, for pg.display.update."""
+        rects = self.get_dirty()
+        if self._redraw_all:
+            self._redraw_all = False
+            self.draw(screen)
+            return [screen.get_rect()]
+        return render_dirty(screen, rects, self.draw)
+
+    def invalidate(self):
+        self._redraw_all = True
+
+    def get_dirty(self):
+        rects = []
+        self.map.get_dirty(rects)
+        for node in self.nodes:
+            node.get_dirty(rects)
+        self.mission_panel.get_dirty(rects)
+        self._animations.get_dirty(rects)
+        return rects
+
     def draw(self, screen):
         self.map.draw(screen)
         for node in self.nodes:
@@ -72,6 +95,8 @@ class OverworldScene(object):
         return False
 
     def reset(self):
+        # dropped nodes leave no dirty areas behind
+        self.invalidate()
         self.nodes = []
         self.map.set_image(None)
         self.mission_panel.visible = False
@@ -84,6 +109,7 @@ class OverworldScene(object):
         self.mission_panel.opponent.set_picture(None)
 
     def set_map(self, name, nodes):
+        self.invalidate()
         self.selected_action = None
         self.map.set_image(self.image_bank.get(name))
         self.map.visible = True
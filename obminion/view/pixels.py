@@ -0,0 +1,199 @@
+#Copyright (c) 2017 Andre Santos
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#THE SOFTWARE.
+
+# Cache of decoded images in the display's pixel format.
+# Each converted image is stored as its raw pixel rows, named by the hash of
+# the source file, the conversion mode and the display format, so that a
+# changed file or display format misses the cache. A manifest remembers the
+# size, mtime and content hash of every source file; the file is only
+# hashed again when its size or mtime change. A hit maps the pixels with
+# mmap and copies them into a new surface of the display format; nothing is
+# decoded or converted.
+
+import marshal
+import mmap
+import os
+import struct
+import threading
+from hashlib import sha1
+
+import pygame as pg
+
+from .assets import convert_image
+
+
+MAGIC = "OBPX"
+_header = struct.Struct("<4sIII")   # magic, width, height, pitch
+
+
+class PixelCache(object):
+    """read and store may run on any thread once prepare has been called
+    on the main thread with the display mode set."""
+    def __init__(self, folder):
+        self.folder     = folder
+        self.hits       = 0
+        self.misses     = 0
+        self._formats   = None
+        self._lock      = threading.Lock()
+        self._manifest  = self._read_manifest()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.folder, "manifest.bin")
+
+    def prepare(self):
+        """Sample the display formats the conversion modes produce."""
+        if self._formats is None and pg.display.get_surface():
+            formats = {}
+            for mode in ("convert", "convert_alpha"):
+                sample = convert_image(pg.Surface((1, 1), pg.SRCALPHA, 32), mode)
+                formats[mode] = (sample, "{} {} {} {}".format(mode,
+                                 sample.get_bitsize(), sample.get_masks(),
+                                 sample.get_flags() & pg.SRCALPHA))
+            self._formats = formats
+        return self._formats is not None
+
+    def load(self, path, mode = "convert"):
+        """Loader for an AssetManager: from the cache, or decoded and
+        converted, then stored."""
+        self.prepare()
+        surface = self.read(path, mode)
+        if surface is None:
+            surface = convert_image(pg.image.load(path), mode)
+            self.store(path, mode, surface)
+        return surface
+
+    def read(self, path, mode):
+        """The cached surface of an image, or None."""
+        if self._formats is None:
+            return None
+        blob = self._blob(path, mode)
+        if blob is None or not os.path.exists(blob):
+            self.misses += 1
+            return None
+        try:
+            surface = self._map(blob, self._formats[mode][0])
+        except (EnvironmentError, ValueError, struct.error, pg.error):
+            surface = None
+        if surface is None:
+            # truncated, empty or corrupt: drop it, to be stored again
+            try:
+                os.remove(blob)
+            except OSError:
+                pass
+            self.misses += 1
+            return None
+        self.hits += 1
+        return surface
+
+    def _map(self, blob, sample):
+        with open(blob, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            magic, width, height, pitch = _header.unpack_from(data)
+            if magic != MAGIC or width * sample.get_bytesize() > pitch \
+                    or len(data) != _header.size + pitch * height:
+                return None
+            surface = pg.Surface((width, height),
+                                 sample.get_flags() & pg.SRCALPHA, sample)
+            if surface.get_pitch() != pitch:
+                return None
+            surface.get_buffer().write(buffer(data, _header.size))
+            return surface
+        finally:
+            data.close()
+
+    def store(self, path, mode, surface):
+        """Store a surface converted with `mode` from the file at `path`."""
+        if self._formats is None:
+            return
+        blob = self._blob(path, mode)
+        if blob is None:
+            return
+        tmp = "{}.{}.tmp".format(blob, os.getpid())
+        try:
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            with open(tmp, "wb") as f:
+                f.write(_header.pack(MAGIC, surface.get_width(),
+                                     surface.get_height(), surface.get_pitch()))
+                f.write(surface.get_buffer().raw)
+            os.rename(tmp, blob)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self._update(path, mode, blob)
+
+    def _blob(self, path, mode):
+        digest = self._source_hash(path)
+        if digest is None:
+            return None
+        name = sha1(digest + self._formats[mode][1]).hexdigest()
+        return os.path.join(self.folder, name + ".px")
+
+    def _source_hash(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (st.st_size, st.st_mtime)
+        with self._lock:
+            known = self._manifest.get(path)
+        if known and known[0] == stamp:
+            return known[1]
+        with open(path, "rb") as f:
+            digest = sha1(f.read()).hexdigest()
+        with self._lock:
+            blobs = self._manifest[path][2] if path in self._manifest else {}
+            self._manifest[path] = (stamp, digest, blobs)
+            self._write_manifest()
+        return digest
+
+    def _update(self, path, mode, blob):
+        # remember the blob of each mode, and delete the one it replaces
+        with self._lock:
+            stamp, digest, blobs = self._manifest[path]
+            old = blobs.get(mode)
+            blobs[mode] = os.path.basename(blob)
+            self._write_manifest()
+        if old and old != blobs[mode]:
+            try:
+                os.remove(os.path.join(self.folder, old))
+            except OSError:
+                pass
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, "rb") as f:
+                return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return {}
+
+    def _write_manifest(self):
+        tmp = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+        try:
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            with open(tmp, "wb") as f:
+                marshal.dump(self._manifest, f)
+            os.rename(tmp, self.manifest_path)
+        except (IOError, OSError):
+            pass
@@ -22,7 +22,10 @@ import pygame as pg
 
 
 class Spritesheet(object):
-    def __init__(self, filename):
+    def __init__(self, filename, sheet = None):
+        if not sheet is None:
+            self.sheet = sheet
+            return
         try:
             self.sheet = pg.image.load(filename).convert_alpha()
         except pg.error, message:
@@ -0,0 +1,251 @@
+import os
+import shutil
+import tempfile
+
+###############################################################################
+# Asset manager test
+
+print "Testing asset manager..."
+
+import pygame as pg
+from .assets import AssetManager, surface_bytes
+
+loads = []
+def fake_loader(path, mode):
+    loads.append((path, mode))
+    return pg.Surface((16, 16) if path.endswith("small") else (64, 64))
+
+size = surface_bytes(pg.Surface((64, 64)))
+assets = AssetManager(budget = 2 * size, loader = fake_loader)
+first = assets.acquire("a", owner = "overworld")
+assert assets.acquire("a", owner = "battle") is first
+assert assets.acquire("a", "convert_alpha", owner = "battle") is not first
+assets.acquire("b", owner = "battle")
+# everything is in use, so nothing can go despite the budget
+assert assets.resident == 3 * size and assets.evictions == 0
+assets.release(owner = "battle")
+# ("a", "convert") is still held; the least recently used of the rest goes
+assert ("a", "convert") in assets and not ("a", "convert_alpha") in assets
+assert ("b", "convert") in assets and assets.resident == 2 * size
+assets.acquire("small", owner = "battle")
+assert not ("b", "convert") in assets
+assert assets.resident == size + surface_bytes(pg.Surface((16, 16)))
+assets.release(owner = "overworld")
+assets.acquire("a", owner = "overworld")
+assert loads.count(("a", "convert")) == 1
+assert assets.hits == 2 and assets.misses == 4
+
+print "> OK"
+
+###############################################################################
+# Asset streaming test
+
+print "Testing background asset streaming..."
+
+import time
+from .assets import AssetStreamer
+
+# conversion needs a display mode
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+pg.display.init()
+pg.display.set_mode((1, 1))
+
+def fake_decode(path):
+    if path == "broken":
+        raise pg.error("cannot decode")
+    if path == "strange":
+        raise ValueError("unexpected failure")
+    return pg.Surface((8, 8))
+
+assets = AssetManager(loader = fake_loader)
+streamer = AssetStreamer(assets, decode = fake_decode)
+assert streamer.done and streamer.progress == 1.0
+keys = [("x", "convert"), ("y", "convert_alpha"), ("broken", "convert"),
+        ("strange", "convert")]
+streamer.request(keys + keys[:1])
+assert streamer.requested == 4
+start = time.time()
+while not streamer.done and time.time() - start < 5.0:
+    streamer.update()
+assert streamer.done and streamer.progress == 1.0
+assert ("x", "convert") in assets and ("y", "convert_alpha") in assets
+assert not ("broken", "convert") in assets
+assert not ("strange", "convert") in assets
+# only the failures are remembered, so they are not queued again
+assert streamer._keys == set(keys[2:])
+streamer.request(keys[2:])
+assert streamer.requested == 4
+del loads[:]
+assets.acquire("y", "convert_alpha")
+assert assets.hits == 1 and not loads
+# already cached images are not queued again
+streamer.request(keys[:2])
+assert streamer.requested == 4
+pg.display.quit()
+
+print "> OK"
+
+###############################################################################
+# Texture atlas test
+
+print "Testing texture atlases..."
+
+from .atlas import Atlas, AtlasEntry, pack
+
+sizes = [(30, 20), (50, 40), (60, 10), (40, 40), (100, 100)]
+places, pages = pack(sizes, width = 100, height = 100)
+assert len(pages) == 2
+rects = [pg.Rect(x, y, w, h) for (p, x, y), (w, h) in zip(places, sizes)]
+for i, (p, x, y) in enumerate(places):
+    w, h = pages[p]
+    assert rects[i].right <= w and rects[i].bottom <= h
+    for j in xrange(i):
+        assert places[j][0] != p or not rects[i].colliderect(rects[j])
+
+page = ("atlas-0", "convert_alpha")
+atlas = Atlas({("a", "convert_alpha"): AtlasEntry(page, (0, 0, 8, 8), 0, 0),
+               ("b", "convert_alpha"): AtlasEntry(page, (8, 0, 8, 8), 0, 0)})
+del loads[:]
+assets = AssetManager(budget = 0, atlas = atlas, loader = fake_loader)
+a = assets.acquire("a", "convert_alpha", owner = "battle")
+b = assets.acquire("b", "convert_alpha", owner = "battle")
+assert loads == [page] and a.get_parent() is b.get_parent()
+assert a.get_offset() == (0, 0) and b.get_offset() == (8, 0)
+assert assets.resident == surface_bytes(pg.Surface((64, 64)))
+assert assets.source("b", "convert_alpha") == page
+assert assets.source("c", "convert_alpha") == ("c", "convert_alpha")
+# the page goes with the last view of it
+assets.release(owner = "battle")
+assert len(assets) == 0 and assets.resident == 0
+
+# the index names images as the game does, from any working directory
+from .atlas import build_atlas
+
+folder = tempfile.mkdtemp()
+cwd = os.getcwd()
+try:
+    images = os.path.join(folder, "images")
+    os.mkdir(images)
+    for name in ("button_a.png", "button_b.png", "plain.png"):
+        pg.image.save(pg.Surface((8, 8), pg.SRCALPHA, 32),
+                      os.path.join(images, name))
+    os.chdir(folder)
+    assert build_atlas("images") == 2
+    os.chdir(images)
+    atlas = Atlas.load("atlas.json")
+    assert sorted(atlas.entries) == [("images/button_a.png", "convert_alpha"),
+                                     ("images/button_b.png", "convert_alpha")]
+    entry = atlas.get("images/button_b.png", "convert_alpha")
+    assert not entry is None and os.path.isfile(entry.page[0])
+    os.chdir(cwd)
+    atlas = Atlas.load(os.path.join(images, "atlas.json"))
+    page = atlas.get("images/button_a.png", "convert_alpha").page[0]
+    assert os.path.samefile(page, os.path.join(images,
+                                               "atlas-convert_alpha-0.png"))
+    # a changed source image is loaded from its file again
+    pg.image.save(pg.Surface((4, 4)), os.path.join(images, "button_a.png"))
+    os.utime(os.path.join(images, "button_a.png"), (0, 0))
+    atlas = Atlas.load(os.path.join(images, "atlas.json"))
+    assert atlas.get("images/button_a.png", "convert_alpha") is None
+    assert not atlas.get("images/button_b.png", "convert_alpha") is None
+finally:
+    os.chdir(cwd)
+    shutil.rmtree(folder)
+
+print "> OK"
+
+###############################################################################
+# Pixel cache test
+
+print "Testing pixel cache..."
+
+from .pixels import PixelCache
+
+pg.display.init()
+pg.display.set_mode((1, 1))
+folder = tempfile.mkdtemp()
+try:
+    path = os.path.join(folder, "image.png")
+    def save_image(colour):
+        image = pg.Surface((5, 3), pg.SRCALPHA, 32)
+        image.fill(colour)
+        pg.image.save(image, path)
+    save_image((10, 20, 30, 128))
+    pixels = PixelCache(os.path.join(folder, "cache"))
+    decoded = pixels.load(path, "convert_alpha")
+    assert pixels.misses == 1
+    for mode in ("convert_alpha", "convert"):
+        expected = pixels.load(path, mode) if mode == "convert" else decoded
+        # a new cache only has the files on disk
+        cache = PixelCache(pixels.folder)
+        assert cache.prepare()
+        cached = cache.read(path, mode)
+        assert cached.get_size() == (5, 3)
+        assert cached.get_flags() == expected.get_flags()
+        assert pg.image.tostring(cached, "RGBA") == \
+               pg.image.tostring(expected, "RGBA")
+    blobs = [name for name in os.listdir(pixels.folder) if name.endswith(".px")]
+    assert len(blobs) == 2
+    # truncated and empty blobs are misses, deleted and stored again
+    for size in (20, 0):
+        blob = cache._blob(path, "convert")
+        with open(blob, "r+b") as f:
+            f.truncate(size)
+        assert cache.read(path, "convert") is None and not os.path.exists(blob)
+        assert cache.load(path, "convert").get_size() == (5, 3)
+        assert os.path.exists(blob)
+    # a changed source misses, and its old pixels are dropped
+    save_image((40, 50, 60, 255))
+    os.utime(path, (1, 1))
+    pixels = PixelCache(pixels.folder)
+    assert pixels.prepare() and pixels.read(path, "convert") is None
+    assert pixels.load(path, "convert").get_at((0, 0)) == (40, 50, 60, 255)
+    assert len([name for name in os.listdir(pixels.folder)
+                if name.endswith(".px")]) == 2
+finally:
+    shutil.rmtree(folder)
+    pg.display.quit()
+
+print "> OK"
+
+###############################################################################
+# Dirty rectangle test
+
+print "Testing dirty rectangles..."
+
+from .widgets import UIWidget, merge_rects, render_dirty
+
+widget = UIWidget(10, 10, pg.Surface((20, 10)))
+rects = []
+widget.get_dirty(rects)
+assert rects == [pg.Rect(10, 10, 20, 10)]
+rects = []
+widget.get_dirty(rects)
+widget.x = 10
+widget.get_dirty(rects)
+assert rects == []
+widget.x = 50
+widget.get_dirty(rects)
+assert rects == [pg.Rect(10, 10, 20, 10), pg.Rect(50, 10, 20, 10)]
+rects = []
+widget.visible = False
+widget.get_dirty(rects)
+assert rects == [pg.Rect(50, 10, 20, 10)]
+
+merged = merge_rects([(0, 0, 10, 10), (5, 5, 10, 10), (30, 30, 5, 5),
+                      (12, 12, 10, 10)])
+assert sorted(merged) == [pg.Rect(0, 0, 22, 22), pg.Rect(30, 30, 5, 5)]
+
+screen = pg.Surface((40, 40))
+clips = []
+def draw(surface):
+    clips.append(surface.get_clip())
+    surface.fill((255, 0, 0))
+drawn = render_dirty(screen, [(30, 30, 20, 20), (0, 0, 5, 5), (60, 0, 5, 5)],
+                     draw)
+assert drawn == clips == [pg.Rect(30, 30, 10, 10), pg.Rect(0, 0, 5, 5)]
+assert screen.get_clip() == screen.get_rect()
+assert screen.get_at((0, 0)) == (255, 0, 0, 255)
+assert screen.get_at((10, 10)) == (0, 0, 0, 255)
+
+print "> OK"
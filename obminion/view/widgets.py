@@ -21,11 +21,84 @@
 import pygame as pg
 
 
+###############################################################################
+#   Dirty Rectangles
+###############################################################################
+
+# Widgets remember whether they changed since the last get_dirty call, and
+# where they were shown then. A scene collects those areas every frame and
+# redraws all of its layers clipped to each of them, so that only changed
+# areas are drawn and pushed to the display.
+
+def redraws(name):
+    """A property that marks its widget dirty when the value changes."""
+    attr = "_" + name
+    def get(self):
+        return getattr(self, attr)
+    def set(self, value):
+        if getattr(self, attr, None) != value:
+            setattr(self, attr, value)
+            self._dirty = True
+    return property(get, set)
+
+
+def merge_rects(rects):
+    """Join overlapping rects, until none overlap."""
+    merged = []
+    for rect in rects:
+        rect = pg.Rect(rect)
+        i = rect.collidelist(merged)
+        while i >= 0:
+            rect.union_ip(merged.pop(i))
+            i = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+
+def render_dirty(screen, rects, draw):
+    """Call draw(screen) clipped to each of the merged `rects`. Returns
+    the areas drawn, for pg.display.update."""
+    area = screen.get_rect()
+    rects = [rect.clip(area) for rect in merge_rects(rects)]
+    rects = [rect for rect in rects if rect.w and rect.h]
+    clip = screen.get_clip()
+    for rect in rects:
+        screen.set_clip(rect)
+        draw(screen)
+    screen.set_clip(clip)
+    return rects
+
+
+class DirtyTracker(object):
+    """Mixin: get_dirty reports where the widget was and where it is,
+    when it changed. Subclasses define bounds."""
+    _dirty = True
+    _shown = None
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def get_dirty(self, rects):
+        """Append the screen areas to redraw since the last call."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        if self._shown:
+            rects.append(self._shown)
+        self._shown = self.bounds() if self.visible else None
+        if self._shown:
+            rects.append(self._shown)
+
+
 ###############################################################################
 #   Basic UI Widgets
 ###############################################################################
 
-class UIWidget(pg.sprite.Sprite):
+class UIWidget(DirtyTracker, pg.sprite.Sprite):
+    x       = redraws("x")
+    y       = redraws("y")
+    visible = redraws("visible")
+
     def __init__(self, x, y, image, name = "widget", border = (0, 0, 0, 0),
                  on_click = None, on_right_click = None):
         pg.sprite.Sprite.__init__(self)
@@ -87,7 +160,11 @@ class UIWidget(pg.sprite.Sprite):
     def h(self):
         return self.rect.height
 
+    def bounds(self):
+        return pg.Rect(self.x, self.y, self.rect.w, self.rect.h)
+
     def set_image(self, image):
+        self._dirty = True
         self.image = image
         if image is None:
             self.visible = False
@@ -98,7 +175,10 @@ class UIWidget(pg.sprite.Sprite):
             self.rect.y = self.y
 
 
-class TextLabel(object):
+class TextLabel(DirtyTracker):
+    x       = redraws("x")
+    y       = redraws("y")
+
     def __init__(self, x, y, text = "", font = None, font_name = "monospace",
                  font_size = 12, font_colour = (0, 0, 0), font_bg = None):
         self.x           = x
@@ -119,7 +199,15 @@ class TextLabel(object):
             self.rect.y = self.y
             screen.blit(self.label, self.rect)
 
+    @property
+    def visible(self):
+        return not self.label is None
+
+    def bounds(self):
+        return pg.Rect(self.x, self.y, self.rect.w, self.rect.h)
+
     def set_text(self, text):
+        self._dirty = True
         self.text = text
         if text:
             self.label = self.font.render(text, True, self.font_colour,
@@ -152,6 +240,10 @@ class HighlightWidget(UIWidget):
 ###############################################################################
 
 class UnitPortrait(UIWidget):
+    bar_level       = redraws("bar_level")
+    display_picture = redraws("display_picture")
+    display_labels  = redraws("display_labels")
+
     def __init__(self, x, y, name, frame, border, bar, bar_colour, bar_bg,
                  picture, bg_colour, font, font_colour,
                  health_label, power_label, speed_label):
@@ -184,7 +276,7 @@ class UnitPortrait(UIWidget):
         if not self.visible:
             return False
         if self.picture is None or not self.display_picture:
-            screen.fill(self.bg_colour, self.picture_pos)
+            screen.fill(self.bg_colour, self._picture_area())
         else:
             self.picture_rect.x = self.x + self.picture_pos[0]
             self.picture_rect.y = self.y + self.picture_pos[1]
@@ -213,7 +305,31 @@ class UnitPortrait(UIWidget):
             self.speed.y = self.y + self.speed_pos[1]
             self.speed.draw(screen)
 
+    def bounds(self):
+        rect = UIWidget.bounds(self).union(self._picture_area())
+        rect.union_ip(pg.Rect(self.x + self.bar_pos[0], self.y + self.bar_pos[1],
+                              self.bar_pos[2], self.bar_pos[3]))
+        for label, pos in ((self.health, self.health_pos),
+                           (self.power, self.power_pos),
+                           (self.speed, self.speed_pos)):
+            if label.rect:
+                rect.union_ip(pg.Rect(self.x + pos[0], self.y + pos[1],
+                                      label.rect.w, label.rect.h))
+        return rect
+
+    def get_dirty(self, rects):
+        for label in (self.health, self.power, self.speed):
+            if label._dirty:
+                label._dirty = False
+                self._dirty = True
+        UIWidget.get_dirty(self, rects)
+
+    def _picture_area(self):
+        return pg.Rect(self.x + self.picture_pos[0], self.y + self.picture_pos[1],
+                       self.picture_pos[2], self.picture_pos[3])
+
     def set_picture(self, image):
+        self._dirty = True
         self.picture = image
         if not image is None:
             self.picture_rect = image.get_rect()
@@ -279,7 +395,13 @@ class LargeUnitPortrait(UnitPortrait):
             screen.blit(self.icon, self.icon_rect)
         UnitPortrait.draw(self, screen)
 
+    def bounds(self):
+        return UnitPortrait.bounds(self).union(pg.Rect(
+                self.x + self.icon_pos[0], self.y + self.icon_pos[1],
+                self.icon_pos[2], self.icon_pos[3]))
+
     def set_icon(self, image):
+        self._dirty = True
         self.icon = image
         if not image is None:
             self.icon_rect = image.get_rect()
@@ -343,6 +465,10 @@ class BattleTeamWidget(object):
         for portrait in self.portraits:
             portrait.draw(screen)
 
+    def get_dirty(self, rects):
+        for portrait in self.portraits:
+            portrait.get_dirty(rects)
+
     def get_event(self, event):
         for portrait in self.portraits:
             if portrait.get_event(event):
@@ -398,7 +524,16 @@ class CombatLogWidget(UIWidget):
             entry.draw(screen)
             i += 1
 
+    def get_dirty(self, rects):
+        # logging moves every entry, so any change redraws the whole log
+        for entry in self.entries:
+            if entry._dirty:
+                entry._dirty = False
+                self._dirty = True
+        UIWidget.get_dirty(self, rects)
+
     def log(self, text):
+        self._dirty = True
         entry = self.entries.pop(0)
         self.entries.append(entry)
         entry.set_text(text)
@@ -423,6 +558,8 @@ class ActionButton(UIWidget):
 
 # it is easier for 'actions' to be a dict instead of a list of things
 class ActionPanel(UIWidget):
+    active = redraws("active")
+
     def __init__(self, x = 0, y = 0, name = "action_panel", frame = None,
                  border = (0, 0, 0, 0), actions = None, label = (0, 0),
                  font = None, font_name = "monospace",
@@ -459,6 +596,19 @@ class ActionPanel(UIWidget):
                     return True
         return False
 
+    def bounds(self):
+        rect = UIWidget.bounds(self)
+        rect.unionall_ip([action.bounds() for action in self.actions])
+        if self.label.visible:
+            rect.union_ip(self.label.bounds())
+        return rect
+
+    def get_dirty(self, rects):
+        if self.label._dirty:
+            self.label._dirty = False
+            self._dirty = True
+        UIWidget.get_dirty(self, rects)
+
     def set_text_label(self, text):
         self.label.set_text(text)
 
@@ -526,14 +676,23 @@ class SimplePortrait(UIWidget):
         if not self.visible:
             return False
         if self.picture is None:
-            screen.fill(self.bg_colour, self.picture_pos)
+            screen.fill(self.bg_colour, (self.x + self.picture_pos[0],
+                                         self.y + self.picture_pos[1],
+                                         self.picture_pos[2],
+                                         self.picture_pos[3]))
         else:
             self.picture_rect.x = self.x + self.picture_pos[0]
             self.picture_rect.y = self.y + self.picture_pos[1]
             screen.blit(self.picture, self.picture_rect)
         UIWidget.draw(self, screen)
 
+    def bounds(self):
+        area = pg.Rect(self.x + self.picture_pos[0], self.y + self.picture_pos[1],
+                       self.picture_pos[2], self.picture_pos[3])
+        return UIWidget.bounds(self).union(area)
+
     def set_picture(self, image):
+        self._dirty = True
         self.picture = image
         if not image is None:
             self.picture_rect = image.get_rect()
@@ -614,5 +773,18 @@ class MissionPanel(ActionPanel):
                 return True
         return False
 
+    def bounds(self):
+        rect = ActionPanel.bounds(self)
+        rect.unionall_ip([portrait.bounds() for portrait
+                          in self.team + self.roster + [self.opponent]])
+        return rect
+
+    def get_dirty(self, rects):
+        for portrait in self.team + self.roster + [self.opponent]:
+            if portrait._dirty:
+                portrait._dirty = False
+                self._dirty = True
+        ActionPanel.get_dirty(self, rects)
+
     def set_title(self, text):
         self.label.set_text(text)